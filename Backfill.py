@@ -0,0 +1,87 @@
+# Rebuilds TCA history over a range of dates, spreading the days across a pool of processes
+
+import argparse
+import importlib
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from FillStore import available_dates
+from BrkrIndex import get_index
+
+engines = {'single': 'ProcessExecutions', 'ml': 'ProcessExecutions_ML'}
+
+
+def discover_days(start=None, end=None):
+    # Returns the sorted dates between start and end (inclusive) which have a Trades file
+    days = available_dates('Trades')
+    if start is not None:
+        days = [d for d in days if d >= pd.to_datetime(start)]
+    if end is not None:
+        days = [d for d in days if d <= pd.to_datetime(end)]
+    return days
+
+
+def process_day(dt, engine='ml', use_cache=True, exact_vols=False):
+    # Runs process_day_TCA for one day in a worker.  Failures are reported rather than raised
+    # so that one bad day doesn't stop the rest of the backfill
+    module = importlib.import_module(engines[engine])
+    summary = []
+    try:
+        wins = module.process_day_TCA(dt, summary, use_cache, exact_vols)
+        error = None
+    except Exception as e:
+        wins = 0
+        error = repr(e)
+    return {'date': dt, 'files': wins, 'parents': sorted({s['baseParentNumber'] for s in summary}),
+            'fileNames': [s['file'] for s in summary], 'error': error}
+
+
+def run_backfill(start=None, end=None, workers=None, engine='ml', use_cache=True, exact_vols=False):
+    """Runs TCA for every day with fills between start and end across a process pool
+
+    Parameters
+    ----------
+    start : datetime.date (or anything pd.to_datetime accepts), optional
+        First trade date to process (default is the earliest available)
+    end : datetime.date (or anything pd.to_datetime accepts), optional
+        Last trade date to process (default is the latest available)
+    workers : int, optional
+        Number of worker processes (default is os.cpu_count())
+    engine : string, optional
+        'ml' for ProcessExecutions_ML or 'single' for ProcessExecutions (default is 'ml')
+    use_cache : bool, optional
+        Only recompute parents whose inputs changed since the last run (default is True)
+    exact_vols : bool, optional
+        Calculate the vol rows as exact implied vols (default is False)
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        One row per day, in date order, with the number of files written, the baseParentNumbers
+        processed, the file names and any error
+    """
+
+    days = discover_days(start, end)
+    if len(days) == 0:
+        return pd.DataFrame(columns=['files', 'parents', 'fileNames', 'error'])
+    # Bring the broker state index up to date once, so the workers only ever read it
+    get_index()
+    os.makedirs(os.path.join(os.getcwd(), 'TCA'), exist_ok=True)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        rows = list(pool.map(process_day, days, [engine] * len(days), [use_cache] * len(days),
+                             [exact_vols] * len(days)))
+    return pd.DataFrame(rows).set_index('date')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild TCA files for a range of trade dates')
+    parser.add_argument('start', nargs='?', help='first date, yyyymmdd (default earliest)')
+    parser.add_argument('end', nargs='?', help='last date, yyyymmdd (default latest)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default all cores)')
+    parser.add_argument('--engine', choices=sorted(engines), default='ml')
+    parser.add_argument('--no-cache', action='store_true', help='recompute every parent')
+    parser.add_argument('--exact-vols', action='store_true', help='use exact implied vols in the vol rows')
+    args = parser.parse_args()
+    summary = run_backfill(args.start, args.end, args.workers, args.engine, not args.no_cache, args.exact_vols)
+    summary['parents'] = summary['parents'].apply(len)
+    print(summary[['files', 'parents', 'error']].to_string())
@@ -0,0 +1,66 @@
+# Compares SRUtils.process_time_cols against the original per-cell implementation on the FillData files
+
+import os
+import re
+import time
+import pandas as pd
+from SRUtils import process_time_cols
+
+
+def process_time_cols_legacy(df):
+    # The original implementation: one pd.to_datetime and one pd.Timedelta per cell
+    time_cols = [col for col in df.columns if ('Dttm' in col) and ('_us' not in col)]
+    for col in time_cols:
+        df[col] = df[col].apply(pd.to_datetime)
+        df[col] = df[col].dt.tz_localize('America/Chicago').dt.tz_convert('America/New_York')
+        try:
+            s = df[col + '_us'].apply(pd.Timedelta, unit='micros')
+            df[col] = df[col] + s
+        except:
+            pass
+
+
+def time_call(func, df, repeats):
+    # Returns the best wall time over repeats, and the processed copy of df
+    best = float('inf')
+    for _ in range(repeats):
+        out = df.copy()
+        t = time.perf_counter()
+        func(out)
+        best = min(best, time.perf_counter() - t)
+    return best, out
+
+
+def run_benchmark(fStart='Trades', repeats=3):
+    """Times both implementations on every FillData file starting with fStart
+
+    Parameters
+    ----------
+    fStart: string, optional
+        The initial text in the filenames to benchmark (default='Trades')
+    repeats: int, optional
+        Number of timed runs per file; the best is reported (default=3)
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        Rows per file with legacy and vectorized timings, speedup and whether outputs matched
+    """
+
+    dirPath = os.path.join(os.getcwd(), 'FillData')
+    files = sorted(f for f in os.listdir(dirPath) if f.startswith(fStart) and re.search(r'\d{8}\.csv$', f))
+    rows = []
+    for f in files:
+        df = pd.read_csv(os.path.join(dirPath, f))
+        if df.shape[0] == 0:
+            continue
+        legacy, legacyOut = time_call(process_time_cols_legacy, df, repeats)
+        fast, fastOut = time_call(process_time_cols, df, repeats)
+        rows.append({'File': f, 'Rows': df.shape[0], 'Legacy (s)': legacy, 'Vectorized (s)': fast,
+                     'Speedup': legacy / fast, 'Match': legacyOut.equals(fastOut)})
+    return pd.DataFrame(rows).set_index('File')
+
+
+if __name__ == '__main__':
+    results = run_benchmark()
+    print(results.to_string(float_format='{:.4f}'.format))
@@ -0,0 +1,112 @@
+# Persistent index of SR broker state marks (Qwap / QwapU / Vwap) keyed by baseParentNumber
+#
+# Replaces calling SRUtils.find_first_file for every parent.  The index spans every BrkrState date
+# found by FillStore and is saved to FillData/Store, so each run only reads dates that are new or
+# whose files have changed since the last run.
+
+import os
+import bisect
+import pickle
+from FillStore import store_dir, available_dates, partition_parts, csv_path, load_table
+
+mark_cols = ['brokerQwapMark', 'brokerQwapUMark', 'brokerVwapMark']
+
+
+def source_signature(table, dt):
+    # Identifies the current contents of a table/date so changed files get re-indexed
+    parts = partition_parts(table, dt)
+    paths = parts if len(parts) > 0 else [csv_path(table, dt)]
+    return tuple((os.path.basename(p), os.path.getmtime(p), os.path.getsize(p)) for p in paths)
+
+
+class BrkrStateIndex:
+    """Maps baseParentNumber to the broker state marks of each BrkrState date
+
+    Lookups follow the rules of SRUtils.find_first_file: the first BrkrState date on or after
+    the trade date is used, and the first row for the parent within that date.
+
+    Parameters
+    ----------
+    table : string, optional
+        The broker state table to index (default='BrkrState')
+    """
+
+    def __init__(self, table='BrkrState'):
+        self.table = table
+        self.path = os.path.join(store_dir(), f'{table}Index.pkl')
+        self.sources = {}   # date -> source_signature
+        self.dates = []     # sorted dates in sources
+        self.marks = {}     # baseParentNumber -> {date: {mark_col: value}}
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                self.sources, self.marks = pickle.load(f)
+            self.dates = sorted(self.sources)
+
+    def refresh(self):
+        """Indexes any new or changed dates and drops dates whose files have gone
+
+        Returns
+        -------
+        int
+            The number of dates (re)indexed or removed
+        """
+
+        current = {dt: source_signature(self.table, dt) for dt in available_dates(self.table)}
+        stale = [dt for dt in self.sources if current.get(dt) != self.sources[dt]]
+        for dt in stale:
+            self._drop_date(dt)
+        added = [dt for dt in current if dt not in self.sources]
+        for dt in added:
+            df = load_table(self.table, dt, ['baseParentNumber'] + mark_cols)
+            df = df.drop_duplicates('baseParentNumber')
+            for row in df.itertuples(index=False):
+                self.marks.setdefault(row.baseParentNumber, {})[dt] = \
+                    {col: getattr(row, col) for col in mark_cols if col in df.columns}
+            self.sources[dt] = current[dt]
+        self.dates = sorted(self.sources)
+        changed = len(set(stale) | set(added))
+        if changed > 0:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'wb') as f:
+                pickle.dump((self.sources, self.marks), f)
+        return changed
+
+    def _drop_date(self, dt):
+        del self.sources[dt]
+        for parent in [p for p, byDate in self.marks.items() if dt in byDate]:
+            del self.marks[parent][dt]
+            if len(self.marks[parent]) == 0:
+                del self.marks[parent]
+
+    def lookup(self, parent, dt):
+        """Returns the marks for parent from the first indexed date on or after dt
+
+        Parameters
+        ----------
+        parent : int
+            The baseParentNumber
+        dt : datetime.date (or anything richer)
+            The trade date
+
+        Returns
+        -------
+        dict or None
+            Keyed by mark_cols, or None if the first date has no row for parent
+        """
+
+        i = bisect.bisect_left(self.dates, dt)
+        if i == len(self.dates):
+            return None
+        return self.marks.get(parent, {}).get(self.dates[i])
+
+
+_indices = {}
+
+
+def get_index(table='BrkrState'):
+    # Returns a memoized BrkrStateIndex for table, refreshed against the files on disk
+    key = (os.getcwd(), table)
+    if key not in _indices:
+        _indices[key] = BrkrStateIndex(table)
+    _indices[key].refresh()
+    return _indices[key]
@@ -0,0 +1,213 @@
+# Rebuilds each order's state over the day from the SRSE broker event logs
+#
+# BrkrEvent (single-leg) and MLBrkrEvent (multi-leg) hold an event for every change of a parent
+# order: New, Replace and Close records with the order and broker status and, when closing, the
+# reason.  The events of a day are sorted once by order and time; each event's state then runs
+# until the order's next event, so the whole timeline comes from one linear pass with no per-order
+# loop.  join_fills tags every fill with the state its order was in (a sorted as-of merge), and
+# state_summary sets the time spent in each state against the quantity filled in it.
+
+import numpy as np
+import pandas as pd
+from SRUtils import process_time_cols
+from DayContext import DayContext
+from FillStore import available_dates, load_table
+
+states = ['Active', 'Paused', 'PendingReplace', 'Closed']
+
+# States in which the order is being worked; in the others it has no live parent order
+working_states = ['Active']
+
+# Event columns used, where the table has them
+event_cols = ['parentNumber', 'baseParentNumber', 'prevParentNumber', 'eventNumber', 'recType',
+              'spdrBrokerStatus', 'spdrOrderStatus', 'spdrCloseReason', 'brokerState',
+              'timestamp', 'timestamp_us']
+
+# Broker statuses in which the order isn't being worked
+paused_statuses = ['Paused', 'Suspended', 'Halted']
+
+
+def event_states(events):
+    """Returns the state each event leaves its order in
+
+    Closed for a close, unless a Replace at or after it names the closed parentNumber as its
+    prevParentNumber, in which case it is PendingReplace: the order isn't working until the
+    replacement arrives.  Paused when the broker status or state is one of paused_statuses.
+    Otherwise Active; a RiskHold on the make or take side alone doesn't stop the order filling.
+
+    Parameters
+    ----------
+    events : pandas.core.frame.DataFrame
+        Rows of BrkrEvent or MLBrkrEvent, with their time as a start column
+
+    Returns
+    -------
+    numpy.ndarray
+        Of state names
+    """
+
+    closed = ((events['recType'] == 'Close') | (events['spdrOrderStatus'] == 'Closed')).values
+    # Pair each close with the replaces of its parentNumber and keep those which come later
+    closes = pd.DataFrame({'row': np.flatnonzero(closed), 'parentNumber': events['parentNumber'].values[closed],
+                           'closeStart': events['start'].values[closed]})
+    isReplace = (events['recType'] == 'Replace').values
+    replaces = pd.DataFrame({'parentNumber': events['prevParentNumber'].values[isReplace],
+                             'replaceStart': events['start'].values[isReplace]})
+    pairs = closes.merge(replaces, on='parentNumber')
+    replaced = np.zeros(events.shape[0], dtype=bool)
+    replaced[pairs.loc[pairs['replaceStart'] >= pairs['closeStart'], 'row'].values] = True
+    paused = events['spdrBrokerStatus'].isin(paused_statuses).values
+    if 'brokerState' in events.columns:
+        paused |= events['brokerState'].isin(paused_statuses).values
+    return np.select([replaced, closed, paused], ['PendingReplace', 'Closed', 'Paused'], 'Active')
+
+
+def build_timeline(events):
+    """Returns the state timeline of every order in a day's broker events
+
+    Parameters
+    ----------
+    events : pandas.core.frame.DataFrame
+        Rows of BrkrEvent and / or MLBrkrEvent, with at least the event_cols of event_states plus
+        timestamp and timestamp_us
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        One row per event, sorted by baseParentNumber and start: the order (baseParentNumber, or
+        parentNumber for multi-leg events, which have none), the event's parentNumber, eventNumber,
+        recType, spdrOrderStatus and spdrCloseReason, its state, and the start and end of that state.
+        end is the order's next event, or NaT after its last
+    """
+
+    events = events[[c for c in event_cols if c in events.columns]].copy()
+    events = events.rename(columns={'timestamp': 'startDttm', 'timestamp_us': 'startDttm_us'})
+    process_time_cols(events)
+    events = events.drop(columns=['startDttm_us'], errors='ignore').rename(columns={'startDttm': 'start'})
+    # Multi-leg events carry no baseParentNumber; the parentNumber identifies the order
+    base = events['baseParentNumber'].where(events['baseParentNumber'] != 0, events['parentNumber'])
+    events['baseParentNumber'] = base
+    events['state'] = event_states(events)
+
+    # The one pass: sort, then each event's state lasts until the next event of the same order
+    events = events.sort_values(['baseParentNumber', 'start', 'eventNumber'], kind='mergesort', ignore_index=True)
+    same = (events['baseParentNumber'].values[1:] == events['baseParentNumber'].values[:-1])
+    nextStart = events['start'].shift(-1)
+    events['end'] = nextStart.where(np.append(same, False))
+    cols = ['baseParentNumber', 'parentNumber', 'eventNumber', 'recType', 'spdrOrderStatus', 'spdrCloseReason',
+            'state', 'start', 'end']
+    return events[[c for c in cols if c in events.columns]]
+
+
+def load_events(dt, ctx=None):
+    # Returns the day's BrkrEvent and MLBrkrEvent rows together, or an empty frame if there are none
+    if ctx is not None:
+        frames = [ctx.brkrEvent, ctx.mlBrkrEvent]
+    else:
+        frames = [load_table(t, dt) if dt in available_dates(t) else None for t in ['BrkrEvent', 'MLBrkrEvent']]
+    frames = [df for df in frames if df is not None and df.shape[0] > 0]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=event_cols)
+    return pd.concat([df[[c for c in event_cols if c in df.columns]] for df in frames], ignore_index=True)
+
+
+def day_timeline(dt, ctx=None):
+    """Returns build_timeline of the broker events of trade date dt
+
+    Parameters
+    ----------
+    dt : datetime.date (or anything richer)
+        The trade date
+    ctx : DayContext, optional
+        The day's data, if already loaded (default is to load it)
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+    """
+
+    events = load_events(dt, ctx)
+    if events.shape[0] == 0:
+        return pd.DataFrame(columns=['baseParentNumber', 'parentNumber', 'eventNumber', 'recType',
+                                     'spdrOrderStatus', 'spdrCloseReason', 'state', 'start', 'end'])
+    return build_timeline(events)
+
+
+def join_fills(fills, timeline, time_col='fillTransactDttm'):
+    """Returns fills with the state of their order at each fill, by an as-of merge on time
+
+    Parameters
+    ----------
+    fills : pandas.core.frame.DataFrame
+        Rows of msgsrparentexecution, e.g. DayContext.fills
+    timeline : pandas.core.frame.DataFrame
+        From build_timeline or day_timeline
+    time_col : string, optional
+        The fill time to match (default='fillTransactDttm')
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        fills in time order with the state, start and parentNumber (as eventParentNumber) of the
+        latest event at or before each fill; state is NaN for fills before their order's first event
+    """
+
+    right = timeline[['baseParentNumber', 'start', 'state', 'parentNumber']]
+    right = right.rename(columns={'parentNumber': 'eventParentNumber'}).dropna(subset=['start'])
+    left = fills.sort_values(time_col, kind='mergesort')
+    right = right.sort_values('start', kind='mergesort')
+    right['baseParentNumber'] = right['baseParentNumber'].astype(left['baseParentNumber'].dtype)
+    return pd.merge_asof(left, right, left_on=time_col, right_on='start', by='baseParentNumber',
+                         direction='backward')
+
+
+def state_summary(timeline, joined, until=None):
+    """Returns the time each order spent in each state and the quantity it filled in it
+
+    Parameters
+    ----------
+    timeline : pandas.core.frame.DataFrame
+        From build_timeline or day_timeline
+    joined : pandas.core.frame.DataFrame
+        From join_fills
+    until : pandas.Timestamp, optional
+        Where the last state of an order without a final close ends (default is the order's last
+        fill, or its last event if that is later)
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        Indexed by baseParentNumber and state: seconds, fills, fillQuantity, fill rate in quantity
+        per minute, and working (whether the state is one of working_states).  Fills in a state that
+        isn't working, e.g. PendingReplace, are late reports of the order's closed children
+    """
+
+    tl = timeline.copy()
+    joined = joined[joined['fillQuantity'] > 0]
+    time_col = 'fillTransactDttm' if 'fillTransactDttm' in joined.columns else 'fillDttm'
+    if until is None:
+        lastFill = joined.groupby('baseParentNumber')[time_col].max()
+        lastEvent = tl.groupby('baseParentNumber')['start'].max()
+        ends = pd.concat([lastFill, lastEvent], axis=1).max(axis=1)
+        until = tl['baseParentNumber'].map(ends)
+    # A final close lasts no time; any other open ended state runs to until
+    end = tl['end'].where(tl['end'].notna() | (tl['state'] == 'Closed'), until)
+    tl['seconds'] = (end - tl['start']).dt.total_seconds().fillna(0)
+    seconds = tl.groupby(['baseParentNumber', 'state'])['seconds'].sum()
+    filled = joined.groupby(['baseParentNumber', 'state'])['fillQuantity'].agg(['size', 'sum'])
+    filled.columns = ['fills', 'fillQuantity']
+    summary = pd.concat([seconds, filled], axis=1).fillna(0)
+    summary['qtyPerMin'] = summary['fillQuantity'] / (summary['seconds'] / 60).where(summary['seconds'] > 0)
+    summary['working'] = summary.index.get_level_values('state').isin(working_states)
+    return summary
+
+
+if __name__ == '__main__':
+    pd.set_option('display.width', 200)
+    for dt in sorted(set(available_dates('BrkrEvent')) | set(available_dates('MLBrkrEvent'))):
+        ctx = DayContext(dt) if dt in available_dates('Trades') else None
+        timeline = day_timeline(dt, ctx)
+        print(f'{dt:%Y%m%d}')
+        print(timeline.to_string(index=False))
+        if ctx is not None:
+            print(state_summary(timeline, join_fills(ctx.fills, timeline)).to_string())
@@ -0,0 +1,100 @@
+# Renders the fill graph and bucketed fill histogram of every order over a range of dates
+#
+# Days are spread across a pool of processes, each loading its own day and rendering its orders,
+# so the parent process only ever holds the result rows.  The charts are written to TCA/ as html or
+# static images without opening a browser, so the end of day job can build the whole book.  The
+# html charts share one plotly.min.js in TCA/ rather than each embedding its own copy.
+
+import argparse
+import os
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+from DayContext import DayContext
+from Backfill import discover_days
+from FillVizualizer import plot_fill_graph
+from FillHistogram import plot_fill_bar
+
+
+def chart_name(dt, parent, kind, fmt='html'):
+    # Returns the file name of an order's chart, e.g. '20210319 70624 Fills.html'
+    return f'{dt:%Y%m%d} {parent % 100000} {kind}.{fmt}'
+
+
+def render_parent(dt, parent, fills, fmt='html', timeDelta='5min', max_points=None):
+    # Renders one order's charts in a worker.  Failures are reported rather than raised so that
+    # one bad order doesn't stop the rest of the book
+    files = []
+    try:
+        fName = chart_name(dt, parent, 'Fills', fmt)
+        plot_fill_graph(fills, True, max_points=max_points, fName=fName, auto_open=False, plotlyjs='directory')
+        files.append(fName)
+        fName = chart_name(dt, parent, 'Buckets', fmt)
+        plot_fill_bar(fills[fills['fillQuantity'] > 0], timeDelta, True, fName, auto_open=False,
+                      plotlyjs='directory')
+        files.append(fName)
+        error = None
+    except Exception as e:
+        error = repr(e)
+    return {'date': dt, 'baseParentNumber': parent, 'files': files, 'error': error}
+
+
+def render_day(dt, fmt='html', timeDelta='5min', max_points=None):
+    # Loads one day in a worker and renders each of its orders with fills, returning the result rows
+    try:
+        ctx = DayContext(dt)
+    except Exception as e:
+        return [{'date': dt, 'baseParentNumber': None, 'files': [], 'error': repr(e)}]
+    return [render_parent(dt, parent, fills, fmt, timeDelta, max_points)
+            for parent, fills in ctx.parentFills.items() if (fills['fillQuantity'] > 0).any()]
+
+
+def render_book(start=None, end=None, workers=None, fmt='html', timeDelta='5min', max_points=None):
+    """Renders the charts of every baseParentNumber with fills between start and end
+
+    Parameters
+    ----------
+    start : datetime.date (or anything pd.to_datetime accepts), optional
+        First trade date (default is the earliest available)
+    end : datetime.date (or anything pd.to_datetime accepts), optional
+        Last trade date (default is the latest available)
+    workers : int, optional
+        Number of worker processes (default is os.cpu_count())
+    fmt : string, optional
+        'html', or an image format such as 'png' or 'svg' (which needs kaleido) (default='html')
+    timeDelta : string, optional
+        The histogram bucket width (default='5min')
+    max_points : int, optional
+        Downsample the fill graph's lines to this many points (default is every point)
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        One row per order with the files written and any error; a day which fails to load has one
+        row with no baseParentNumber
+    """
+
+    days = discover_days(start, end)
+    rows = []
+    if len(days) > 0:
+        os.makedirs(os.path.join(os.getcwd(), 'TCA'), exist_ok=True)
+        n = len(days)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for dayRows in pool.map(render_day, days, [fmt] * n, [timeDelta] * n, [max_points] * n):
+                rows.extend(dayRows)
+    if len(rows) == 0:
+        return pd.DataFrame(columns=['date', 'baseParentNumber', 'files', 'error'])
+    return pd.DataFrame(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the fill charts of every order for a range of trade dates')
+    parser.add_argument('start', nargs='?', help='first date, yyyymmdd (default earliest)')
+    parser.add_argument('end', nargs='?', help='last date, yyyymmdd (default latest)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default all cores)')
+    parser.add_argument('--format', default='html', help="html, or an image format such as png (needs kaleido)")
+    parser.add_argument('--bucket', default='5min', help='histogram bucket width (default 5min)')
+    parser.add_argument('--max-points', type=int, default=None, help='downsample chart lines to this many points')
+    args = parser.parse_args()
+    book = render_book(args.start, args.end, args.workers, args.format, args.bucket, args.max_points)
+    book['files'] = book['files'].apply(len)
+    print(book.to_string(index=False))
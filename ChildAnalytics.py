@@ -0,0 +1,221 @@
+# Child order lifecycle: how long each child order took to fill, and how much of it filled
+#
+# The TCA engines only count child orders and take their average size.  Here every child order
+# (clOrdId) of a day or a range of days is summarised in one groupby over the fills: its size,
+# quantity filled, fill ratio, method, market stance and the seconds from the child's creation
+# (childDttm) to its first and last fills.  The child table is then grouped by method, stance or
+# anything else to give fill-rate tables and time-to-fill percentiles, with each order's slicing
+# parameters from BrkrDetail (progressRule, progressSliceCnt, progressExposeTime) alongside so
+# that they can be tuned against the results.
+
+import time
+import numpy as np
+import pandas as pd
+from DayContext import DayContext
+from FillStore import available_dates, load_fill_history, load_table
+
+# Child order columns carried from the first fill of each child
+child_cols = ['childMethod', 'childMktStance', 'childMakerTaker', 'secType', 'childSize', 'childDttm']
+
+# The instrument of a fill; a multi-leg child has fills of each of its legs under one clOrdId
+leg_cols = ['secKey_tk', 'secKey_yr', 'secKey_mn', 'secKey_dy', 'secKey_xx', 'secKey_cp']
+
+# The BrkrDetail slicing parameters joined to each child by baseParentNumber
+slicing_cols = ['progressRule', 'progressSliceCnt', 'progressExposeTime']
+
+percentiles = (0.5, 0.9, 0.99)
+
+
+def child_orders(df):
+    """Returns one row per child order of df's fills
+
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        Rows of msgsrparentexecution with the SRUtils.keep_cols fields, of any number of orders and
+        days, e.g. DayContext.fills or FillStore.load_fill_history
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        baseParentNumber, clOrdId, the child_cols with methodFamily (childMethod up to any ':'), legs,
+        fills, filledQty, fillRatio (filledQty / childSize), complete (fillRatio >= 1) and
+        secsToFirstFill / secsToLastFill from childDttm.  The times are NaN for children which never
+        filled or have no childDttm.  For a multi-leg child, whose childSize is the package size,
+        fills and filledQty are those of its least filled leg, i.e. the packages filled
+    """
+
+    qty = df['fillQuantity'].values
+    filled = qty > 0
+    # Times as integer ns, so that min / max are plain numeric reductions; NaT where nothing filled
+    fillNs = df['fillTransactDttm'].values.view('int64').astype('float64')
+    fillNs[~filled] = np.nan
+    sums = pd.DataFrame({'baseParentNumber': df['baseParentNumber'].values, 'clOrdId': df['clOrdId'].values,
+                         'fills': filled.astype('int32'), 'filledQty': np.where(filled, qty, 0),
+                         'firstNs': fillNs, 'lastNs': fillNs})
+    # Numbered once over the few distinct instruments, so the fills are grouped on integers
+    sums['leg'] = df.groupby(leg_cols, sort=False, observed=True, dropna=False).ngroup().values
+    # The child_cols are taken from each child's first row, found as a numeric min rather than by a
+    # groupby first, which is slow on categorical and tz-aware columns
+    sums['row'] = np.arange(df.shape[0])
+
+    # The one pass over the fills, by child and leg, then the legs of each child combined
+    agg = {'fills': 'sum', 'filledQty': 'sum', 'firstNs': 'min', 'lastNs': 'max', 'row': 'min'}
+    legs = sums.groupby(['baseParentNumber', 'clOrdId', 'leg'], sort=False).agg(agg)
+    agg.update({'fills': 'min', 'filledQty': 'min', 'leg': 'size'})
+    child = legs.reset_index().groupby(['baseParentNumber', 'clOrdId'], sort=False).agg(agg)
+    child = child.rename(columns={'leg': 'legs'}).reset_index()
+    rows = child.pop('row').values
+    for i, c in enumerate(child_cols):
+        child.insert(2 + i, c, df[c].iloc[rows].array)
+
+    # e.g. TAP for TAP:0.11, whose suffix varies order by order
+    child.insert(child.columns.get_loc('childMethod'), 'methodFamily',
+                 child['childMethod'].astype(str).str.split(':').str[0])
+    child['fillRatio'] = child['filledQty'] / child['childSize'].where(child['childSize'] > 0)
+    child['complete'] = child['fillRatio'] >= 1
+    childNs = child['childDttm'].values.view('int64').astype('float64')
+    childNs[child['childDttm'].isna().values] = np.nan
+    child['secsToFirstFill'] = (child.pop('firstNs') - childNs) / 1e9
+    child['secsToLastFill'] = (child.pop('lastNs') - childNs) / 1e9
+    return child
+
+
+def load_slicing(dt):
+    # Returns the day's BrkrDetail slicing_cols by baseParentNumber (its latest row), or None
+    if dt not in available_dates('BrkrDetail'):
+        return None
+    return slicing(load_table('BrkrDetail', dt))
+
+
+def slicing(brkrDetail):
+    # Returns the slicing_cols of each baseParentNumber in brkrDetail, from its latest row
+    if brkrDetail is None or brkrDetail.shape[0] == 0:
+        return None
+    return brkrDetail.groupby('baseParentNumber')[slicing_cols].last()
+
+
+def add_slicing(child, detail):
+    # Adds the slicing_cols of each child's order; NaN where the order has no BrkrDetail
+    if detail is None:
+        detail = pd.DataFrame(columns=slicing_cols)
+    for c in slicing_cols:
+        child[c] = child['baseParentNumber'].map(detail[c]) if c in detail.columns else np.nan
+    return child
+
+
+def day_children(dt, ctx=None):
+    """Returns child_orders for every fill of trade date dt, with each order's slicing parameters
+
+    Parameters
+    ----------
+    dt : datetime.date (or anything richer)
+        The trade date
+    ctx : DayContext, optional
+        The day's data, if already loaded (default is to load it)
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+    """
+
+    if ctx is None:
+        ctx = DayContext(dt)
+    return add_slicing(child_orders(ctx.fills), slicing(ctx.brkrDetail))
+
+
+def history_children(start=None, end=None):
+    """Returns child_orders for every fill between start and end (inclusive), with slicing parameters
+
+    The fills of the range are loaded compacted and summarised in one pass, rather than day by day.
+
+    Parameters
+    ----------
+    start, end : datetime.date (or anything pd.to_datetime accepts), optional
+        The range of trade dates (default is all)
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+    """
+
+    child = child_orders(load_fill_history(start, end))
+    days = [d for d in available_dates('BrkrDetail') if (start is None or d >= pd.to_datetime(start))
+            and (end is None or d <= pd.to_datetime(end))]
+    details = [s for s in (load_slicing(d) for d in days) if s is not None]
+    detail = pd.concat(details) if len(details) > 0 else None
+    if detail is not None:
+        detail = detail[~detail.index.duplicated(keep='last')]
+    return add_slicing(child, detail)
+
+
+def fill_rate_table(child, keys=('methodFamily',)):
+    """Returns how much of their size the child orders filled, grouped by keys
+
+    Parameters
+    ----------
+    child : pandas.core.frame.DataFrame
+        From child_orders, day_children or history_children
+    keys : list or tuple, optional
+        Columns of child to group by (default=('methodFamily',))
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        childOrders, childSize and filledQty summed, fillRate (filledQty / childSize), and the
+        fractions of child orders which filled completely, partly and not at all (completeRate,
+        partialRate and unfilledRate), all as fractions of 1
+    """
+
+    ratio = child['fillRatio'].fillna(0)
+    t = pd.DataFrame({'childOrders': 1, 'childSize': child['childSize'], 'filledQty': child['filledQty'],
+                      'completeRate': child['complete'].astype(int),
+                      'partialRate': ((ratio > 0) & (ratio < 1)).astype(int),
+                      'unfilledRate': (ratio == 0).astype(int)})
+    keys = list(keys)
+    for k in keys:
+        t[k] = child[k]
+    t = t.groupby(keys, observed=True).sum()
+    for c in ['completeRate', 'partialRate', 'unfilledRate']:
+        t[c] = t[c] / t['childOrders']
+    t.insert(3, 'fillRate', t['filledQty'] / t['childSize'].where(t['childSize'] > 0))
+    return t
+
+
+def latency_table(child, keys=('methodFamily',), q=percentiles):
+    """Returns percentiles of the seconds from child creation to fill, grouped by keys
+
+    Parameters
+    ----------
+    child : pandas.core.frame.DataFrame
+        From child_orders, day_children or history_children
+    keys : list or tuple, optional
+        Columns of child to group by (default=('methodFamily',))
+    q : list or tuple, optional
+        The percentiles, as fractions (default=percentiles)
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        filledChildren, and for each q 'firstFill p{q}' and 'lastFill p{q}' in seconds, over the child
+        orders which filled
+    """
+
+    filled = child[child['fills'] > 0]
+    groups = filled.groupby(list(keys), observed=True)
+    t = groups[['secsToFirstFill', 'secsToLastFill']].quantile(list(q)).unstack()
+    names = {'secsToFirstFill': 'firstFill', 'secsToLastFill': 'lastFill'}
+    t.columns = [f'{names[c]} p{round(p * 100)}' for c, p in t.columns]
+    t.insert(0, 'filledChildren', groups.size())
+    return t
+
+
+if __name__ == '__main__':
+    pd.set_option('display.width', 200)
+    t0 = time.perf_counter()
+    child = history_children()
+    ms = (time.perf_counter() - t0) * 1000
+    print(f'{child.shape[0]} child orders {ms:.1f}ms')
+    for keys in [['methodFamily'], ['methodFamily', 'childMktStance'], ['progressRule', 'progressSliceCnt']]:
+        print(fill_rate_table(child, keys).round(3).to_string())
+        print(latency_table(child, keys).round(3).to_string())
@@ -0,0 +1,77 @@
+# One trade date's data, loaded and normalized once and shared by the TCA, chart and histogram tools
+#
+# An end of day run builds a DayContext and passes it to process_day_TCA (either engine),
+# ChartBook and the FillVizualizer / FillHistogram helpers, so the day's files are parsed once.
+
+from FillStore import available_dates, load_fills, load_table
+from SRUtils import group_fills
+
+# Columns loaded beyond SRUtils.keep_cols: the ids each engine groups by and the histogram's fill time
+context_cols = ['packageId', 'riskGroupId', 'execShape', 'fillDttm']
+
+
+class DayContext:
+    """The fills, broker state, detail and events of one trade date, with group indices
+
+    The broker tables are only read when first used.  Fills are split by baseParentNumber once,
+    and the grouping by package or risk group is built once per group column.
+
+    Parameters
+    ----------
+    dt : datetime.date (or anything richer)
+        The trade date
+    """
+
+    def __init__(self, dt):
+        self.dt = dt
+        self.fills = load_fills(dt, context_cols)
+        self.parentFills = {p: g for p, g in self.fills.groupby('baseParentNumber', sort=False)}
+        self._groups = {}
+        self._tables = {}
+
+    def _table(self, table):
+        # Returns table for the date, or None if there is none
+        if table not in self._tables:
+            if self.dt in available_dates(table):
+                self._tables[table] = load_table(table, self.dt)
+            else:
+                self._tables[table] = None
+        return self._tables[table]
+
+    @property
+    def brkrState(self):
+        return self._table('BrkrState')
+
+    @property
+    def brkrDetail(self):
+        return self._table('BrkrDetail')
+
+    @property
+    def brkrEvent(self):
+        return self._table('BrkrEvent')
+
+    @property
+    def mlBrkrEvent(self):
+        return self._table('MLBrkrEvent')
+
+    @property
+    def parents(self):
+        # The baseParentNumbers of the day, in order of first fill
+        return list(self.parentFills)
+
+    def groups(self, groupCol):
+        """Returns the (group, opt_parents, stock_parents) tuples of SRUtils.group_fills
+
+        Parameters
+        ----------
+        groupCol : string
+            e.g. 'packageId' or 'riskGroupId'
+
+        Returns
+        -------
+        list
+        """
+
+        if groupCol not in self._groups:
+            self._groups[groupCol] = group_fills(self.fills, groupCol, self.parentFills)[0]
+        return self._groups[groupCol]
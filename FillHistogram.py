@@ -1,12 +1,36 @@
 import pandas as pd
-import os
-from SRUtils import process_time_cols, make_title
+from SRUtils import make_title
+from DayContext import DayContext
+from FillVizualizer import save_figure
 import plotly.express as px
 
 import plotly.io as pio
-pio.renderers.default = 'browser'
 
-def plot_fill_bar(df, timeDelta='5min', save=False):
+def plot_fill_bar(df, timeDelta='5min', save=False, fName=None, auto_open=True, plotlyjs=True):
+    """Charts the quantity filled in each timeDelta bucket from the order's creation
+
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        A dataframe generated from SRSE Trade's msgsrparentexecution table, filtered to a single order
+    timeDelta : string, optional
+        The bucket width as a pandas frequency (default='5min')
+    save : bool, optional
+        Whether to save the chart to the TCA directory rather than display it (default is False)
+    fName : string, optional
+        The file name to save to; its extension picks html or an image format
+        (default is the title + ' Buckets.html')
+    auto_open : bool, optional
+        Whether to open the saved html file in the browser (default is True)
+    plotlyjs : bool or string, optional
+        As for FillVizualizer.save_figure (default is True)
+
+    Returns
+    -------
+    pandas.core.series.Series
+        The fill quantity of each bucket
+    """
+
     startTime = df.loc[df.index[0], 'parentDttm']
     bucketFills = df.groupby(pd.Grouper(key='fillDttm', freq=timeDelta, origin=startTime))['fillQuantity'].sum()
     title = make_title(df)
@@ -18,12 +42,18 @@ def plot_fill_bar(df, timeDelta='5min', save=False):
                  title=title + f', Bucketed Every {timeDelta}')
     fig.update_xaxes(tickvals=bucketFills.index, tickformat='%H:%M')
     fig.layout.update(showlegend=False)
-    fig.show()
+    if save:
+        save_figure(fig, fName or f'{title} Buckets.html', auto_open, plotlyjs)
+    else:
+        fig.show()
     return bucketFills
 
+def plot_parent_bar(ctx, parent, timeDelta='5min', **kwargs):
+    # Runs plot_fill_bar on the positive quantity fills of parent from a DayContext; kwargs are passed on
+    fills = ctx.parentFills[parent]
+    return plot_fill_bar(fills[fills['fillQuantity'] > 0], timeDelta, **kwargs)
+
 if __name__ == '__main__':
-    df = pd.read_csv(os.path.join(os.getcwd(), 'FillData', 'Trades20210125.csv'))
-    process_time_cols(df)
-    parents = df['baseParentNumber'].unique()
-    df = df[df['baseParentNumber'] == parents[0]]
-    result = plot_fill_bar(df)
\ No newline at end of file
+    pio.renderers.default = 'browser'
+    ctx = DayContext(pd.to_datetime('20210125'))
+    result = plot_parent_bar(ctx, ctx.parents[0])
\ No newline at end of file
@@ -0,0 +1,260 @@
+# Columnar, date-partitioned store for the SRSE tables saved by QuerySRTables.py
+#
+# Each table/date partition is a directory FillData/Store/{table}/{yyyymmdd} holding one or more
+# parquet part files.  Rows are stored with typed columns and tz-aware timestamps (the output of
+# process_time_cols), so loads need neither string parsing nor time conversion.
+
+import os
+import re
+import pandas as pd
+from pandas.api.types import union_categoricals
+from SRUtils import keep_cols, process_time_cols, compact_fills, compact_errors
+
+tables = ['Trades', 'BrkrState', 'BrkrDetail', 'BrkrEvent', 'MLBrkrState', 'MLBrkrEvent']
+
+# Columns identifying a row.  When a partition has several parts (e.g. from incremental pulls)
+# loads keep only the last row for each key, so re-sent or updated rows replace earlier ones
+primary_keys = {
+    'Trades': ['fillNumber'],
+    'BrkrState': ['parentNumber'],
+    'BrkrDetail': ['parentNumber'],
+    'BrkrEvent': ['parentNumber', 'eventNumber', 'timestamp', 'timestamp_us'],
+    'MLBrkrState': ['parentNumber'],
+    'MLBrkrEvent': ['parentNumber', 'eventNumber', 'timestamp', 'timestamp_us'],
+}
+
+# Rows per parquet row group.  OrderIndex.load_order reads a part file a row group at a time
+row_group_rows = 5000
+
+
+def store_dir():
+    return os.path.join(os.getcwd(), 'FillData', 'Store')
+
+
+def partition_dir(table, dt):
+    return os.path.join(store_dir(), table, f'{dt:%Y%m%d}')
+
+
+def partition_parts(table, dt):
+    # Returns the sorted part files of a partition, or [] if it doesn't exist
+    pDir = partition_dir(table, dt)
+    if not os.path.isdir(pDir):
+        return []
+    return [os.path.join(pDir, f) for f in sorted(os.listdir(pDir)) if f.endswith('.parquet')]
+
+
+def csv_path(table, dt):
+    return os.path.join(os.getcwd(), 'FillData', f'{table}{dt:%Y%m%d}.csv')
+
+
+def normalize(df):
+    """Prepares a raw SRSE query result for the store
+
+    Drops the index column written by DataFrame.to_csv, converts the Dttm columns with
+    process_time_cols and then drops their _us companions, which have been merged in.
+    """
+
+    df = df.drop([c for c in df.columns if c.startswith('Unnamed:')], axis=1)
+    process_time_cols(df)
+    merged = [col + '_us' for col in df.columns if ('Dttm' in col) and ('_us' not in col)]
+    return df.drop([c for c in merged if c in df.columns], axis=1)
+
+
+def write_table(df, table, dt, append=False):
+    """Writes df as a partition of table for date dt
+
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        A raw query result (time columns as strings or naive datetimes) or an already normalized frame
+    table : string
+        One of tables, e.g. 'Trades'
+    dt : datetime.date (or anything richer)
+        The partition date
+    append : bool, optional
+        Add a new part file to the partition rather than replacing it (default is False)
+
+    Returns
+    -------
+    string
+        The path of the part file written
+    """
+
+    pDir = partition_dir(table, dt)
+    os.makedirs(pDir, exist_ok=True)
+    parts = partition_parts(table, dt)
+    if not append:
+        for p in parts:
+            os.remove(p)
+        parts = []
+    path = os.path.join(pDir, f'part-{len(parts):05}.parquet')
+    normalize(df).to_parquet(path, index=False, row_group_size=row_group_rows)
+    # Keep the order index in step with the store.  Imported here as OrderIndex imports this module
+    from OrderIndex import get_order_index
+    get_order_index(refresh=False).index_date(table, dt)
+    return path
+
+
+def available_dates(table):
+    # Returns the sorted dates for which table exists, either in the store or as a FillData csv
+    dates = set()
+    tDir = os.path.join(store_dir(), table)
+    if os.path.isdir(tDir):
+        dates.update(d for d in os.listdir(tDir) if re.fullmatch(r'\d{8}', d) and partition_parts(table, pd.to_datetime(d)))
+    dirPath = os.path.join(os.getcwd(), 'FillData')
+    dates.update(re.fullmatch(table + r'(\d{8})\.csv', f).group(1) for f in os.listdir(dirPath)
+                 if re.fullmatch(table + r'(\d{8})\.csv', f))
+    return [pd.to_datetime(d) for d in sorted(dates)]
+
+
+def load_table(table, dt, columns=None):
+    """Returns the normalized rows of table for date dt
+
+    Reads from the store if the partition exists, otherwise falls back to parsing the FillData csv.
+    Rows of a multi-part partition are de-duplicated on the table's primary_keys, keeping the last.
+
+    Parameters
+    ----------
+    table : string
+        One of tables, e.g. 'Trades'
+    dt : datetime.date (or anything richer)
+        The partition date
+    columns : list, optional
+        Restrict the load to these columns; names missing from the table are ignored (default is all)
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+    """
+
+    parts = partition_parts(table, dt)
+    if len(parts) > 0:
+        keys = primary_keys.get(table, []) if len(parts) > 1 else []
+        readCols = columns
+        if columns is not None:
+            import pyarrow.parquet as pq
+            present = set(pq.read_schema(parts[0]).names)
+            columns = [c for c in columns if c in present]
+            readCols = columns + [k for k in keys if k in present and k not in columns]
+        dfs = [pd.read_parquet(p, columns=readCols) for p in parts]
+        if len(dfs) == 1:
+            return dfs[0]
+        df = pd.concat(dfs, ignore_index=True)
+        keys = [k for k in keys if k in df.columns]
+        if len(keys) > 0:
+            df = df.drop_duplicates(keys, keep='last', ignore_index=True)
+        return df if columns is None else df[columns]
+
+    if columns is None:
+        usecols = None
+    else:
+        wanted = set(columns) | {c + '_us' for c in columns}
+        usecols = lambda c: c in wanted
+    df = pd.read_csv(csv_path(table, dt), usecols=usecols)
+    df = normalize(df)
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    return df
+
+
+def load_fills(dt, extra_cols=None, compact=False):
+    """Returns the fills for date dt, restricted to SRUtils.keep_cols plus extra_cols
+
+    Parameters
+    ----------
+    dt : datetime.date (or anything richer)
+        The trade date
+    extra_cols : list, optional
+        Further msgsrparentexecution columns to load, e.g. ['packageId'] (default is None)
+    compact : bool, optional
+        Convert to the SRUtils.compact_fills dtypes, with prices rounded to the penny (default is False)
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+    """
+
+    columns = keep_cols + [c for c in (extra_cols or []) if c not in keep_cols]
+    df = load_table('Trades', dt, columns)
+    return compact_fills(df) if compact else df
+
+
+def load_fill_history(start=None, end=None, extra_cols=None, compact=True):
+    """Returns the fills of every trade date between start and end (inclusive) in one frame
+
+    Each day is compacted as it is loaded, so the full history is never held at its loaded size.
+    Categorical columns are combined with the union of every day's categories.
+
+    Parameters
+    ----------
+    start : datetime.date (or anything pd.to_datetime accepts), optional
+        First trade date (default is the earliest available)
+    end : datetime.date (or anything pd.to_datetime accepts), optional
+        Last trade date (default is the latest available)
+    extra_cols : list, optional
+        As for load_fills
+    compact : bool, optional
+        As for load_fills (default is True)
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+    """
+
+    days = available_dates('Trades')
+    if start is not None:
+        days = [d for d in days if d >= pd.to_datetime(start)]
+    if end is not None:
+        days = [d for d in days if d <= pd.to_datetime(end)]
+    dfs = [load_fills(dt, extra_cols, compact) for dt in days]
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=keep_cols + [c for c in (extra_cols or []) if c not in keep_cols])
+    # pd.concat turns categoricals with different categories back into strings
+    cats = {c: union_categoricals([df[c] for df in dfs]).categories for c in dfs[0].columns
+            if all(isinstance(df[c].dtype, pd.CategoricalDtype) for df in dfs)}
+    for df in dfs:
+        for c, categories in cats.items():
+            df[c] = df[c].cat.set_categories(categories)
+    df = pd.concat(dfs, ignore_index=True)
+    # A float column read as int64 on a day when it is all zero (e.g. strikes on a stock only day)
+    # comes back from concat as float64, so compact it again
+    return compact_fills(df) if compact else df
+
+
+def migrate_csvs(overwrite=False):
+    """Converts every FillData csv of a known table into a store partition
+
+    Parameters
+    ----------
+    overwrite : bool, optional
+        Rewrite partitions which already exist in the store (default is False)
+
+    Returns
+    -------
+    list
+        The (table, date) pairs converted
+    """
+
+    done = []
+    dirPath = os.path.join(os.getcwd(), 'FillData')
+    for f in sorted(os.listdir(dirPath)):
+        m = re.fullmatch(r'([A-Za-z]+)(\d{8})\.csv', f)
+        if m is None or m.group(1) not in tables:
+            continue
+        table, dt = m.group(1), pd.to_datetime(m.group(2))
+        if partition_parts(table, dt) and not overwrite:
+            continue
+        write_table(pd.read_csv(os.path.join(dirPath, f)), table, dt)
+        done.append((table, dt))
+    return done
+
+
+if __name__ == '__main__':
+    for table, dt in migrate_csvs():
+        print(f'{table} {dt:%Y%m%d}')
+    # Check that compacting only narrows prices: greeks, fees, marks and vols must survive it
+    for dt in available_dates('Trades'):
+        df = load_fills(dt)
+        errors = compact_errors(df, compact_fills(df))
+        if errors:
+            raise ValueError(f'compact_fills changed {errors} on {dt:%Y%m%d}')
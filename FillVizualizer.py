@@ -1,13 +1,88 @@
 import os
+import numpy as np
 import pandas as pd
-from SRUtils import process_time_cols, make_title
+from SRUtils import make_title
+from DayContext import DayContext
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
 import plotly.offline as off
 import plotly.io as pio
-pio.renderers.default = 'browser'
 
-def plot_fill_graph(df, save=True):
+def save_figure(fig, fName, auto_open=False, plotlyjs=True):
+    """Writes fig to the TCA directory, as html or, for other extensions, a static image
+
+    Parameters
+    ----------
+    fig : plotly.graph_objects.Figure
+    fName : string
+        The file name, e.g. 'Buy 1000 SPX.html' or 'Buy 1000 SPX.png' (images need kaleido)
+    auto_open : bool, optional
+        Open html files in the browser once written (default is False)
+    plotlyjs : bool or string, optional
+        How html files get plotly.js: True embeds it (about 4.8MB a file), 'directory' shares one
+        plotly.min.js beside the files and 'cdn' loads it from the web (default is True)
+
+    Returns
+    -------
+    string
+        The path written
+    """
+
+    path = os.path.join(os.getcwd(), 'TCA', fName)
+    if fName.endswith('.html'):
+        off.plot(fig, filename=path, auto_open=auto_open, include_plotlyjs=plotlyjs)
+    else:
+        fig.write_image(path)
+    return path
+
+def lttb_indices(x, y, n_out):
+    """Returns the positions of the points Largest-Triangle-Three-Buckets keeps from a line
+
+    The first and last points are always kept.  The rest are split into n_out - 2 buckets, and
+    from each the point forming the largest triangle with the point kept from the previous
+    bucket and the average of the next bucket is kept, which preserves the line's visual shape.
+
+    Parameters
+    ----------
+    x : array_like
+        Increasing x values (datetimes are converted to nanoseconds)
+    y : array_like
+        The y values; NaN points are only kept if a bucket has nothing else
+    n_out : int
+        The number of points to keep
+
+    Returns
+    -------
+    numpy.ndarray
+        Sorted integer positions into x and y
+    """
+
+    x = np.asarray(x)
+    if np.issubdtype(x.dtype, np.datetime64):
+        x = pd.to_datetime(pd.Series(x)).values.astype('datetime64[ns]').astype(np.int64)
+    x = x.astype(float)
+    y = np.asarray(y, dtype=float)
+    n = x.shape[0]
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0] = 0
+    keep[-1] = n - 1
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Average of the next bucket (the last point for the final bucket)
+        nlo, nhi = hi, edges[i + 2] if i + 2 < len(edges) else n
+        avgX = x[nlo:nhi].mean()
+        avgY = np.nanmean(y[nlo:nhi]) if np.isfinite(y[nlo:nhi]).any() else y[keep[i]]
+        aX, aY = x[keep[i]], y[keep[i]]
+        areas = np.abs((aX - avgX) * (y[lo:hi] - aY) - (aX - x[lo:hi]) * (avgY - aY))
+        areas = np.where(np.isnan(areas), -1, areas)
+        keep[i + 1] = lo + np.argmax(areas)
+    return keep
+
+def plot_fill_graph(df, save=True, exact_vols=False, max_points=None, fName=None, auto_open=True, plotlyjs=True):
     """Generates a vizualization of a trade execution
 
     For stock trades, this produces a price chart showing bid/offer prices with
@@ -22,10 +97,23 @@ def plot_fill_graph(df, save=True):
         A dataframe generated from SRSE Trade's msgsrparentexecution table, filtered to represent a single underlying
     save: bool, optional
         Whether to save the html file to the TCA directory (default is True)
+    exact_vols: bool, optional
+        Whether to chart option prices as Black-76 implied vols (see ImpliedVol) rather than
+        from the first fill's vol and vega (default is False)
+    max_points: int, optional
+        Downsample each quote, spread, underlier and cumulative fill line to at most this many
+        points with lttb_indices; every fill marker is still drawn (default is to plot every point)
+    fName: string, optional
+        The file name to save to; its extension picks html or an image format (default is the title + .html)
+    auto_open: bool, optional
+        Whether to open the saved html file in the browser (default is True)
+    plotlyjs: bool or string, optional
+        As for save_figure (default is True)
 
     Returns
     -------
-    None (although it will display the graph in a browser)
+    string or None
+        The path saved to, or None if the graph was only displayed
     """
 
     df = df[df['fillQuantity'] > 0].copy()
@@ -60,8 +148,16 @@ def plot_fill_graph(df, save=True):
         arrival_mark_vol = first_trade_vol + (arrival_mark - first_trade_adj_px) / (100 * vega)
 
         df_vol = pd.DataFrame(index = df.index, columns=cols)
-        for col in cols[2:6]:
-            df_vol[col] = arrival_mid_vol + (df_adj[col] - arrival_mid) / (100 * vega)
+        if exact_vols:
+            # Invert all four delta-adjusted price columns at the arrival underlying in one go
+            from ImpliedVol import option_terms, implied_vol
+            K, T, is_call = option_terms(df)
+            vols = implied_vol(df_adj[cols[2:6]].values.T.astype(float), arrival_ul_mid, K, T, is_call)
+            for i, col in enumerate(cols[2:6]):
+                df_vol[col] = vols[i]
+        else:
+            for col in cols[2:6]:
+                df_vol[col] = arrival_mid_vol + (df_adj[col] - arrival_mid) / (100 * vega)
 
         for col in cols[:2] + cols[6:]:
             df_vol[col] = df[col]
@@ -72,51 +168,43 @@ def plot_fill_graph(df, save=True):
         max_fill = df['fillQuantity'].max()
         scale_arrows = True
 
+        def line(y):
+            # Returns the x and y of a line trace, downsampled to max_points if set
+            x = df['fillTransactDttm']
+            if max_points is not None:
+                keep = lttb_indices(x.values, y.values, max_points)
+                x, y = x.iloc[keep], y.iloc[keep]
+            return dict(x=x, y=y)
+
         fig = make_subplots(rows=2, cols=1, row_heights=[1, 0.3], vertical_spacing=0.02,
                             shared_xaxes=True, specs=[[{'secondary_y': True}],
                                                       [{'secondary_y': True}]])
-        fig.add_trace(go.Scatter(x=df['fillTransactDttm'], y=df['fillBid'], name='Bid',
+        fig.add_trace(go.Scatter(**line(df['fillBid']), name='Bid',
                                  line=dict(color='blue', width=1, dash='solid')), row=1, col=1)
-        fig.add_trace(go.Scatter(x=df['fillTransactDttm'], y=df['fillAsk'], name='Ask',
+        fig.add_trace(go.Scatter(**line(df['fillAsk']), name='Ask',
                                  line=dict(color='blue', width=1, dash='solid')), row=1, col=1)
-        fig.add_trace(go.Scatter(x=df['fillTransactDttm'], y=df['fillMark'], name='SR Mark',
+        fig.add_trace(go.Scatter(**line(df['fillMark']), name='SR Mark',
                                  line=dict(color='magenta', width=1, dash='dot')), row=1, col=1)
-        fig.add_trace(go.Scatter(x=df['fillTransactDttm'], y=df['cumQuantity'], name='Cumulative Fills',
+        fig.add_trace(go.Scatter(**line(df['cumQuantity']), name='Cumulative Fills',
                                  line=dict(color='black', width=1, dash='dot')), secondary_y=True, row=1, col=1)
-        fig.add_trace(go.Scatter(x=df['fillTransactDttm'], y=df['fillAsk'] - df['fillBid'], name='Spread',
+        fig.add_trace(go.Scatter(**line(df['fillAsk'] - df['fillBid']), name='Spread',
                                  line=dict(color='royalblue', width=1, dash='solid')), row=2, col=1)
-        fig.add_trace(go.Scatter(x=df['fillTransactDttm'], y=df['fillLimitRefUPrc'], name='Underlier',
+        fig.add_trace(go.Scatter(**line(df['fillLimitRefUPrc']), name='Underlier',
                                  line=dict(color='black', width=1, dash='dot')), secondary_y=True, row=2, col=1)
 
-        for t in df.index:
-            if df.loc[t, 'orderSide'] == 'Buy':
-                fig.add_annotation(dict(
-                    x=df.loc[t, 'fillTransactDttm'],
-                    y=df.loc[t, 'fillPrice'],
-                    ax=0,
-                    ay=(50 * df.loc[t, 'fillQuantity'] / max_fill) * scale_arrows + 25 * (1 - scale_arrows),
-                    xref='x',
-                    yref='y',
-                    showarrow=True,
-                    arrowcolor='green',
-                    arrowsize=2,
-                    arrowwidth=1,
-                    arrowhead=1
-                ))
-            else:
-                fig.add_annotation(dict(
-                    x=df.loc[t, 'fillTransactDttm'],
-                    y=df.loc[t, 'fillPrice'],
-                    ax=0,
-                    ay=-(50 * df.loc[t, 'fillQuantity'] / max_fill) * scale_arrows - 25 * (1 - scale_arrows),
-                    xref='x',
-                    yref='y',
-                    showarrow=True,
-                    arrowcolor='red',
-                    arrowsize=2,
-                    arrowwidth=1,
-                    arrowhead=1
-            ))
+        # Draw the fills as one marker trace: triangles pointing up for buys and down for sells,
+        # sized by fill quantity.  This keeps the figure small however many fills there are
+        buys = (df['orderSide'] == 'Buy').values
+        if scale_arrows:
+            sizes = 6 + 14 * df['fillQuantity'].values / max_fill
+        else:
+            sizes = np.full(df.shape[0], 12)
+        fig.add_trace(go.Scatter(x=df['fillTransactDttm'], y=df['fillPrice'], name='Fills', mode='markers',
+                                 customdata=df['fillQuantity'],
+                                 hovertemplate='%{y}<br>%{customdata:,.0f} filled',
+                                 marker=dict(symbol=np.where(buys, 'triangle-up', 'triangle-down'),
+                                             color=np.where(buys, 'green', 'red'),
+                                             size=sizes, line=dict(width=0))), row=1, col=1)
         fig.update_xaxes(range=[start, df.loc[df.index[-1], 'fillTransactDttm']])
         if pct_y:
             fig.update_yaxes(title='Vol', tickformat='.2%', secondary_y=False, row=1, col=1)
@@ -131,18 +219,20 @@ def plot_fill_graph(df, save=True):
             fig.update_yaxes(title='Underlier Price', tickformat=',.2f', showgrid=False, secondary_y=True, row=2, col=1)
         fig.update_layout(title=title, height=1000, width=1000)
         if save:
-            off.plot(fig, filename=os.path.join(os.getcwd(), 'TCA', f'{title}.html'))
-        else:
-            fig.show()
+            return save_figure(fig, fName or f'{title}.html', auto_open, plotlyjs)
+        fig.show()
+        return None
 
     if delta != 0:
-        generate_graph(df_vol, True)
+        return generate_graph(df_vol, True)
     else:
-        generate_graph(df, False)
+        return generate_graph(df, False)
+
+def plot_parent_graph(ctx, parent, **kwargs):
+    # Runs plot_fill_graph on the fills of parent from a DayContext; kwargs are passed on
+    return plot_fill_graph(ctx.parentFills[parent], **kwargs)
 
 if __name__ == '__main__':
-    df = pd.read_csv(os.path.join(os.getcwd(), 'FillData', 'Trades20210122.csv'))
-    process_time_cols(df)
-    parents = df['baseParentNumber'].unique()
-    df = df[df['baseParentNumber'] == parents[0]]
-    plot_fill_graph(df, True)
+    pio.renderers.default = 'browser'
+    ctx = DayContext(pd.to_datetime('20210122'))
+    plot_parent_graph(ctx, ctx.parents[0], save=True)
@@ -0,0 +1,254 @@
+# Vectorized Black-76 implied volatility for whole arrays of option prices
+#
+# Replaces the first-order vega approximation (vol + dPrice / (100 * vega)) where exact vols are
+# wanted.  Prices are inverted against the underlying mid as the forward, undiscounted, which suits
+# the index options traded here; early exercise of American options is ignored.  Each element
+# starts from a rational (Corrado-Miller) guess and takes Newton steps, falling back to bisection
+# whenever a step would leave the bracket known to hold the root, so every valid price converges.
+
+import time
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr
+
+min_vol = 1e-4
+max_vol = 5.0
+
+
+def black_price(F, K, T, vol, is_call):
+    # Undiscounted Black-76 price of a call (is_call True) or put
+    F, K, T, vol = (np.asarray(a, dtype=float) for a in (F, K, T, vol))
+    sd = vol * np.sqrt(T)
+    d1 = np.log(F / K) / sd + sd / 2
+    d2 = d1 - sd
+    return np.where(is_call, F * ndtr(d1) - K * ndtr(d2), K * ndtr(-d2) - F * ndtr(-d1))
+
+
+def black_vega(F, K, T, vol):
+    # Undiscounted Black-76 vega, per unit of vol
+    F, K, T, vol = (np.asarray(a, dtype=float) for a in (F, K, T, vol))
+    sd = vol * np.sqrt(T)
+    d1 = np.log(F / K) / sd + sd / 2
+    return F * np.exp(-d1 ** 2 / 2) / np.sqrt(2 * np.pi) * np.sqrt(T)
+
+
+def initial_guess(call, F, K, T):
+    # Corrado-Miller rational approximation of the vol of an undiscounted call price
+    half = call - (F - K) / 2
+    root = np.sqrt(np.maximum(half ** 2 - (F - K) ** 2 / np.pi, 0))
+    return np.sqrt(2 * np.pi) / (F + K) * (half + root) / np.sqrt(T)
+
+
+def implied_vol(price, F, K, T, is_call, tol=1e-10, max_iter=100):
+    """Returns the Black-76 implied vols of arrays of option prices
+
+    Parameters
+    ----------
+    price : array_like
+        Undiscounted option prices
+    F : array_like
+        Forward (here the underlying mid)
+    K : array_like
+        Strikes
+    T : array_like
+        Years to expiry
+    is_call : array_like
+        True for calls, False for puts
+    tol : float, optional
+        Convergence tolerance on price, relative to the forward (default=1e-10)
+    max_iter : int, optional
+        Iteration limit (default=100)
+
+    Returns
+    -------
+    numpy.ndarray
+        The vols, NaN where the price is outside the no-arbitrage bounds or an input is missing
+    """
+
+    price, F, K, T, is_call = np.broadcast_arrays(np.asarray(price, dtype=float), np.asarray(F, dtype=float),
+                                                  np.asarray(K, dtype=float), np.asarray(T, dtype=float),
+                                                  np.asarray(is_call, dtype=bool))
+    # Solve on the out-of-the-money option, whose price is the time value by put-call parity
+    otmCall = K >= F
+    timeValue = price - np.where(is_call, F - K, K - F).clip(0)
+    upper = np.where(otmCall, F, K)
+    valid = (T > 0) & (F > 0) & (K > 0) & (timeValue > 0) & (timeValue < upper)
+    vols = np.full(price.shape, np.nan)
+    if not valid.any():
+        return vols
+
+    p, F, K, T, otmCall = timeValue[valid], F[valid], K[valid], T[valid], otmCall[valid]
+    lo = np.full(p.shape, min_vol)
+    hi = np.full(p.shape, max_vol)
+    vol = initial_guess(p + (F - K).clip(0), F, K, T)
+    vol = np.where(np.isfinite(vol) & (vol > lo) & (vol < hi), vol, 0.2)
+    active = np.ones(p.shape, dtype=bool)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        for _ in range(max_iter):
+            idx = np.flatnonzero(active)
+            diff = black_price(F[idx], K[idx], T[idx], vol[idx], otmCall[idx]) - p[idx]
+            done = np.abs(diff) <= tol * F[idx]
+            # Tighten the bracket: price rises with vol
+            hi[idx] = np.where(diff > 0, vol[idx], hi[idx])
+            lo[idx] = np.where(diff < 0, vol[idx], lo[idx])
+            step = vol[idx] - diff / black_vega(F[idx], K[idx], T[idx], vol[idx])
+            inside = np.isfinite(step) & (step > lo[idx]) & (step < hi[idx])
+            vol[idx] = np.where(done, vol[idx], np.where(inside, step, (lo[idx] + hi[idx]) / 2))
+            active[idx[done]] = False
+            if not active.any():
+                break
+    vols[valid] = vol
+    return vols
+
+
+def years_to_expiry(yr, mn, dy, at, close='16:00'):
+    """Returns the years from at to expiry dates given as year / month / day arrays
+
+    Parameters
+    ----------
+    yr, mn, dy : array_like
+        The expiry date, e.g. from secKey_yr, secKey_mn, secKey_dy
+    at : pandas.Series or Timestamp
+        The valuation times.  Naive times are taken as Chicago, as in the raw SRSE tables
+    close : string, optional
+        New York time of expiry (default='16:00')
+
+    Returns
+    -------
+    numpy.ndarray
+        Calendar years (of 365 days); zero or negative for expired options
+    """
+
+    expiry = pd.to_datetime(pd.DataFrame({'year': np.atleast_1d(yr), 'month': np.atleast_1d(mn),
+                                          'day': np.atleast_1d(dy)}), errors='coerce')
+    expiry = (expiry + pd.Timedelta(close + ':00')).dt.tz_localize('America/New_York')
+    at = pd.to_datetime(pd.Series(np.atleast_1d(at)) if np.ndim(at) == 0 else pd.Series(np.asarray(at)))
+    if at.dt.tz is None:
+        at = at.dt.tz_localize('America/Chicago')
+    return ((expiry.values - at.dt.tz_convert('America/New_York').values) / pd.Timedelta(days=365)).astype(float)
+
+
+def option_terms(df, at_col='fillTransactDttm'):
+    """Returns the strike, years to expiry and call flag of each row of an executions dataframe
+
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        Rows of msgsrparentexecution, with the secKey_* columns
+    at_col : string, optional
+        The column of valuation times (default='fillTransactDttm')
+
+    Returns
+    -------
+    tuple of numpy.ndarray
+        K, T, is_call
+    """
+
+    T = years_to_expiry(df['secKey_yr'].values, df['secKey_mn'].values, df['secKey_dy'].values, df[at_col])
+    return df['secKey_xx'].values.astype(float), T, (df['secKey_cp'] == 'Call').values
+
+
+def fill_vols(df, price_col='fillPrice', forward=None):
+    """Returns the implied vol of price_col for each option fill in df
+
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        Rows of msgsrparentexecution
+    price_col : string or array_like, optional
+        The prices to invert: a column of df or an array aligned with it (default='fillPrice')
+    forward : array_like, optional
+        The underlying prices (default is the fillUBid / fillUAsk mid)
+
+    Returns
+    -------
+    numpy.ndarray
+        NaN for rows which aren't options or have no valid vol
+    """
+
+    prices = df[price_col].values if isinstance(price_col, str) else np.asarray(price_col, dtype=float)
+    if forward is None:
+        forward = ((df['fillUBid'] + df['fillUAsk']) / 2).values
+    K, T, is_call = option_terms(df)
+    vols = implied_vol(prices, forward, K, T, is_call)
+    vols[(df['secType'] != 'Option').values] = np.nan
+    return vols
+
+
+# Vol rows of the TCA tables: the price each is the implied vol of, and the underlying it is taken at
+vol_rows = {'Arrival Mid Vol': ('Arrival Mid', 'Arrival U Mid'),
+            'Arrival Mark Vol': ('Arrival Mark', 'Arrival U Mid'),
+            'Qwap Vol': ('Qwap', 'Qwap U'),
+            'Exec DTheo Vol': ('Exec DTheo Arr Mid Px', 'Arrival U Mid'),
+            'Exec DAct Vol': ('Exec DAct Arr Mid Px', 'Arrival U Mid')}
+# Slippage vol rows: (vol row) - (vol of the exec price) in the order's favour
+slip_vol_rows = {'DTheo Slip Arr Mid Vol': ('Arrival Mid Vol', 'Exec DTheo Vol'),
+                 'DTheo Slip Arr Mark Vol': ('Arrival Mark Vol', 'Exec DTheo Vol'),
+                 'DTheo Slip Qwap Vol': ('Qwap Vol', ('Exec DTheo Qwap Px', 'Qwap U')),
+                 'DAct Slip Arr Mid Vol': ('Arrival Mid Vol', 'Exec DAct Vol'),
+                 'DAct Slip Arr Mark Vol': ('Arrival Mark Vol', 'Exec DAct Vol'),
+                 'DAct Slip Qwap Vol': ('Qwap Vol', ('Exec DAct Qwap Px', 'Qwap U'))}
+
+
+def exact_TCA_vols(vals, row_index, side, K, T, is_call, dPxRanges=None):
+    """Replaces the vega-approximated vol rows of a calc_TCA_array result with exact implied vols
+
+    All the prices involved are inverted in one implied_vol call.  Rows which don't apply to the
+    order (NaN) and empty Maker / Taker columns (zero) are left as they are.
+
+    Parameters
+    ----------
+    vals : numpy.ndarray
+        From calc_TCA_array, updated in place
+    row_index : dict
+        The row positions of vals, keyed by the names in rows_dict
+    side : int
+        1 for a buy, -1 for a sell
+    K, T, is_call : float, float, bool
+        The option's strike, years to expiry and type
+    dPxRanges : numpy.ndarray, optional
+        Shape (3, 2): the low and high delta-adjusted fill price of each column, for DTheo Vol Range
+
+    Returns
+    -------
+    numpy.ndarray
+        vals
+    """
+
+    pairs = list(vol_rows.values()) + [v[1] for v in slip_vol_rows.values() if isinstance(v[1], tuple)]
+    prices = np.array([vals[row_index[px]] for px, _ in pairs])
+    forwards = np.array([vals[row_index[u]] for _, u in pairs])
+    if dPxRanges is not None:
+        prices = np.vstack([prices, dPxRanges.T])
+        forwards = np.vstack([forwards, np.broadcast_to(vals[row_index['Arrival U Mid']], (2, 3))])
+    vols = implied_vol(prices, forwards, K, T, is_call)
+    exact = dict(zip(pairs, vols))
+    for row, pair in vol_rows.items():
+        exact[row] = exact[pair]
+    for row, (ref, px) in slip_vol_rows.items():
+        exact[row] = side * (exact[ref] - exact[px])
+    if dPxRanges is not None:
+        exact['DTheo Vol Range'] = vols[-1] - vols[-2]
+
+    filled = vals[row_index['Filled Ctr']] > 0
+    for row in list(vol_rows) + list(slip_vol_rows) + ['DTheo Vol Range']:
+        if row in exact:
+            r = row_index[row]
+            use = filled & np.isfinite(vals[r])
+            vals[r, use] = exact[row][use]
+    return vals
+
+
+if __name__ == '__main__':
+    # Times exact vols for every option fill of each day and compares them with SR's fillVol
+    from FillStore import available_dates, load_fills
+    for dt in available_dates('Trades'):
+        df = load_fills(dt)
+        df = df[(df['secType'] == 'Option') & (df['fillQuantity'] > 0)]
+        if df.shape[0] == 0:
+            continue
+        t0 = time.perf_counter()
+        vols = fill_vols(df, 'fillMark', df['fillUMark'].values)
+        ms = (time.perf_counter() - t0) * 1000
+        err = np.nanmedian(np.abs(vols - df['fillVol'].values))
+        print(f'{dt:%Y%m%d} {df.shape[0]:>6} fills {ms:>7.1f}ms  median |vol - fillVol| {err:.4%}')
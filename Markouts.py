@@ -0,0 +1,172 @@
+# Post-fill markouts: how the market moved 1 and 10 minutes after each fill
+#
+# SR stamps every fill with the option (or stock) mark and the underlying mark 1 and 10 minutes
+# later.  The markout of a fill is the move of the mark from the fill price, in the order's favour,
+# less the delta times the underlying's move over the same time, so that an option fill is judged
+# as if it had been delta hedged at the fill.  Negative markouts mean the market moved against the
+# fill after it traded, i.e. adverse selection.
+#
+# Every fill of a day is marked out in one vectorized step and the sums are grouped once by child
+# order.  The child sums are rolled up to parents and Maker / Taker buckets without revisiting the
+# fills.
+
+import time
+import numpy as np
+import pandas as pd
+from DayContext import DayContext
+
+horizons = ['1M', '10M']
+
+# The child order columns carried through to the child level table
+child_cols = ['baseParentNumber', 'clOrdId', 'childMakerTaker', 'childMethod', 'childMktStance']
+
+
+def fill_markouts(df):
+    """Returns the delta-adjusted markouts of every positive quantity fill in df
+
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        Rows of msgsrparentexecution with the SRUtils.keep_cols fields, of any number of orders
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        The child_cols, fillQuantity and mult of each fill, and for each horizon h:
+        markout{h} per share or contract and markout{h}USD over the fill's quantity.  Markouts are
+        NaN where SR has no mark at the horizon (e.g. fills late in the day)
+    """
+
+    df = df[df['fillQuantity'] > 0]
+    side = np.where(df['orderSide'] == 'Buy', 1, -1)
+    mult = np.where(df['secType'] == 'Option', 100, 1)
+    qty = df['fillQuantity'].values
+    price = df['fillPrice'].values
+    delta = df['fillDe'].values
+    # The underlying at the fill: its mark, or its mid where SR has no mark
+    uMid = ((df['fillUBid'] + df['fillUAsk']) / 2).values
+    uMark = np.where(df['fillUMark'].values > 0, df['fillUMark'].values, uMid)
+
+    out = df[child_cols].copy()
+    out['fillQuantity'] = qty
+    out['mult'] = mult
+    for h in horizons:
+        # Zero marks are missing rather than prices
+        mark = df['fillMark' + h].values.astype(float)
+        mark[mark == 0] = np.nan
+        uMarkH = df['fillUMark' + h].values.astype(float)
+        hedge = np.where(delta != 0, delta * (uMarkH - uMark), 0)
+        hedge[(delta != 0) & (uMarkH == 0)] = np.nan
+        markout = side * (mark - price - hedge)
+        out['markout' + h] = markout
+        out['markout' + h + 'USD'] = markout * qty * mult
+    return out
+
+
+def sum_cols():
+    # The columns summed when rolling markouts up: quantity marked out and quantity times markout
+    cols = []
+    for h in horizons:
+        cols += ['qty' + h, 'qtyMarkout' + h, 'markout' + h + 'USD']
+    return cols
+
+
+def add_averages(sums):
+    # Adds the quantity-weighted average markout per share or contract at each horizon
+    for h in horizons:
+        sums['markout' + h] = sums['qtyMarkout' + h] / sums['qty' + h].where(sums['qty' + h] > 0)
+    return sums
+
+
+def rollup(childSums, keys):
+    """Returns child level markout sums regrouped by keys, with average markouts
+
+    Parameters
+    ----------
+    childSums : pandas.core.frame.DataFrame
+        The 'child' table of markout_tables
+    keys : list
+        Columns of childSums to group by, e.g. ['baseParentNumber', 'childMakerTaker']
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+    """
+
+    groups = childSums.groupby(keys, sort=False)
+    sums = groups[['fills', 'fillQuantity'] + sum_cols()].sum()
+    sums.insert(0, 'childOrders', groups.size())
+    return add_averages(sums)
+
+
+def markout_tables(df):
+    """Returns the markouts of df's fills per fill, child order, parent and Maker / Taker bucket
+
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        Rows of msgsrparentexecution with the SRUtils.keep_cols fields, e.g. DayContext.fills
+
+    Returns
+    -------
+    dict
+        'fill': from fill_markouts;
+        'child': one row per clOrdId with its fills, quantity, summed USD markouts and average markout
+        per share or contract at each horizon;
+        'parent': the same per baseParentNumber, with its number of child orders;
+        'makerTaker': the same per baseParentNumber and childMakerTaker
+    """
+
+    fills = fill_markouts(df)
+    sums = pd.DataFrame({'baseParentNumber': fills['baseParentNumber'], 'clOrdId': fills['clOrdId'],
+                         'fillQuantity': fills['fillQuantity']})
+    for h in horizons:
+        marked = fills['markout' + h].notna()
+        sums['qty' + h] = fills['fillQuantity'].where(marked, 0)
+        sums['qtyMarkout' + h] = (fills['markout' + h] * fills['fillQuantity']).fillna(0)
+        sums['markout' + h + 'USD'] = fills['markout' + h + 'USD'].fillna(0)
+
+    # The one pass over the fills: sums by child order, keeping its descriptive columns
+    children = sums.groupby(['baseParentNumber', 'clOrdId'], sort=False)
+    child = children.sum()
+    child.insert(0, 'fills', children.size())
+    first = fills.groupby(['baseParentNumber', 'clOrdId'], sort=False)[child_cols[2:]].first()
+    child = add_averages(first.join(child)).reset_index()
+
+    return {'fill': fills,
+            'child': child,
+            'parent': rollup(child, ['baseParentNumber']),
+            'makerTaker': rollup(child, ['baseParentNumber', 'childMakerTaker'])}
+
+
+def day_markouts(dt, ctx=None):
+    """Returns markout_tables for every fill of trade date dt
+
+    Parameters
+    ----------
+    dt : datetime.date (or anything richer)
+        The trade date
+    ctx : DayContext, optional
+        The day's data, if already loaded (default is to load it)
+
+    Returns
+    -------
+    dict
+        As markout_tables
+    """
+
+    if ctx is None:
+        ctx = DayContext(dt)
+    return markout_tables(ctx.fills)
+
+
+if __name__ == '__main__':
+    from FillStore import available_dates
+    pd.set_option('display.width', 200)
+    for dt in available_dates('Trades'):
+        t0 = time.perf_counter()
+        tables = day_markouts(dt)
+        ms = (time.perf_counter() - t0) * 1000
+        print(f'{dt:%Y%m%d} {tables["fill"].shape[0]:>6} fills {ms:>7.1f}ms')
+        print(tables['makerTaker'][['fillQuantity', 'markout1M', 'markout10M', 'markout1MUSD',
+                                    'markout10MUSD']].round(4).to_string())
@@ -0,0 +1,370 @@
+# Persistent SQLite index of where each order's rows are in the FillData history
+#
+# For every source file of every FillStore table (a store part file, or the FillData csv where a
+# date has no store partition) the index records the runs of rows belonging to each combination of
+# baseParentNumber, packageId, riskGroupId and secKey.  Finding the days an order traded is then a
+# query rather than a scan of every file, and load_order reads only the rows of those runs.
+#
+# FillStore.write_table indexes each part file as it is written, so ingestion keeps the index
+# current; refresh() picks up csv files and anything written before the index existed.
+
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+from FillStore import (tables, primary_keys, store_dir, available_dates, partition_parts, csv_path,
+                       normalize)
+
+key_cols = ['baseParentNumber', 'packageId', 'riskGroupId']
+seckey_cols = ['secKey_tk', 'secKey_yr', 'secKey_mn', 'secKey_dy', 'secKey_xx', 'secKey_cp']
+
+# Rows of an order less than this far apart are kept in one run, trading a few unwanted rows
+# read for fewer, larger reads
+max_gap = 100
+
+schema = """
+CREATE TABLE IF NOT EXISTS sources (tbl TEXT, date TEXT, file TEXT, signature TEXT,
+                                    PRIMARY KEY (tbl, date, file));
+CREATE TABLE IF NOT EXISTS locations (tbl TEXT, date TEXT, file TEXT, baseParentNumber INTEGER,
+                                      packageId INTEGER, riskGroupId INTEGER, secKey TEXT,
+                                      firstRow INTEGER, lastRow INTEGER);
+CREATE INDEX IF NOT EXISTS loc_parent ON locations (baseParentNumber);
+CREATE INDEX IF NOT EXISTS loc_package ON locations (packageId);
+CREATE INDEX IF NOT EXISTS loc_risk ON locations (riskGroupId);
+CREATE INDEX IF NOT EXISTS loc_seckey ON locations (secKey);
+CREATE INDEX IF NOT EXISTS loc_file ON locations (file);
+"""
+
+
+def sec_key(tk, yr=0, mn=0, dy=0, xx=0.0, cp=''):
+    # Returns the index's secKey: e.g. 'SPX 20210319 3860.0 Call' for an option, or the ticker alone
+    # for a stock (whose secKey has no month)
+    if mn is None or pd.isna(mn) or int(mn) == 0:
+        return str(tk)
+    return f'{tk} {int(yr):04}{int(mn):02}{int(dy):02} {float(xx)} {cp}'
+
+
+def source_files(table, dt):
+    # Returns the files load_table reads for table on dt: the store parts, or else the csv
+    parts = partition_parts(table, dt)
+    if len(parts) > 0:
+        return parts
+    path = csv_path(table, dt)
+    return [path] if os.path.exists(path) else []
+
+
+def file_signature(path):
+    return f'{os.path.getmtime(path)}:{os.path.getsize(path)}'
+
+
+def read_keys(path):
+    # Returns the key and secKey columns of every row of a source file, in file order
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        present = set(pq.read_schema(path).names)
+        cols = [c for c in key_cols + seckey_cols + ['ticker_tk'] if c in present]
+        return pd.read_parquet(path, columns=cols)
+    wanted = set(key_cols + seckey_cols + ['ticker_tk'])
+    return pd.read_csv(path, usecols=lambda c: c in wanted)
+
+
+def order_runs(keys):
+    """Returns the runs of rows of each key combination of a source file
+
+    Parameters
+    ----------
+    keys : pandas.core.frame.DataFrame
+        From read_keys
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        baseParentNumber, packageId, riskGroupId, secKey, firstRow and lastRow (inclusive, counted
+        from 0 over the file's data rows)
+    """
+
+    df = pd.DataFrame({c: keys[c] if c in keys.columns else None for c in key_cols}, index=keys.index)
+    if 'secKey_tk' in keys.columns:
+        secKeys = keys[[c for c in seckey_cols if c in keys.columns]]
+        df['secKey'] = [sec_key(*row) for row in secKeys.itertuples(index=False)]
+    elif 'ticker_tk' in keys.columns:
+        df['secKey'] = keys['ticker_tk'].astype(str)
+    else:
+        df['secKey'] = None
+    df['row'] = np.arange(df.shape[0])
+    groupCols = key_cols + ['secKey']
+    runs = []
+    for key, g in df.groupby(groupCols, sort=False, dropna=False):
+        rows = g['row'].values
+        # Start a new run wherever the gap to the previous row of the key exceeds max_gap
+        breaks = np.flatnonzero(np.diff(rows) > max_gap + 1)
+        starts = np.concatenate([[0], breaks + 1])
+        ends = np.concatenate([breaks, [rows.shape[0] - 1]])
+        for s, e in zip(starts, ends):
+            runs.append(key + (int(rows[s]), int(rows[e])))
+    return pd.DataFrame(runs, columns=groupCols + ['firstRow', 'lastRow'])
+
+
+def sql_int(v):
+    # Converts a key to an int for SQLite, or None if it is missing
+    return None if v is None or pd.isna(v) else int(v)
+
+
+class OrderIndex:
+    """SQLite index from baseParentNumber, packageId, riskGroupId and secKey to dates, files and rows
+
+    A connection is opened for each call, so one instance can be shared by threads (such as the
+    table writers of QuerySRTables.sync_concurrent).
+
+    Parameters
+    ----------
+    path : string, optional
+        The database file (default is FillData/Store/OrderIndex.sqlite)
+    """
+
+    def __init__(self, path=None):
+        self.path = path or os.path.join(store_dir(), 'OrderIndex.sqlite')
+        # Files are recorded relative to FillData, so the index survives the folder moving
+        self.root = os.path.dirname(store_dir())
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with self._connect() as con:
+            con.executescript(schema)
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=60)
+
+    def index_date(self, table, dt):
+        """Brings the index of table on dt in line with its current source files
+
+        Files which are new or changed are (re)indexed and files which have gone are dropped, so an
+        appended part file costs only its own rows.
+
+        Parameters
+        ----------
+        table : string
+            One of FillStore.tables
+        dt : datetime.date (or anything richer)
+            The partition date
+
+        Returns
+        -------
+        int
+            The number of files indexed or dropped
+        """
+
+        date = f'{dt:%Y%m%d}'
+        current = {os.path.relpath(f, self.root): file_signature(f) for f in source_files(table, dt)}
+        changed = 0
+        with self._connect() as con:
+            indexed = dict(con.execute('SELECT file, signature FROM sources WHERE tbl = ? AND date = ?',
+                                       (table, date)).fetchall())
+            for f, sig in indexed.items():
+                if current.get(f) != sig:
+                    con.execute('DELETE FROM locations WHERE file = ?', (f,))
+                    con.execute('DELETE FROM sources WHERE file = ?', (f,))
+                    changed += 1
+            for f, sig in current.items():
+                if indexed.get(f) == sig:
+                    continue
+                runs = order_runs(read_keys(os.path.join(self.root, f)))
+                con.executemany('INSERT INTO locations VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                [(table, date, f, sql_int(r.baseParentNumber), sql_int(r.packageId),
+                                  sql_int(r.riskGroupId), r.secKey, r.firstRow, r.lastRow)
+                                 for r in runs.itertuples(index=False)])
+                con.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)', (table, date, f, sig))
+                changed += 1
+        return changed
+
+    def refresh(self):
+        # Indexes every table and date FillStore can find, returning the number of files changed
+        changed = 0
+        for table in tables:
+            dates = {f'{dt:%Y%m%d}' for dt in available_dates(table)}
+            for dt in sorted(dates):
+                changed += self.index_date(table, pd.to_datetime(dt))
+            with self._connect() as con:
+                gone = [d for (d,) in con.execute('SELECT DISTINCT date FROM sources WHERE tbl = ?', (table,))
+                        if d not in dates]
+                for d in gone:
+                    con.execute('DELETE FROM locations WHERE tbl = ? AND date = ?', (table, d))
+                    con.execute('DELETE FROM sources WHERE tbl = ? AND date = ?', (table, d))
+            changed += len(gone)
+        return changed
+
+    def find(self, baseParentNumber=None, packageId=None, riskGroupId=None, secKey=None, table=None):
+        """Returns the locations of the rows matching every key given
+
+        Parameters
+        ----------
+        baseParentNumber, packageId, riskGroupId : int, optional
+        secKey : string, optional
+            As made by sec_key, or just a ticker to match all its options and stock
+        table : string, optional
+            Restrict to one of FillStore.tables (default is all)
+
+        Returns
+        -------
+        pandas.core.frame.DataFrame
+            tbl, date, file (relative to FillData), the keys, firstRow and lastRow, ordered by table,
+            date, file and row
+        """
+
+        where, params = [], []
+        for col, v in [('baseParentNumber', baseParentNumber), ('packageId', packageId),
+                       ('riskGroupId', riskGroupId), ('tbl', table)]:
+            if v is not None:
+                where.append(f'{col} = ?')
+                params.append(int(v) if col != 'tbl' else v)
+        if secKey is not None:
+            where.append('(secKey = ? OR secKey LIKE ?)')
+            params += [secKey, secKey + ' %']
+        sql = 'SELECT * FROM locations'
+        if len(where) > 0:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY tbl, date, file, firstRow'
+        with self._connect() as con:
+            cur = con.execute(sql, params)
+            cols = [d[0] for d in cur.description]
+            df = pd.DataFrame(cur.fetchall(), columns=cols)
+        # Nullable ints, as float64 would round the 19 digit ids
+        return df.astype({c: 'Int64' for c in key_cols})
+
+    def dates(self, baseParentNumber, table='Trades'):
+        # Returns the sorted dates on which baseParentNumber has rows in table
+        with self._connect() as con:
+            rows = con.execute('SELECT DISTINCT date FROM locations WHERE baseParentNumber = ? AND tbl = ? '
+                               'ORDER BY date', (int(baseParentNumber), table)).fetchall()
+        return [pd.to_datetime(d) for (d,) in rows]
+
+    def match_parents(self, digits, dt, table='Trades'):
+        # Returns the baseParentNumbers on dt ending in digits (e.g. the 5 digits of the TCA file names)
+        with self._connect() as con:
+            rows = con.execute('SELECT DISTINCT baseParentNumber FROM locations WHERE tbl = ? AND date = ? '
+                               'AND (baseParentNumber = ? OR baseParentNumber % 100000 = ?)',
+                               (table, f'{dt:%Y%m%d}', int(digits), int(digits))).fetchall()
+        return [p for (p,) in rows]
+
+
+def read_rows(path, ranges, columns=None):
+    """Returns the rows of a source file within ranges, normalized as FillStore.load_table
+
+    Parquet files are read a row group at a time, so only the groups holding the ranges are read.
+    Csv rows outside the ranges are skipped without being parsed.
+
+    Parameters
+    ----------
+    path : string
+        A store part file or FillData csv
+    ranges : list
+        Of (firstRow, lastRow), inclusive
+    columns : list, optional
+        Restrict the load to these columns; names missing from the file are ignored (default is all)
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+    """
+
+    keep = np.zeros(max(last for _, last in ranges) + 1, dtype=bool)
+    for first, last in ranges:
+        keep[first:last + 1] = True
+    if path.endswith('.parquet'):
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(path)
+        if columns is not None:
+            present = set(pf.schema_arrow.names)
+            columns = [c for c in columns if c in present]
+        groupRows = np.array([pf.metadata.row_group(i).num_rows for i in range(pf.num_row_groups)])
+        groupEnds = np.cumsum(groupRows)
+        groupStarts = groupEnds - groupRows
+        rows = np.flatnonzero(keep)
+        groups = [i for i in range(pf.num_row_groups)
+                  if ((rows >= groupStarts[i]) & (rows < groupEnds[i])).any()]
+        data = pf.read_row_groups(groups, columns=columns)
+        # Only convert the wanted rows, by their positions within the groups read
+        offsets = np.concatenate([np.arange(groupStarts[i], groupEnds[i]) for i in groups])
+        return data.take(np.flatnonzero(np.isin(offsets, rows))).to_pandas()
+
+    if columns is None:
+        usecols = None
+    else:
+        wanted = set(columns) | {c + '_us' for c in columns}
+        usecols = lambda c: c in wanted
+    # Line 0 is the header; data row i is line i + 1.  Reading stops after the last wanted row
+    skip = np.flatnonzero(~keep) + 1
+    df = pd.read_csv(path, usecols=usecols, skiprows=set(skip.tolist()), nrows=int(keep.sum()))
+    df = normalize(df)
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    return df
+
+
+def load_order(baseParentNumber, table='Trades', columns=None, dt=None, index=None):
+    """Returns the rows of one order from table, reading only the runs the index holds for it
+
+    Parameters
+    ----------
+    baseParentNumber : int
+    table : string, optional
+        One of FillStore.tables (default='Trades')
+    columns : list, optional
+        Restrict the load to these columns (default is all)
+    dt : datetime.date (or anything richer), optional
+        Only load this date (default is every date the order has rows)
+    index : OrderIndex, optional
+        The index to use (default is get_order_index())
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        In date and file order.  Rows repeated across the parts of a partition are de-duplicated
+        on the table's primary_keys as by load_table
+    """
+
+    if index is None:
+        index = get_order_index()
+    locs = index.find(baseParentNumber=baseParentNumber, table=table)
+    if dt is not None:
+        locs = locs[locs['date'] == f'{dt:%Y%m%d}']
+    readCols = None
+    if columns is not None:
+        readCols = list(columns) + [c for c in ['baseParentNumber'] + primary_keys.get(table, [])
+                                    if c not in columns]
+    dfs = []
+    for date, byDate in locs.groupby('date', sort=True):
+        parts = [read_rows(os.path.join(index.root, f), list(zip(g['firstRow'], g['lastRow'])), readCols)
+                 for f, g in byDate.groupby('file', sort=True)]
+        df = pd.concat(parts, ignore_index=True)
+        df = df[df['baseParentNumber'] == baseParentNumber]
+        keys = [k for k in primary_keys.get(table, []) if k in df.columns]
+        if len(parts) > 1 and len(keys) > 0:
+            df = df.drop_duplicates(keys, keep='last')
+        dfs.append(df)
+    if len(dfs) == 0:
+        return pd.DataFrame(columns=columns)
+    df = pd.concat(dfs, ignore_index=True)
+    return df if columns is None else df[[c for c in columns if c in df.columns]]
+
+
+_indices = {}
+
+
+def get_order_index(refresh=True):
+    # Returns a memoized OrderIndex for the working directory's store, refreshed against the files on disk
+    key = os.getcwd()
+    if key not in _indices:
+        _indices[key] = OrderIndex()
+    if refresh:
+        _indices[key].refresh()
+    return _indices[key]
+
+
+if __name__ == '__main__':
+    import sys
+    index = get_order_index()
+    if len(sys.argv) > 1:
+        print(index.find(baseParentNumber=int(sys.argv[1])).to_string())
+    else:
+        with index._connect() as con:
+            print(pd.read_sql_query('SELECT tbl, COUNT(DISTINCT date) AS dates, COUNT(DISTINCT baseParentNumber) '
+                                    'AS parents, COUNT(*) AS runs FROM locations GROUP BY tbl', con).to_string())
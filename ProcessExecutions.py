@@ -1,94 +1,110 @@
 import pandas as pd
-from SRUtils import process_time_cols, format_df, make_title, find_first_file
+import numpy as np
+from SRUtils import format_df, make_title
+from BrkrIndex import get_index
+from DayContext import DayContext
+from TCACache import TCACache
+from TCAWarehouse import DayFacts, strategy_name
 import os
 
-def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=True):
-    """Returns a dataframe of TCA metrics for an option or stock order on SpiderRock
-
-    The are three broad classes of TCA returned.  The first is raw stats on execution price vs. arrival
-    and QWAP (quote-weighted average price).  The second uses theoretical delta-adjusted values. These are
-    theoretical in the sense they assume the delta-hedge was executed at mid-market at the time of each option fill.
-    The third takes an actual delta execution price and uses this in place of the theoretical one.
+# Define the TCA datastructure as a global
+comma = '{:>10,.0f}'
+price = '{:>10.2f}'
+pct0 = '{:>10.0%}'
+pct2 = '{:>10.2%}'
+rows_dict = {
+    'Arrival Mid': (price, 'Mid at order creation'),
+    'Arrival Mark': (price, 'SR Mark at order creation'),
+    'Arrival U Mid': (price, 'Mid of underlying at order creation'),
+    'Arrival Mid Vol': (pct2, 'Implied volatility of Arrival Mid at Arrival U Mid'),
+    'Arrival Mark Vol': (pct2, 'Implied volatility of Arrival Mark at Arrival U Mid'),
+    'Qwap': (price, 'SR-calculated Qwap (or Vwap for a stock only order)'),
+    'Qwap U': (price, 'SR-calculated Qwap for underlying price'),
+    'Qwap Vol': (pct2, 'Implied volatility of Qwap at Qwap U'),
+    'Delta': (pct0, 'Option Contract Delta'),
+    'Vega': (price, 'Option Contract Vega'),
+    'Child Orders': (comma, 'Number of child orders which had fills'),
+    'Avg Child Size': (comma, 'Avg size of child orders which had fills'),
+    'Filled Ctr': (comma, 'Total number of contracts filled'),
+    'Ctr Fill Rate': (pct0, 'Filled Contracts divided by total size sent by child orders which had fills'),
+    'Avg Fill Pct Spread': (pct2, '0% means fill is on bid at fill time; 100% means offer'),
+    'Exec Px': (price, 'Average filled price'),
+    'Px Range': (price, 'High minus low fill price'),
+    'Slip Arr Mid Px': (price, 'Amount by which Exec Px was more favorable than mid at order creation'),
+    'Slip Arr Mid USD': (comma, 'Above  * contracts filled * contract multiplier'),
+    'Slip Arr Mark Px': (price, 'Amount by which Exec Px was more favorable than SR mark at order creation'),
+    'Slip Arr Mark USD': (comma, 'Above  * contracts filled * contract multiplier'),
+    'Slip Qwap Px': (price, 'Amount by which Exec Px was more favorable than Qwap'),
+    'Slip Qwap USD': (comma, 'Above  * contracts filled * contract multiplier'),
+    'Theo U Mid': (price, 'Average underlying price if hedging mid-market each fill time'),
+    'Exec DTheo Arr Mid Px': (price, 'Exec Px delta-adjusted from Theo U Mid to Arrival Mid'),
+    'DTheo Px Range': (price, 'High minus low delta-adjusted fill price'),
+    'DTheo Slip Arr Mid Px': (price, 'Amount by which Exec DTheo Arr Mid Px was more favorable than Arrival Mid'),
+    'DTheo Slip Arr Mid USD': (comma, 'Above  * contracts filled * contract multiplier'),
+    'DTheo Slip Arr Mark Px': (price, 'Amount by which Exec DTheo Arr Mid Px was more favorable than Arrival Mark'),
+    'DTheo Slip Arr Mark USD': (comma, 'Above  * contracts filled * contract multiplier'),
+    'Exec DTheo Qwap Px': (price, 'Exec Px delta-adjusted from Theo U Mid to Qwap U'),
+    'DTheo Slip Qwap Px': (price, 'Amount by which Exec DTheo Qwap Px was more favorable than Qwap'),
+    'DTheo Slip Qwap USD': (comma, 'Above  * contracts filled * contract multiplier'),
+    'Exec DTheo Vol': (pct2, 'Implied volatility of Exec DTheo Arr Mid Px at Arrival Mid'),
+    'DTheo Vol Range': (pct2, 'High minus low vol'),
+    'DTheo Slip Arr Mid Vol': (pct2, 'Implied volatility of DTheo Slip Arr Mid Px at Arrival Mid'),
+    'DTheo Slip Arr Mark Vol': (pct2, 'Implied volatility of DTheo Slip Arr Mark Px at Arrival Mid'),
+    'DTheo Slip Qwap Vol': (pct2, 'Implied volatility of DTheo Slip Qwap Px at Qwap U'),
+    'Act U Mid': (price, 'Actual average underlying price from executed hedge'),
+    'Exec DAct Arr Mid Px': (price, 'Exec Px delta-adjusted from Act U Mid to Arrival Mid'),
+    'DAct Slip Arr Mid Px': (price, 'Amount by which Exec DAct Arr Mid Px was more favorable than Arrival Mid'),
+    'DAct Slip Arr Mid USD': (comma, 'Above  * contracts filled * contract multiplier'),
+    'DAct Slip Arr Mark Px': (price, 'Amount by which Exec DAct Arr Mid Px was more favorable than Arrival Mark'),
+    'DAct Slip Arr Mark USD': (comma, 'Above  * contracts filled * contract multiplier'),
+    'Exec DAct Qwap Px': (price, 'Exec Px delta-adjusted from Act U Mid to Qwap U'),
+    'DAct Slip Qwap Px': (price, 'Amount by which Exec DAct Qwap Px was more favorable than Qwap'),
+    'DActSlip Qwap USD': (comma, 'Above  * contracts filled * contract multiplier'),
+    'Exec DAct Vol': (pct2, 'Implied volatility of Exec DAct Arr Mid Px at Arrival Mid'),
+    'DAct Slip Arr Mid Vol': (pct2, 'Implied volatility of DTheo Slip Arr Mid Px at Arrival Mid'),
+    'DAct Slip Arr Mark Vol': (pct2, 'Implied volatility of DTheo Slip Arr Mark Px at Arrival Mid'),
+    'DAct Slip Qwap Vol': (pct2, 'Implied volatility of DTheo Slip Qwap Px at Qwap U')}
+
+format_dict = {key: rows_dict[key][0] for key in rows_dict.keys()}
+
+# Part of every TCACache key: bump this whenever a change alters the TCA results
+TCA_VERSION = 1
+
+row_index = {key: i for i, key in enumerate(rows_dict.keys())}
+val_cols = ['Maker', 'Taker', 'Total']
+
+def results_to_df(vals):
+    """Converts an array from calc_TCA_array into the results dataframe of calc_TCA_metrics
 
     Parameters
     ----------
-    df : pandas.core.frame.DataFrame
-        A dataframe generated from SRSE Trade's msgsrparentexecution table, filtered to represent a single underlying
-    qwap : float, optional
-        SR's estimated QWAP for the option, from msgsrparentbrkrstate (default is None)
-    qwapU : float, optional
-        SR's estimated QWAP for the option underlying, from msgsrparentbrkrstate (default is None)
-    arrActSlipPct: float, optional
-        The % difference between the hedge's average price and its mid at the time of first fill (default is None)
-    formatted: bool, optional
-        Whether the dataframe returned should be converted to fixed-width formatted strings (default is True)
+    vals : numpy.ndarray
+        TCA metrics as returned by calc_TCA_array
 
     Returns
     -------
     pandas.core.frame.DataFrame
-        A dataframe indexed by TCA stats, separating Making and Taking trades and providing field descriptions
+        Indexed by TCA stats, with Maker, Taker, Total and Desc columns
+    """
+
+    results = pd.DataFrame(vals, index=rows_dict.keys(), columns=val_cols).astype(object)
+    results['Desc'] = [rows_dict[key][1] for key in rows_dict.keys()]
+    return results
+
+def calc_TCA_array(df, qwap=None, qwapU=None, arrActSlipPct=None, exact_vols=False):
+    """Returns the TCA metrics of calc_TCA_metrics as a float64 array
+
+    Parameters are as for calc_TCA_metrics.
+
+    Returns
+    -------
+    numpy.ndarray
+        Shape (len(rows_dict), 3), with rows ordered as rows_dict (see row_index) and columns as val_cols.
+        Metrics which don't apply to the order are NaN
     """
 
-    # Build results df so as to put variable definitions at start
-    cols = ['Maker', 'Taker', 'Total', 'Desc']
-    comma = '{:>10,.0f}'
-    price = '{:>10.2f}'
-    pct0 = '{:>10.0%}'
-    pct2 = '{:>10.2%}'
-    rows_dict = {
-        'Arrival Mid': (price, 'Mid at order creation'),
-        'Arrival Mark': (price, 'SR Mark at order creation'),
-        'Arrival U Mid': (price, 'Mid of underlying at order creation'),
-        'Arrival Mid Vol': (pct2, 'Implied volatility of Arrival Mid at Arrival U Mid'),
-        'Arrival Mark Vol': (pct2, 'Implied volatility of Arrival Mark at Arrival U Mid'),
-        'Qwap': (price, 'SR-calculated Qwap (or Vwap for a stock only order)'),
-        'Qwap U': (price, 'SR-calculated Qwap for underlying price'),
-        'Qwap Vol': (pct2, 'Implied volatility of Qwap at Qwap U'),
-        'Delta': (pct0, 'Option Contract Delta'),
-        'Vega': (price, 'Option Contract Vega'),
-        'Child Orders': (comma, 'Number of child orders which had fills'),
-        'Avg Child Size': (comma, 'Avg size of child orders which had fills'),
-        'Filled Ctr': (comma, 'Total number of contracts filled'),
-        'Ctr Fill Rate': (pct0, 'Filled Contracts divided by total size sent by child orders which had fills'),
-        'Avg Fill Pct Spread': (pct2, '0% means fill is on bid at fill time; 100% means offer'),
-        'Exec Px': (price, 'Average filled price'),
-        'Px Range': (price, 'High minus low fill price'),
-        'Slip Arr Mid Px': (price, 'Amount by which Exec Px was more favorable than mid at order creation'),
-        'Slip Arr Mid USD': (comma, 'Above  * contracts filled * contract multiplier'),
-        'Slip Arr Mark Px': (price, 'Amount by which Exec Px was more favorable than SR mark at order creation'),
-        'Slip Arr Mark USD': (comma, 'Above  * contracts filled * contract multiplier'),
-        'Slip Qwap Px': (price, 'Amount by which Exec Px was more favorable than Qwap'),
-        'Slip Qwap USD': (comma, 'Above  * contracts filled * contract multiplier'),
-        'Theo U Mid': (price, 'Average underlying price if hedging mid-market each fill time'),
-        'Exec DTheo Arr Mid Px': (price, 'Exec Px delta-adjusted from Theo U Mid to Arrival Mid'),
-        'DTheo Px Range': (price, 'High minus low delta-adjusted fill price'),
-        'DTheo Slip Arr Mid Px': (price, 'Amount by which Exec DTheo Arr Mid Px was more favorable than Arrival Mid'),
-        'DTheo Slip Arr Mid USD': (comma, 'Above  * contracts filled * contract multiplier'),
-        'DTheo Slip Arr Mark Px': (price, 'Amount by which Exec DTheo Arr Mid Px was more favorable than Arrival Mark'),
-        'DTheo Slip Arr Mark USD': (comma, 'Above  * contracts filled * contract multiplier'),
-        'Exec DTheo Qwap Px': (price, 'Exec Px delta-adjusted from Theo U Mid to Qwap U'),
-        'DTheo Slip Qwap Px': (price, 'Amount by which Exec DTheo Qwap Px was more favorable than Qwap'),
-        'DTheo Slip Qwap USD': (comma, 'Above  * contracts filled * contract multiplier'),
-        'Exec DTheo Vol': (pct2, 'Implied volatility of Exec DTheo Arr Mid Px at Arrival Mid'),
-        'DTheo Vol Range': (pct2, 'High minus low vol'),
-        'DTheo Slip Arr Mid Vol': (pct2, 'Implied volatility of DTheo Slip Arr Mid Px at Arrival Mid'),
-        'DTheo Slip Arr Mark Vol': (pct2, 'Implied volatility of DTheo Slip Arr Mark Px at Arrival Mid'),
-        'DTheo Slip Qwap Vol': (pct2, 'Implied volatility of DTheo Slip Qwap Px at Qwap U'),
-        'Act U Mid': (price, 'Actual average underlying price from executed hedge'),
-        'Exec DAct Arr Mid Px': (price, 'Exec Px delta-adjusted from Act U Mid to Arrival Mid'),
-        'DAct Slip Arr Mid Px': (price, 'Amount by which Exec DAct Arr Mid Px was more favorable than Arrival Mid'),
-        'DAct Slip Arr Mid USD': (comma, 'Above  * contracts filled * contract multiplier'),
-        'DAct Slip Arr Mark Px': (price, 'Amount by which Exec DAct Arr Mid Px was more favorable than Arrival Mark'),
-        'DAct Slip Arr Mark USD': (comma, 'Above  * contracts filled * contract multiplier'),
-        'Exec DAct Qwap Px': (price, 'Exec Px delta-adjusted from Act U Mid to Qwap U'),
-        'DAct Slip Qwap Px': (price, 'Amount by which Exec DAct Qwap Px was more favorable than Qwap'),
-        'DActSlip Qwap USD': (comma, 'Above  * contracts filled * contract multiplier'),
-        'Exec DAct Vol': (pct2, 'Implied volatility of Exec DAct Arr Mid Px at Arrival Mid'),
-        'DAct Slip Arr Mid Vol': (pct2, 'Implied volatility of DTheo Slip Arr Mid Px at Arrival Mid'),
-        'DAct Slip Arr Mark Vol': (pct2, 'Implied volatility of DTheo Slip Arr Mark Px at Arrival Mid'),
-        'DAct Slip Qwap Vol': (pct2, 'Implied volatility of DTheo Slip Qwap Px at Qwap U')}
-
-    results = pd.DataFrame(index=rows_dict.keys(), columns=cols)
+    vals = np.full((len(rows_dict), len(val_cols)), np.nan)
+    dPxRanges = np.full((len(val_cols), 2), np.nan)
 
     # Restrict calculations to positive quantity fills only
     df = df[df['fillQuantity'] > 0].copy()
@@ -97,7 +113,7 @@ def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=Tr
     # Handle Generic Metrics
     arrivalMid = (df['parentBid'].iloc[0] + df['parentAsk'].iloc[0]) / 2
     # Save to results
-    results.loc['Arrival Mid'] = arrivalMid
+    vals[row_index['Arrival Mid']] = arrivalMid
 
     if df['orderSide'].iloc[0] == 'Buy':
         side = 1
@@ -110,8 +126,8 @@ def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=Tr
 
     # Handle qwap-dependent Metrics
     if qwap is not None:
-        results.loc['Qwap'] = qwap
-        results.loc['Qwap U'] = qwapU
+        vals[row_index['Qwap']] = qwap
+        vals[row_index['Qwap U']] = qwapU
 
     # Handle delta-dependent Metrics and data
     delta = df['fillDe'].iloc[0]
@@ -127,18 +143,18 @@ def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=Tr
         firstFillDPx = df['fillDPrice'].iloc[0]
         arrivalMidVol = firstFillVol + (arrivalMid - firstFillDPx) / (100 * vega)
         arrivalMarkVol = firstFillVol + (arrivalMark - firstFillDPx) / (100 * vega)
-        results.loc['Delta'] = delta
-        results.loc['Vega'] = vega
-        results.loc['Arrival Mark'] = arrivalMark
-        results.loc['Arrival U Mid'] = arrivalUMid
-        results.loc['Arrival Mid Vol'] = arrivalMidVol
-        results.loc['Arrival Mark Vol'] = arrivalMarkVol
+        vals[row_index['Delta']] = delta
+        vals[row_index['Vega']] = vega
+        vals[row_index['Arrival Mark']] = arrivalMark
+        vals[row_index['Arrival U Mid']] = arrivalUMid
+        vals[row_index['Arrival Mid Vol']] = arrivalMidVol
+        vals[row_index['Arrival Mark Vol']] = arrivalMarkVol
 
         # Handle qwap- and delta-dependent Metrics
         if qwap is not None:
             qwapDPx = qwap - delta * (qwapU - arrivalUMid)
             qwapVol = arrivalMidVol + (qwapDPx - arrivalMid) / (100 * vega)
-            results.loc['Qwap Vol'] = qwapVol
+            vals[row_index['Qwap Vol']] = qwapVol
 
         # Handle arrActSlipPct and delta-dependent Metrics
         if arrActSlipPct is not None:
@@ -146,11 +162,11 @@ def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=Tr
             # Note that this uses Mid at the time of first option fill, rather than order arrival,
             # since my stock returns are based off the time of the first stock fill
             # (which will follow the option fill)
-            results.loc['Act U Mid'] = actUMid
+            vals[row_index['Act U Mid']] = actUMid
 
 
     # Calculate Metrics that Depend on Make/Take Classification
-    def populate_rows(sdf, col):
+    def populate_rows(sdf, c):
         # sdf - subdataframe - e.g. filtered for just Make or Take trades
 
         # Calc metrics that require none of (delta/vega, qwap, arrActSlipPct)
@@ -166,22 +182,22 @@ def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=Tr
         slipArrMidPx = side * (arrivalMid - execPx)
         slipArrMidUSD = slipArrMidPx * filledCtr * mult
         # Save to results
-        results.loc['Child Orders', col] = childOrders
-        results.loc['Avg Child Size', col] = avgChildSize
-        results.loc['Filled Ctr', col] = filledCtr
-        results.loc['Ctr Fill Rate', col] = ctrFillRate
-        results.loc['Avg Fill Pct Spread', col] = avgFillPctSpread
-        results.loc['Exec Px', col] = execPx
-        results.loc['Px Range', col] = pxRange
-        results.loc['Slip Arr Mid Px', col] = slipArrMidPx
-        results.loc['Slip Arr Mid USD', col] = slipArrMidUSD
+        vals[row_index['Child Orders'], c] = childOrders
+        vals[row_index['Avg Child Size'], c] = avgChildSize
+        vals[row_index['Filled Ctr'], c] = filledCtr
+        vals[row_index['Ctr Fill Rate'], c] = ctrFillRate
+        vals[row_index['Avg Fill Pct Spread'], c] = avgFillPctSpread
+        vals[row_index['Exec Px'], c] = execPx
+        vals[row_index['Px Range'], c] = pxRange
+        vals[row_index['Slip Arr Mid Px'], c] = slipArrMidPx
+        vals[row_index['Slip Arr Mid USD'], c] = slipArrMidUSD
 
         # Calc metrics that require only qwap
         if qwap is not None:
             slipQwapPx = side * (qwap - execPx)
             slipQwapUSD = slipQwapPx * filledCtr * mult
-            results.loc['Slip Qwap Px', col] = slipQwapPx
-            results.loc['Slip Qwap USD', col] = slipQwapUSD
+            vals[row_index['Slip Qwap Px'], c] = slipQwapPx
+            vals[row_index['Slip Qwap USD'], c] = slipQwapUSD
 
         # Calc metrics that require only delta/vega
         if delta != 0:
@@ -190,6 +206,7 @@ def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=Tr
             theoUMid = (sdf['fillUMid'] * sdf['fillQuantity']).sum() / filledCtr
             execDTheoArrMidPx = execPx - delta * (theoUMid - arrivalUMid)
             dTheoPxRange = sdf['fillDPrice'].max() - sdf['fillDPrice'].min()
+            dPxRanges[c] = [sdf['fillDPrice'].min(), sdf['fillDPrice'].max()]
             dTheoSlipArrMidPx = side * (arrivalMid - execDTheoArrMidPx)
             dTheoSlipArrMidUSD = dTheoSlipArrMidPx * filledCtr * mult
             dTheoSlipArrMarkPx = side * (arrivalMark - execDTheoArrMidPx)
@@ -199,19 +216,19 @@ def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=Tr
             dTheoSlipArrMidVol = dTheoSlipArrMidPx / (100 * vega)
             dTheoSlipArrMarkVol = dTheoSlipArrMarkPx / (100 * vega)
             # Save to results
-            results.loc['Slip Arr Mark Px', col] = slipArrMarkPx
-            results.loc['Slip Arr Mark USD', col] = slipArrMarkUSD
-            results.loc['Theo U Mid', col] = theoUMid
-            results.loc['Exec DTheo Arr Mid Px', col] = execDTheoArrMidPx
-            results.loc['DTheo Px Range', col] = dTheoPxRange
-            results.loc['DTheo Slip Arr Mid Px', col] = dTheoSlipArrMidPx
-            results.loc['DTheo Slip Arr Mid USD', col] = dTheoSlipArrMidUSD
-            results.loc['DTheo Slip Arr Mark Px', col] = dTheoSlipArrMarkPx
-            results.loc['DTheo Slip Arr Mark USD', col] = dTheoSlipArrMarkUSD
-            results.loc['Exec DTheo Vol', col] = execDTheoVol
-            results.loc['DTheo Vol Range', col] = dTheoVolRange
-            results.loc['DTheo Slip Arr Mid Vol', col] = dTheoSlipArrMidVol
-            results.loc['DTheo Slip Arr Mark Vol', col] = dTheoSlipArrMarkVol
+            vals[row_index['Slip Arr Mark Px'], c] = slipArrMarkPx
+            vals[row_index['Slip Arr Mark USD'], c] = slipArrMarkUSD
+            vals[row_index['Theo U Mid'], c] = theoUMid
+            vals[row_index['Exec DTheo Arr Mid Px'], c] = execDTheoArrMidPx
+            vals[row_index['DTheo Px Range'], c] = dTheoPxRange
+            vals[row_index['DTheo Slip Arr Mid Px'], c] = dTheoSlipArrMidPx
+            vals[row_index['DTheo Slip Arr Mid USD'], c] = dTheoSlipArrMidUSD
+            vals[row_index['DTheo Slip Arr Mark Px'], c] = dTheoSlipArrMarkPx
+            vals[row_index['DTheo Slip Arr Mark USD'], c] = dTheoSlipArrMarkUSD
+            vals[row_index['Exec DTheo Vol'], c] = execDTheoVol
+            vals[row_index['DTheo Vol Range'], c] = dTheoVolRange
+            vals[row_index['DTheo Slip Arr Mid Vol'], c] = dTheoSlipArrMidVol
+            vals[row_index['DTheo Slip Arr Mark Vol'], c] = dTheoSlipArrMarkVol
 
             # Calc metrics that require both delta/vega and qwap
             if qwap is not None:
@@ -220,10 +237,10 @@ def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=Tr
                 dTheoSlipQwapUSD = dTheoSlipQwapPx * filledCtr * mult
                 dTheoSlipQwapVol = dTheoSlipQwapPx / (100 * vega)
                 # Save to results
-                results.loc['Exec DTheo Qwap Px', col] = execDTheoQwapPx
-                results.loc['DTheo Slip Qwap Px', col] = dTheoSlipQwapPx
-                results.loc['DTheo Slip Qwap USD', col] = dTheoSlipQwapUSD
-                results.loc['DTheo Slip Qwap Vol', col] = dTheoSlipQwapVol
+                vals[row_index['Exec DTheo Qwap Px'], c] = execDTheoQwapPx
+                vals[row_index['DTheo Slip Qwap Px'], c] = dTheoSlipQwapPx
+                vals[row_index['DTheo Slip Qwap USD'], c] = dTheoSlipQwapUSD
+                vals[row_index['DTheo Slip Qwap Vol'], c] = dTheoSlipQwapVol
 
             # Calc metrics that require delta/vega and arrActSlipPct
             if arrActSlipPct is not None:
@@ -236,14 +253,14 @@ def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=Tr
                 dActSlipArrMidVol = dActSlipArrMidPx / (100 * vega)
                 dActSlipArrMarkVol = dActSlipArrMarkPx / (100 * vega)
                 # Save to results
-                results.loc['Exec DAct Arr Mid Px', col] = execDActArrMidPx
-                results.loc['DAct Slip Arr Mid Px', col] = dActSlipArrMidPx
-                results.loc['DAct Slip Arr Mid USD', col] = dActSlipArrMidUSD
-                results.loc['DAct Slip Arr Mark Px', col] = dActSlipArrMarkPx
-                results.loc['DAct Slip Arr Mark USD', col] = dActSlipArrMarkUSD
-                results.loc['Exec DAct Vol', col] = execDActVol
-                results.loc['DAct Slip Arr Mid Vol', col] = dActSlipArrMidVol
-                results.loc['DAct Slip Arr Mark Vol', col] = dActSlipArrMarkVol
+                vals[row_index['Exec DAct Arr Mid Px'], c] = execDActArrMidPx
+                vals[row_index['DAct Slip Arr Mid Px'], c] = dActSlipArrMidPx
+                vals[row_index['DAct Slip Arr Mid USD'], c] = dActSlipArrMidUSD
+                vals[row_index['DAct Slip Arr Mark Px'], c] = dActSlipArrMarkPx
+                vals[row_index['DAct Slip Arr Mark USD'], c] = dActSlipArrMarkUSD
+                vals[row_index['Exec DAct Vol'], c] = execDActVol
+                vals[row_index['DAct Slip Arr Mid Vol'], c] = dActSlipArrMidVol
+                vals[row_index['DAct Slip Arr Mark Vol'], c] = dActSlipArrMarkVol
 
                 # Calc metrics that require delta/vega, arrActSlipPct and qwap
                 if qwap is not None:
@@ -252,41 +269,77 @@ def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=Tr
                     dActSlipQwapUSD = dActSlipQwapPx * filledCtr * mult
                     dActSlipQwapVol = dActSlipQwapPx / (100 * vega)
                     # Save to results
-                    results.loc['Exec DAct Qwap Px', col] = execDActQwapPx
-                    results.loc['DAct Slip Qwap Px', col] = dActSlipQwapPx
-                    results.loc['DActSlip Qwap USD', col] = dActSlipQwapUSD
-                    results.loc['DAct Slip Qwap Vol', col] = dActSlipQwapVol
+                    vals[row_index['Exec DAct Qwap Px'], c] = execDActQwapPx
+                    vals[row_index['DAct Slip Qwap Px'], c] = dActSlipQwapPx
+                    vals[row_index['DActSlip Qwap USD'], c] = dActSlipQwapUSD
+                    vals[row_index['DAct Slip Qwap Vol'], c] = dActSlipQwapVol
 
     # Run populate_rows for makeDf / takeDf
     makeDf = df[df['childMakerTaker'] == 'Maker']
     takeDf = df[df['childMakerTaker'] == 'Taker']
 
     if makeDf['fillQuantity'].sum() > 0:
-        populate_rows(makeDf, 'Maker')
+        populate_rows(makeDf, 0)
     else:
-        results['Maker'] = 0
+        vals[:, 0] = 0
 
     if takeDf['fillQuantity'].sum() > 0:
-        populate_rows(takeDf, 'Taker')
+        populate_rows(takeDf, 1)
     else:
-        results['Taker'] = 0
+        vals[:, 1] = 0
 
     if df['fillQuantity'].sum() > 0:
-        populate_rows(df, 'Total')
+        populate_rows(df, 2)
     else:
-        results['Total'] = 0
+        vals[:, 2] = 0
+
+    if exact_vols and delta != 0:
+        # Imported here so that scipy is only loaded when exact vols are asked for
+        from ImpliedVol import option_terms, exact_TCA_vols
+        K, T, is_call = option_terms(df.iloc[:1])
+        exact_TCA_vols(vals, row_index, side, K[0], T[0], is_call[0], dPxRanges)
+
+    return vals
+
+def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=True, exact_vols=False):
+    """Returns a dataframe of TCA metrics for an option or stock order on SpiderRock
+
+    The are three broad classes of TCA returned.  The first is raw stats on execution price vs. arrival
+    and QWAP (quote-weighted average price).  The second uses theoretical delta-adjusted values. These are
+    theoretical in the sense they assume the delta-hedge was executed at mid-market at the time of each option fill.
+    The third takes an actual delta execution price and uses this in place of the theoretical one.
+
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        A dataframe generated from SRSE Trade's msgsrparentexecution table, filtered to represent a single underlying
+    qwap : float, optional
+        SR's estimated QWAP for the option, from msgsrparentbrkrstate (default is None)
+    qwapU : float, optional
+        SR's estimated QWAP for the option underlying, from msgsrparentbrkrstate (default is None)
+    arrActSlipPct: float, optional
+        The % difference between the hedge's average price and its mid at the time of first fill (default is None)
+    formatted: bool, optional
+        Whether the dataframe returned should be converted to fixed-width formatted strings (default is True)
+    exact_vols: bool, optional
+        Whether to calculate the vol rows as Black-76 implied vols (see ImpliedVol) rather than
+        from the first fill's vol and vega (default is False)
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        A dataframe indexed by TCA stats, separating Making and Taking trades and providing field descriptions
+    """
 
-    # Add descriptions
-    for key in rows_dict.keys():
-        results.loc[key, 'Desc'] = rows_dict[key][1]
+    vals = calc_TCA_array(df, qwap, qwapU, arrActSlipPct, exact_vols)
+    results = results_to_df(vals)
 
     # Add formatting and return results
     if formatted:
-        format_dict = {key: rows_dict[key][0] for key in rows_dict.keys()}
         results = format_df(results, format_dict)
     return results
 
-def process_day_TCA(dt):
+def process_day_TCA(dt, summary=None, use_cache=True, exact_vols=False, ctx=None, warehouse=True):
     """Calls calc_option_TCA_metrics for each trade ticket found for date dt
 
     The function will attempt to locate the relevant files for the day and determine the number
@@ -298,6 +351,17 @@ def process_day_TCA(dt):
     ----------
     dt : datetime.date (or anything richer than that)
             The trade date to process
+    summary : list, optional
+            If given, a dict of date, baseParentNumber and file name is appended for each file written
+    use_cache : bool, optional
+            Skip parents whose fills, broker state and hedge are unchanged since their files were
+            last written (see TCACache).  Bump TCA_VERSION when the metrics change (default is True)
+    exact_vols : bool, optional
+            Calculate the vol rows as exact implied vols (see calc_TCA_metrics) (default is False)
+    ctx : DayContext, optional
+            The day's data, if already loaded (default is to load it)
+    warehouse : bool, optional
+            Record the numeric results in the TCAWarehouse and update its rollups (default is True)
 
     Returns
     -------
@@ -305,22 +369,47 @@ def process_day_TCA(dt):
             The number of baseParentNumbers processed
     """
 
-    tradeFile = os.path.join(os.getcwd(), 'FillData', f'Trades{dt:%Y%m%d}.csv')
-    dayFills = pd.read_csv(tradeFile)
-    process_time_cols(dayFills)
+    if ctx is None:
+        ctx = DayContext(dt)
     wins = 0
-    if dayFills.shape[0] == 0:
+    if ctx.fills.shape[0] == 0:
         return wins
-
-    for pkg in dayFills['packageId'].unique():
-        parents = dayFills.loc[dayFills['packageId'] == pkg, 'baseParentNumber'].unique()
-        opt_parents = [p for p in parents if dayFills.loc[dayFills['baseParentNumber'] == p, 'secType'].iloc[0] == 'Option']
-        stock_parents = [p for p in parents if dayFills.loc[dayFills['baseParentNumber'] == p, 'secType'].iloc[0] == 'Stock']
-
+    brkrIndex = get_index()
+    cache = TCACache(dt, 'ProcessExecutions') if use_cache else None
+    facts = DayFacts(dt, 'ProcessExecutions', list(rows_dict)) if warehouse else None
+    keys = {}
+    written = {}
+
+    def save(results, fName, parent):
+        results.to_csv(os.path.join(os.getcwd(), 'TCA', fName))
+        written.setdefault(parent, []).append(fName)
+        if summary is not None:
+            summary.append({'date': dt, 'baseParentNumber': parent, 'file': fName})
+
+    def record(parent, vals, fills, hedged=False):
+        if facts is not None:
+            facts.add(parent, 0, vals, fills, strategy_name(fills, hedged))
+
+    def cached(parent, *inputs):
+        # Returns the number of files still current for parent, or 0 if it needs computing
+        if cache is None:
+            return 0
+        keys[parent] = cache.make_key(parentFills[parent], 'ProcessExecutions', TCA_VERSION, exact_vols, *inputs)
+        files = cache.lookup(parent, keys[parent])
+        if files is None or (facts is not None and not facts.has(parent)):
+            return 0
+        if summary is not None:
+            summary.extend({'date': dt, 'baseParentNumber': parent, 'file': f} for f in files)
+        return len(files)
+
+    # The day is grouped once; each parent's fills are then a dict lookup
+    groups, parentFills = ctx.groups('packageId'), ctx.parentFills
+
+    for pkg, opt_parents, stock_parents in groups:
         if len(opt_parents) > 0:
             # Look for a delta hedge execution
             if len(stock_parents) == 1: # I think it will be either 0 or 1
-                hedges = dayFills[dayFills['baseParentNumber'] == stock_parents[0]]
+                hedges = parentFills[stock_parents[0]]
                 actUMid = (hedges.loc[hedges.index[0], 'parentBid'] + hedges.loc[hedges.index[0], 'parentAsk']) / 2
                 fillU = (hedges['fillPrice'] * hedges['fillQuantity']).sum() / hedges['fillQuantity'].sum()
                 arrActSlipPct = (fillU - actUMid) / actUMid
@@ -328,20 +417,22 @@ def process_day_TCA(dt):
                 arrActSlipPct = None
             for opt in opt_parents:
                 # Look for qwap data matching opt
-                brkr = find_first_file(dt)
-                if brkr is not None:
-                    brkr = brkr[brkr['baseParentNumber'] == opt]
-                    if brkr.shape[0] > 0:
-                        qwap = brkr.loc[brkr.index[0], 'brokerQwapMark']
-                        qwapU = brkr.loc[brkr.index[0], 'brokerQwapUMark']
-                    else:
-                        qwap = qwapU = None
+                marks = brkrIndex.lookup(opt, dt)
+                hits = cached(opt, marks, arrActSlipPct)
+                if hits > 0:
+                    wins += hits
+                    continue
+                if marks is not None:
+                    qwap = marks['brokerQwapMark']
+                    qwapU = marks['brokerQwapUMark']
                 else:
                     qwap = qwapU = None
-                fills = dayFills[dayFills['baseParentNumber'] == opt]
-                results = calc_TCA_metrics(fills, qwap, qwapU, arrActSlipPct)
-                fName = make_title(fills) + '.csv'
-                results.to_csv(os.path.join(os.getcwd(), 'TCA', fName))
+                fills = parentFills[opt]
+                vals = calc_TCA_array(fills, qwap, qwapU, arrActSlipPct, exact_vols)
+                results = format_df(results_to_df(vals), format_dict)
+                fName = make_title(fills) + f'{dt:%Y%m%d}.csv'
+                save(results, fName, opt)
+                record(opt, vals, fills, arrActSlipPct is not None)
                 wins += 1
 
         if len(opt_parents) == 0 and len(stock_parents) > 0:
@@ -349,17 +440,29 @@ def process_day_TCA(dt):
                 # Look for Vwap data matching stock
                 # For a pure stock order, Vwap is probably a better metric than Qwap
                 qwap = qwapU = None
-                brkr = find_first_file(dt)
-                if brkr is not None:
-                    brkr = brkr[brkr['baseParentNumber'] == stock]
-                    if brkr.shape[0] > 0:
-                        qwap = brkr.loc[brkr.index[0], 'brokerVwapMark']
-                fills = dayFills[dayFills['baseParentNumber'] == stock]
-                results = calc_TCA_metrics(fills, qwap)
-                fName = make_title(fills) + '.csv'
-                results.to_csv(os.path.join(os.getcwd(), 'TCA', fName))
+                marks = brkrIndex.lookup(stock, dt)
+                hits = cached(stock, marks)
+                if hits > 0:
+                    wins += hits
+                    continue
+                if marks is not None:
+                    qwap = marks['brokerVwapMark']
+                fills = parentFills[stock]
+                vals = calc_TCA_array(fills, qwap)
+                results = format_df(results_to_df(vals), format_dict)
+                fName = make_title(fills) + f'{dt:%Y%m%d}.csv'
+                save(results, fName, stock)
+                record(stock, vals, fills)
                 wins += 1
 
+    if cache is not None:
+        for parent, key in keys.items():
+            if parent not in cache.seen:
+                cache.store(parent, key, written.get(parent, []))
+        cache.save()
+    if facts is not None:
+        facts.save(ctx.parents)
+
     return wins
 
 
@@ -2,7 +2,12 @@
 # This code *should* also work for single-leg orders but I haven't tested that yet
 
 import pandas as pd
-from SRUtils import process_time_cols, format_df, make_title, find_first_file
+import numpy as np
+from SRUtils import format_df, make_title
+from BrkrIndex import get_index
+from DayContext import DayContext
+from TCACache import TCACache
+from TCAWarehouse import DayFacts, strategy_name
 import os
 
 # Define the TCA datastructure as a global
@@ -67,146 +72,296 @@ rows_dict = {
 
 format_dict = {key: rows_dict[key][0] for key in rows_dict.keys()}
 
-def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=True):
-    """Returns a dataframe of TCA metrics for an option or stock order on SpiderRock
+# Part of every TCACache key: bump this whenever a change alters the TCA results
+TCA_VERSION = 1
 
-    The are three broad classes of TCA returned.  The first is raw stats on execution price vs. arrival
-    and QWAP (quote-weighted average price).  The second uses theoretical delta-adjusted values. These are
-    theoretical in the sense they assume the delta-hedge was executed at mid-market at the time of each option fill.
-    The third takes an actual delta execution price and uses this in place of the theoretical one.
+row_index = {key: i for i, key in enumerate(rows_dict.keys())}
+val_cols = ['Maker', 'Taker', 'Total']
+
+def results_to_df(vals, title=''):
+    """Converts an array from calc_TCA_array into the results dataframe of calc_TCA_metrics
 
     Parameters
     ----------
-    df : pandas.core.frame.DataFrame
-        A dataframe generated from SRSE Trade's msgsrparentexecution table, filtered to represent a single underlying
-    qwap : float, optional
-        SR's estimated QWAP for the option, from msgsrparentbrkrstate (default is None)
-    qwapU : float, optional
-        SR's estimated QWAP for the option underlying, from msgsrparentbrkrstate (default is None)
-    arrActSlipPct: float, optional
-        The % difference between the hedge's average price and its mid at the time of first fill (default is None)
-    formatted: bool, optional
-        Whether the dataframe returned should be converted to fixed-width formatted strings (default is True)
+    vals : numpy.ndarray
+        TCA metrics as returned by calc_TCA_array
+    title: string, optional
+        The order description placed in the Desc column of the Order row (default is '')
 
     Returns
     -------
     pandas.core.frame.DataFrame
-        A dataframe indexed by TCA stats, separating Making and Taking trades and providing field descriptions
+        Indexed by TCA stats, with Maker, Taker, Total and Desc columns
     """
 
-    # Build results df so as to put variable definitions at start
-    cols = ['Maker', 'Taker', 'Total', 'Desc']
-    results = pd.DataFrame(index=rows_dict.keys(), columns=cols)
-
-    # Restrict calculations to positive quantity fills only
-    df = df[df['fillQuantity'] > 0].copy()
+    results = pd.DataFrame(vals, index=rows_dict.keys(), columns=val_cols).astype(object)
+    results['Desc'] = [rows_dict[key][1] for key in rows_dict.keys()]
     results.loc['Order'] = ''
+    results.loc['Order', 'Desc'] = title
+    return results
+
+# Each option in a multi-leg package is identified by its secKey
+leg_cols = ['secKey_tk',
+        'secKey_yr', 'secKey_mn', 'secKey_dy',
+        'secKey_xx',
+        'secKey_cp']
+
+# Rules to combine results across the legs of a multi-leg order
+# Default behaviour will be to combine results in a side/qty weighted sum
+# However, this row will be ignored
+ig_rows = ['Order']
+# and these rows will be qty weighted only
+sum_rows = ['Slip Arr Mid Px',
+            'Slip Arr Mid USD',
+            'Slip Arr Mark Px',
+            'Slip Arr Mark USD',
+            'DTheo Slip Arr Mid Px',
+            'DTheo Slip Arr Mid USD',
+            'DTheo Slip Arr Mark Px',
+            'DTheo Slip Arr Mid Vol',
+            'DTheo Slip Arr Mark Vol',
+            'DTheo Slip Arr Mark USD',
+            'DAct Slip Arr Mid Px',
+            'DAct Slip Arr Mid USD',
+            'DAct Slip Arr Mark Px',
+            'DAct Slip Arr Mark USD',
+            'DAct Slip Arr Mid Vol',
+            'DAct Slip Arr Mark Vol',
+            ]
+# and these rows will simply return max()
+max_rows = ['Arrival U Mid',
+            'Child Orders',
+            'Avg Child Size',
+            'Filled Ctr',
+            'Ctr Fill Rate',
+            'Px Range',
+            'Theo U Mid',
+            'DTheo Px Range',
+            'DTheo Vol Range',
+            'Act U Mid']
+
+is_ig_row = np.array([key in ig_rows for key in rows_dict.keys()])
+is_sum_row = np.array([key in sum_rows for key in rows_dict.keys()])
+is_max_row = np.array([key in max_rows for key in rows_dict.keys()])
+
+def consolidate_legs(legVals, sides):
+    """Combines the TCA arrays of each leg of a multi-leg order into a single array
+
+    Rows in sum_rows are summed weighted by each leg's filled quantity, rows in max_rows take
+    the largest leg value (floored at zero, ignoring NaN) and all other rows except ig_rows are
+    summed weighted by side * quantity.  Everything but the max_rows is then divided by the
+    smallest positive leg quantity, i.e. expressed per unit of the package.
+
+    Parameters
+    ----------
+    legVals : numpy.ndarray
+        Shape (legs, len(rows_dict), 3): the output of calc_TCA_array for each leg, stacked
+    sides : numpy.ndarray
+        Shape (legs,): 1 for legs bought, -1 for legs sold
+
+    Returns
+    -------
+    numpy.ndarray
+        Shape (len(rows_dict), 3), laid out as calc_TCA_array
+    """
+
+    qtys = legVals[:, row_index['Filled Ctr'], 2]
+    weights = np.where(is_sum_row, qtys[:, None], (sides * qtys)[:, None])
+    sumVals = (legVals * weights[:, :, None]).sum(axis=0)
+    maxVals = np.fmax(np.fmax.reduce(legVals, axis=0), 0)
+    sumVals[is_max_row] = maxVals[is_max_row]
+    sumVals[is_ig_row] = 0
+    posQtys = qtys[qtys > 0]
+    min_qty = posQtys.min() if posQtys.shape[0] > 0 else float('inf')
+    sumVals[~is_max_row] /= min_qty
+    return sumVals
+
+def arrival_stats(first):
+    """Returns the order-level values calc_TCA_array takes from an order's first positive fill
+
+    Parameters
+    ----------
+    first : pandas.core.series.Series or dict
+        The first fill with positive fillQuantity
+
+    Returns
+    -------
+    dict
+        arrivalMid, side, mult, delta and vega, plus arrivalMark, arrivalUMid, firstFillUMid,
+        arrivalMidVol and arrivalMarkVol when delta is non-zero
+    """
 
-    # Populate Arrival Stats and Contract Details (incl side and mult)
     # Handle Generic Metrics
-    if df['parentBid'].iloc[0] > 0:
-        arrivalMid = (df['parentBid'].iloc[0] + df['parentAsk'].iloc[0]) / 2
+    if first['parentBid'] > 0:
+        arrivalMid = (first['parentBid'] + first['parentAsk']) / 2
     else:
-        arrivalMid = (df['fillBid'].iloc[0] + df['fillAsk'].iloc[0]) / 2
-    # Save to results
-    results.loc['Arrival Mid'] = arrivalMid
+        arrivalMid = (first['fillBid'] + first['fillAsk']) / 2
+    arrival = {'arrivalMid': arrivalMid,
+               'side': 1 if first['orderSide'] == 'Buy' else -1,
+               'mult': 100 if first['secType'] == 'Option' else 1,
+               'delta': first['fillDe'],
+               'vega': first['fillVe']}
+
+    # Handle delta-dependent data
+    delta = arrival['delta']
+    vega = arrival['vega']
+    if delta != 0:
+        if first['parentMark'] > 0:
+            arrivalMark = first['parentMark']
+            arrivalUMid = (first['parentUBid'] + first['parentUAsk']) / 2
+        else:
+            arrivalMark = first['fillMark']
+            arrivalUMid = (first['fillUBid'] + first['fillUAsk']) / 2
+        firstFillUMid = (first['fillUBid'] + first['fillUAsk']) / 2
+        # Calculate arrival vols
+        firstFillVol = first['fillVol']
+        firstFillDPx = first['fillPrice'] - delta * (firstFillUMid - arrivalUMid)
+        arrival.update({'arrivalMark': arrivalMark,
+                        'arrivalUMid': arrivalUMid,
+                        'firstFillUMid': firstFillUMid,
+                        'arrivalMidVol': firstFillVol + (arrivalMid - firstFillDPx) / (100 * vega),
+                        'arrivalMarkVol': firstFillVol + (arrivalMark - firstFillDPx) / (100 * vega)})
+    return arrival
+
+def bucket_stats(sdf, arrival):
+    """Returns the sums and extremes calc_TCA_array needs from one Maker / Taker / Total bucket
 
-    if df['orderSide'].iloc[0] == 'Buy':
-        side = 1
-    else:
-        side = -1
-    if df['secType'].iloc[0] == 'Option':
-        mult = 100
-    else:
-        mult = 1
+    Parameters
+    ----------
+    sdf : pandas.core.frame.DataFrame
+        The bucket's positive quantity fills
+    arrival : dict
+        From arrival_stats
+
+    Returns
+    -------
+    dict
+        childOrders, childSizeSum, filledCtr, pctSpreadQty, pxQty, pxMax and pxMin, plus uMidQty,
+        dPxMax and dPxMin when the order has a delta
+    """
+
+    childOrders = sdf['clOrdId'].unique().shape[0]
+    stats = {'childOrders': childOrders,
+             'childSizeSum': sdf.groupby('clOrdId').first()['childSize'].sum(),
+             'filledCtr': sdf['fillQuantity'].sum(),
+             'pctSpreadQty': ((sdf['fillPrice'] - sdf['fillBid'])
+                              / (sdf['fillAsk'] - sdf['fillBid'])
+                              * sdf['fillQuantity']).sum(),
+             'pxQty': (sdf['fillPrice'] * sdf['fillQuantity']).sum(),
+             'pxMax': sdf['fillPrice'].max(),
+             'pxMin': sdf['fillPrice'].min()}
+    if arrival['delta'] != 0:
+        # Delta-adjust each fill price to the arrival underlying mid
+        fillUMid = (sdf['fillUBid'] + sdf['fillUAsk']) / 2
+        fillDPrice = sdf['fillPrice'] - arrival['delta'] * (fillUMid - arrival['arrivalUMid'])
+        stats.update({'uMidQty': (fillUMid * sdf['fillQuantity']).sum(),
+                      'dPxMax': fillDPrice.max(),
+                      'dPxMin': fillDPrice.min()})
+    return stats
+
+def stats_to_array(arrival, buckets, qwap=None, qwapU=None, arrActSlipPct=None):
+    """Returns the TCA array of calc_TCA_array from an order's arrival and bucket statistics
+
+    This is shared by calc_TCA_array and StreamingTCA, which keeps the same statistics running
+    fill by fill.
+
+    Parameters
+    ----------
+    arrival : dict
+        From arrival_stats
+    buckets : list
+        The bucket_stats of the Maker, Taker and Total fills, or None for a bucket with no quantity
+    qwap, qwapU, arrActSlipPct : float, optional
+        As for calc_TCA_metrics
+
+    Returns
+    -------
+    numpy.ndarray
+        Shape (len(rows_dict), 3), as calc_TCA_array
+    """
+
+    vals = np.full((len(rows_dict), len(val_cols)), np.nan)
+
+    # Populate Arrival Stats and Contract Details (incl side and mult)
+    arrivalMid = arrival['arrivalMid']
+    side = arrival['side']
+    mult = arrival['mult']
+    vals[row_index['Arrival Mid']] = arrivalMid
 
     # Handle qwap-dependent Metrics
     if qwap is not None:
-        results.loc['Qwap'] = qwap
-        results.loc['Qwap U'] = qwapU
+        vals[row_index['Qwap']] = qwap
+        vals[row_index['Qwap U']] = qwapU
 
     # Handle delta-dependent Metrics and data
-    delta = df['fillDe'].iloc[0]
-    vega = df['fillVe'].iloc[0]
+    delta = arrival['delta']
+    vega = arrival['vega']
     if delta != 0:
-        if df['parentMark'].iloc[0] > 0:
-            arrivalMark = df['parentMark'].iloc[0]
-            arrivalUMid = (df['parentUBid'].iloc[0] + df['parentUAsk'].iloc[0]) / 2
-        else:
-            arrivalMark = df['fillMark'].iloc[0]
-            arrivalUMid = (df['fillUBid'].iloc[0] + df['fillUAsk'].iloc[0]) / 2
-        # Add delta-adjusted price column
-        df['fillUMid'] = (df['fillUBid'] + df['fillUAsk']) / 2
-        df['fillDPrice'] = df['fillPrice'] - delta * (df['fillUMid'] - arrivalUMid)
-        # Calculate arrival vols
-        firstFillVol = df['fillVol'].iloc[0]
-        firstFillDPx = df['fillDPrice'].iloc[0]
-        arrivalMidVol = firstFillVol + (arrivalMid - firstFillDPx) / (100 * vega)
-        arrivalMarkVol = firstFillVol + (arrivalMark - firstFillDPx) / (100 * vega)
-        results.loc['Delta'] = delta
-        results.loc['Vega'] = vega
-        results.loc['Arrival Mark'] = arrivalMark
-        results.loc['Arrival U Mid'] = arrivalUMid
-        results.loc['Arrival Mid Vol'] = arrivalMidVol
-        results.loc['Arrival Mark Vol'] = arrivalMarkVol
+        arrivalMark = arrival['arrivalMark']
+        arrivalUMid = arrival['arrivalUMid']
+        arrivalMidVol = arrival['arrivalMidVol']
+        vals[row_index['Delta']] = delta
+        vals[row_index['Vega']] = vega
+        vals[row_index['Arrival Mark']] = arrivalMark
+        vals[row_index['Arrival U Mid']] = arrivalUMid
+        vals[row_index['Arrival Mid Vol']] = arrivalMidVol
+        vals[row_index['Arrival Mark Vol']] = arrival['arrivalMarkVol']
 
         # Handle qwap- and delta-dependent Metrics
         if qwap is not None:
             qwapDPx = qwap - delta * (qwapU - arrivalUMid)
             qwapVol = arrivalMidVol + (qwapDPx - arrivalMid) / (100 * vega)
-            results.loc['Qwap Vol'] = qwapVol
+            vals[row_index['Qwap Vol']] = qwapVol
 
         # Handle arrActSlipPct and delta-dependent Metrics
         if arrActSlipPct is not None:
-            actUMid = (df['fillUMid'].iloc[0]) * (1 + arrActSlipPct)
+            actUMid = arrival['firstFillUMid'] * (1 + arrActSlipPct)
             # Note that this uses Mid at the time of first option fill, rather than order arrival,
             # since my stock returns are based off the time of the first stock fill
             # (which will follow the option fill)
-            results.loc['Act U Mid'] = actUMid
+            vals[row_index['Act U Mid']] = actUMid
 
 
     # Calculate Metrics that Depend on Make/Take Classification
-    def populate_rows(sdf, col):
-        # sdf - subdataframe - e.g. filtered for just Make or Take trades
-        # col - the column to populate (Maker / Taker / Total)
+    def populate_rows(stats, c):
+        # stats - bucket_stats of e.g. just Make or Take trades
+        # c - the column to populate (0, 1, 2 for Maker / Taker / Total)
 
         # Calc metrics that require none of (delta/vega, qwap, arrActSlipPct)
-        childOrders = sdf['clOrdId'].unique().shape[0]
-        avgChildSize = sdf.groupby('clOrdId').first()['childSize'].sum() / childOrders
-        filledCtr = sdf['fillQuantity'].sum()
+        childOrders = stats['childOrders']
+        avgChildSize = stats['childSizeSum'] / childOrders
+        filledCtr = stats['filledCtr']
         ctrFillRate = filledCtr / (childOrders * avgChildSize)
-        avgFillPctSpread = ((sdf['fillPrice'] - sdf['fillBid'])
-                             / (sdf['fillAsk'] - sdf['fillBid'])
-                             * sdf['fillQuantity']).sum() / filledCtr
-        execPx = (sdf['fillPrice'] * sdf['fillQuantity']).sum() / filledCtr
-        pxRange = sdf['fillPrice'].max() - sdf['fillPrice'].min()
+        avgFillPctSpread = stats['pctSpreadQty'] / filledCtr
+        execPx = stats['pxQty'] / filledCtr
+        pxRange = stats['pxMax'] - stats['pxMin']
         slipArrMidPx = side * (arrivalMid - execPx)
         slipArrMidUSD = slipArrMidPx * filledCtr * mult
         # Save to results
-        results.loc['Child Orders', col] = childOrders
-        results.loc['Avg Child Size', col] = avgChildSize
-        results.loc['Filled Ctr', col] = filledCtr
-        results.loc['Ctr Fill Rate', col] = ctrFillRate
-        results.loc['Avg Fill Pct Spread', col] = avgFillPctSpread
-        results.loc['Exec Px', col] = execPx
-        results.loc['Px Range', col] = pxRange
-        results.loc['Slip Arr Mid Px', col] = slipArrMidPx
-        results.loc['Slip Arr Mid USD', col] = slipArrMidUSD
+        vals[row_index['Child Orders'], c] = childOrders
+        vals[row_index['Avg Child Size'], c] = avgChildSize
+        vals[row_index['Filled Ctr'], c] = filledCtr
+        vals[row_index['Ctr Fill Rate'], c] = ctrFillRate
+        vals[row_index['Avg Fill Pct Spread'], c] = avgFillPctSpread
+        vals[row_index['Exec Px'], c] = execPx
+        vals[row_index['Px Range'], c] = pxRange
+        vals[row_index['Slip Arr Mid Px'], c] = slipArrMidPx
+        vals[row_index['Slip Arr Mid USD'], c] = slipArrMidUSD
 
         # Calc metrics that require only qwap
         if qwap is not None:
             slipQwapPx = side * (qwap - execPx)
             slipQwapUSD = slipQwapPx * filledCtr * mult
-            results.loc['Slip Qwap Px', col] = slipQwapPx
-            results.loc['Slip Qwap USD', col] = slipQwapUSD
+            vals[row_index['Slip Qwap Px'], c] = slipQwapPx
+            vals[row_index['Slip Qwap USD'], c] = slipQwapUSD
 
         # Calc metrics that require only delta/vega
         if delta != 0:
             slipArrMarkPx = side * (arrivalMark - execPx) # Doesn't use delta but mark is zero for non options
             slipArrMarkUSD = slipArrMarkPx * filledCtr * mult
-            theoUMid = (sdf['fillUMid'] * sdf['fillQuantity']).sum() / filledCtr
+            theoUMid = stats['uMidQty'] / filledCtr
             execDTheoArrMidPx = execPx - delta * (theoUMid - arrivalUMid)
-            dTheoPxRange = sdf['fillDPrice'].max() - sdf['fillDPrice'].min()
+            dTheoPxRange = stats['dPxMax'] - stats['dPxMin']
             dTheoSlipArrMidPx = side * (arrivalMid - execDTheoArrMidPx)
             dTheoSlipArrMidUSD = dTheoSlipArrMidPx * filledCtr * mult
             dTheoSlipArrMarkPx = side * (arrivalMark - execDTheoArrMidPx)
@@ -216,19 +371,19 @@ def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=Tr
             dTheoSlipArrMidVol = dTheoSlipArrMidPx / (100 * vega)
             dTheoSlipArrMarkVol = dTheoSlipArrMarkPx / (100 * vega)
             # Save to results
-            results.loc['Slip Arr Mark Px', col] = slipArrMarkPx
-            results.loc['Slip Arr Mark USD', col] = slipArrMarkUSD
-            results.loc['Theo U Mid', col] = theoUMid
-            results.loc['Exec DTheo Arr Mid Px', col] = execDTheoArrMidPx
-            results.loc['DTheo Px Range', col] = dTheoPxRange
-            results.loc['DTheo Slip Arr Mid Px', col] = dTheoSlipArrMidPx
-            results.loc['DTheo Slip Arr Mid USD', col] = dTheoSlipArrMidUSD
-            results.loc['DTheo Slip Arr Mark Px', col] = dTheoSlipArrMarkPx
-            results.loc['DTheo Slip Arr Mark USD', col] = dTheoSlipArrMarkUSD
-            results.loc['Exec DTheo Vol', col] = execDTheoVol
-            results.loc['DTheo Vol Range', col] = dTheoVolRange
-            results.loc['DTheo Slip Arr Mid Vol', col] = dTheoSlipArrMidVol
-            results.loc['DTheo Slip Arr Mark Vol', col] = dTheoSlipArrMarkVol
+            vals[row_index['Slip Arr Mark Px'], c] = slipArrMarkPx
+            vals[row_index['Slip Arr Mark USD'], c] = slipArrMarkUSD
+            vals[row_index['Theo U Mid'], c] = theoUMid
+            vals[row_index['Exec DTheo Arr Mid Px'], c] = execDTheoArrMidPx
+            vals[row_index['DTheo Px Range'], c] = dTheoPxRange
+            vals[row_index['DTheo Slip Arr Mid Px'], c] = dTheoSlipArrMidPx
+            vals[row_index['DTheo Slip Arr Mid USD'], c] = dTheoSlipArrMidUSD
+            vals[row_index['DTheo Slip Arr Mark Px'], c] = dTheoSlipArrMarkPx
+            vals[row_index['DTheo Slip Arr Mark USD'], c] = dTheoSlipArrMarkUSD
+            vals[row_index['Exec DTheo Vol'], c] = execDTheoVol
+            vals[row_index['DTheo Vol Range'], c] = dTheoVolRange
+            vals[row_index['DTheo Slip Arr Mid Vol'], c] = dTheoSlipArrMidVol
+            vals[row_index['DTheo Slip Arr Mark Vol'], c] = dTheoSlipArrMarkVol
 
             # Calc metrics that require both delta/vega and qwap
             if qwap is not None:
@@ -237,10 +392,10 @@ def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=Tr
                 dTheoSlipQwapUSD = dTheoSlipQwapPx * filledCtr * mult
                 dTheoSlipQwapVol = dTheoSlipQwapPx / (100 * vega)
                 # Save to results
-                results.loc['Exec DTheo Qwap Px', col] = execDTheoQwapPx
-                results.loc['DTheo Slip Qwap Px', col] = dTheoSlipQwapPx
-                results.loc['DTheo Slip Qwap USD', col] = dTheoSlipQwapUSD
-                results.loc['DTheo Slip Qwap Vol', col] = dTheoSlipQwapVol
+                vals[row_index['Exec DTheo Qwap Px'], c] = execDTheoQwapPx
+                vals[row_index['DTheo Slip Qwap Px'], c] = dTheoSlipQwapPx
+                vals[row_index['DTheo Slip Qwap USD'], c] = dTheoSlipQwapUSD
+                vals[row_index['DTheo Slip Qwap Vol'], c] = dTheoSlipQwapVol
 
             # Calc metrics that require delta/vega and arrActSlipPct
             if arrActSlipPct is not None:
@@ -253,14 +408,14 @@ def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=Tr
                 dActSlipArrMidVol = dActSlipArrMidPx / (100 * vega)
                 dActSlipArrMarkVol = dActSlipArrMarkPx / (100 * vega)
                 # Save to results
-                results.loc['Exec DAct Arr Mid Px', col] = execDActArrMidPx
-                results.loc['DAct Slip Arr Mid Px', col] = dActSlipArrMidPx
-                results.loc['DAct Slip Arr Mid USD', col] = dActSlipArrMidUSD
-                results.loc['DAct Slip Arr Mark Px', col] = dActSlipArrMarkPx
-                results.loc['DAct Slip Arr Mark USD', col] = dActSlipArrMarkUSD
-                results.loc['Exec DAct Vol', col] = execDActVol
-                results.loc['DAct Slip Arr Mid Vol', col] = dActSlipArrMidVol
-                results.loc['DAct Slip Arr Mark Vol', col] = dActSlipArrMarkVol
+                vals[row_index['Exec DAct Arr Mid Px'], c] = execDActArrMidPx
+                vals[row_index['DAct Slip Arr Mid Px'], c] = dActSlipArrMidPx
+                vals[row_index['DAct Slip Arr Mid USD'], c] = dActSlipArrMidUSD
+                vals[row_index['DAct Slip Arr Mark Px'], c] = dActSlipArrMarkPx
+                vals[row_index['DAct Slip Arr Mark USD'], c] = dActSlipArrMarkUSD
+                vals[row_index['Exec DAct Vol'], c] = execDActVol
+                vals[row_index['DAct Slip Arr Mid Vol'], c] = dActSlipArrMidVol
+                vals[row_index['DAct Slip Arr Mark Vol'], c] = dActSlipArrMarkVol
 
                 # Calc metrics that require delta/vega, arrActSlipPct and qwap
                 if qwap is not None:
@@ -269,41 +424,90 @@ def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=Tr
                     dActSlipQwapUSD = dActSlipQwapPx * filledCtr * mult
                     dActSlipQwapVol = dActSlipQwapPx / (100 * vega)
                     # Save to results
-                    results.loc['Exec DAct Qwap Px', col] = execDActQwapPx
-                    results.loc['DAct Slip Qwap Px', col] = dActSlipQwapPx
-                    results.loc['DActSlip Qwap USD', col] = dActSlipQwapUSD
-                    results.loc['DAct Slip Qwap Vol', col] = dActSlipQwapVol
+                    vals[row_index['Exec DAct Qwap Px'], c] = execDActQwapPx
+                    vals[row_index['DAct Slip Qwap Px'], c] = dActSlipQwapPx
+                    vals[row_index['DActSlip Qwap USD'], c] = dActSlipQwapUSD
+                    vals[row_index['DAct Slip Qwap Vol'], c] = dActSlipQwapVol
+
+    for c, stats in enumerate(buckets):
+        if stats is None:
+            vals[:, c] = 0
+        else:
+            populate_rows(stats, c)
 
-    # Run populate_rows for makeDf / takeDf
+    return vals
+
+def calc_TCA_array(df, qwap=None, qwapU=None, arrActSlipPct=None, exact_vols=False):
+    """Returns the TCA metrics of calc_TCA_metrics as a float64 array
+
+    Parameters are as for calc_TCA_metrics.
+
+    Returns
+    -------
+    numpy.ndarray
+        Shape (len(rows_dict), 3), with rows ordered as rows_dict (see row_index) and columns as val_cols.
+        Metrics which don't apply to the order are NaN
+    """
+
+    # Restrict calculations to positive quantity fills only
+    df = df[df['fillQuantity'] > 0]
+    arrival = arrival_stats(df.iloc[0])
+
+    # Collect stats for makeDf / takeDf / all fills
     makeDf = df[df['childMakerTaker'] == 'Maker']
     takeDf = df[df['childMakerTaker'] == 'Taker']
+    buckets = [bucket_stats(sdf, arrival) if sdf['fillQuantity'].sum() > 0 else None
+               for sdf in [makeDf, takeDf, df]]
+    vals = stats_to_array(arrival, buckets, qwap, qwapU, arrActSlipPct)
+
+    if exact_vols and arrival['delta'] != 0:
+        # Imported here so that scipy is only loaded when exact vols are asked for
+        from ImpliedVol import option_terms, exact_TCA_vols
+        K, T, is_call = option_terms(df.iloc[:1])
+        dPxRanges = np.array([[np.nan, np.nan] if stats is None else [stats['dPxMin'], stats['dPxMax']]
+                              for stats in buckets])
+        exact_TCA_vols(vals, row_index, arrival['side'], K[0], T[0], is_call[0], dPxRanges)
+    return vals
+
+def calc_TCA_metrics(df, qwap=None, qwapU=None, arrActSlipPct=None, formatted=True, exact_vols=False):
+    """Returns a dataframe of TCA metrics for an option or stock order on SpiderRock
 
-    if makeDf['fillQuantity'].sum() > 0:
-        populate_rows(makeDf, 'Maker')
-    else:
-        results['Maker'] = 0
+    The are three broad classes of TCA returned.  The first is raw stats on execution price vs. arrival
+    and QWAP (quote-weighted average price).  The second uses theoretical delta-adjusted values. These are
+    theoretical in the sense they assume the delta-hedge was executed at mid-market at the time of each option fill.
+    The third takes an actual delta execution price and uses this in place of the theoretical one.
 
-    if takeDf['fillQuantity'].sum() > 0:
-        populate_rows(takeDf, 'Taker')
-    else:
-        results['Taker'] = 0
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        A dataframe generated from SRSE Trade's msgsrparentexecution table, filtered to represent a single underlying
+    qwap : float, optional
+        SR's estimated QWAP for the option, from msgsrparentbrkrstate (default is None)
+    qwapU : float, optional
+        SR's estimated QWAP for the option underlying, from msgsrparentbrkrstate (default is None)
+    arrActSlipPct: float, optional
+        The % difference between the hedge's average price and its mid at the time of first fill (default is None)
+    formatted: bool, optional
+        Whether the dataframe returned should be converted to fixed-width formatted strings (default is True)
+    exact_vols: bool, optional
+        Whether to calculate the vol rows as Black-76 implied vols (see ImpliedVol) rather than
+        from the first fill's vol and vega (default is False)
 
-    if df['fillQuantity'].sum() > 0:
-        populate_rows(df, 'Total')
-    else:
-        results['Total'] = 0
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        A dataframe indexed by TCA stats, separating Making and Taking trades and providing field descriptions
+    """
 
-    # Add descriptions
-    for key in rows_dict.keys():
-        results.loc[key, 'Desc'] = rows_dict[key][1]
-    results.loc['Order', 'Desc'] = make_title(df)
+    vals = calc_TCA_array(df, qwap, qwapU, arrActSlipPct, exact_vols)
+    results = results_to_df(vals, make_title(df[df['fillQuantity'] > 0]))
 
     # Add formatting and return results
     if formatted:
        results = format_df(results, format_dict)
     return results
 
-def process_day_TCA(dt):
+def process_day_TCA(dt, summary=None, use_cache=True, exact_vols=False, ctx=None, warehouse=True):
     """Calls calc_option_TCA_metrics for each trade ticket found for date dt
 
     The function will attempt to locate the relevant files for the day and determine the number
@@ -315,6 +519,17 @@ def process_day_TCA(dt):
     ----------
     dt : datetime.date (or anything richer than that)
             The trade date to process
+    summary : list, optional
+            If given, a dict of date, baseParentNumber and file name is appended for each file written
+    use_cache : bool, optional
+            Skip parents whose fills, broker state and hedge are unchanged since their files were
+            last written (see TCACache).  Bump TCA_VERSION when the metrics change (default is True)
+    exact_vols : bool, optional
+            Calculate the vol rows as exact implied vols (see calc_TCA_metrics) (default is False)
+    ctx : DayContext, optional
+            The day's data, if already loaded (default is to load it)
+    warehouse : bool, optional
+            Record the numeric results in the TCAWarehouse and update its rollups (default is True)
 
     Returns
     -------
@@ -322,137 +537,95 @@ def process_day_TCA(dt):
             The number of baseParentNumbers processed
     """
 
-    tradeFile = os.path.join(os.getcwd(), 'FillData', f'Trades{dt:%Y%m%d}.csv')
-    dayFills = pd.read_csv(tradeFile)
-    process_time_cols(dayFills)
+    if ctx is None:
+        ctx = DayContext(dt)
     wins = 0
-    if dayFills.shape[0] == 0:
+    if ctx.fills.shape[0] == 0:
         return wins
-
-    for grp in dayFills['riskGroupId'].unique():
-        parents = dayFills.loc[dayFills['riskGroupId'] == grp, 'baseParentNumber'].unique()
-        opt_parents = [p for p in parents if dayFills.loc[dayFills['baseParentNumber'] == p, 'secType'].iloc[0] == 'Option']
-        stock_parents = [p for p in parents if dayFills.loc[dayFills['baseParentNumber'] == p, 'secType'].iloc[0] == 'Stock']
+    brkrIndex = get_index()
+    cache = TCACache(dt, 'ProcessExecutions_ML') if use_cache else None
+    facts = DayFacts(dt, 'ProcessExecutions_ML', list(rows_dict)) if warehouse else None
+    keys = {}
+    written = {}
+
+    def save(results, fName, parent):
+        results.to_csv(os.path.join(os.getcwd(), 'TCA', fName))
+        written.setdefault(parent, []).append(fName)
+        if summary is not None:
+            summary.append({'date': dt, 'baseParentNumber': parent, 'file': fName})
+
+    def record(parent, leg, vals, fills, hedged=False):
+        if facts is not None:
+            facts.add(parent, leg, vals, fills, strategy_name(fills, hedged))
+
+    def cached(parent, *inputs):
+        # Returns the number of files still current for parent, or 0 if it needs computing
+        if cache is None:
+            return 0
+        keys[parent] = cache.make_key(parentFills[parent], 'ProcessExecutions_ML', TCA_VERSION, exact_vols, *inputs)
+        files = cache.lookup(parent, keys[parent])
+        if files is None or (facts is not None and not facts.has(parent)):
+            return 0
+        if summary is not None:
+            summary.extend({'date': dt, 'baseParentNumber': parent, 'file': f} for f in files)
+        return len(files)
+
+    # The day is grouped once; each parent's fills are then a dict lookup
+    groups, parentFills = ctx.groups('riskGroupId'), ctx.parentFills
+
+    for grp, opt_parents, stock_parents in groups:
 
         if len(opt_parents) > 0:
             # Look for a delta hedge execution
             if len(stock_parents) >= 1:
-                hedges = dayFills[dayFills['baseParentNumber'] == stock_parents[0]]
+                hedges = parentFills[stock_parents[0]]
                 actUMid = (hedges.loc[hedges.index[0], 'parentBid'] + hedges.loc[hedges.index[0], 'parentAsk']) / 2
                 fillU = (hedges['fillPrice'] * hedges['fillQuantity']).sum() / hedges['fillQuantity'].sum()
                 arrActSlipPct = (fillU - actUMid) / actUMid
             else:
                 arrActSlipPct = None
             for opt in opt_parents:
-                fills = dayFills[dayFills['baseParentNumber'] == opt].copy()
+                fills = parentFills[opt]
                 qwap = qwapU = None
+                marks = brkrIndex.lookup(opt, dt)
+                hits = cached(opt, marks, arrActSlipPct)
+                if hits > 0:
+                    wins += hits
+                    continue
                 if fills.loc[fills.index[0], 'execShape'] == 'Single':
                     # Look for qwap data matching opt
-                    brkr = find_first_file(dt)
-                    if brkr is not None:
-                        brkr = brkr[brkr['baseParentNumber'] == opt]
-                        if brkr.shape[0] > 0:
-                            qwap = brkr.loc[brkr.index[0], 'brokerQwapMark']
-                            qwapU = brkr.loc[brkr.index[0], 'brokerQwapUMark']
-                    results = calc_TCA_metrics(fills, qwap, qwapU, arrActSlipPct)
-                    fName = make_title(fills) + '.csv'
-                    results.to_csv(os.path.join(os.getcwd(), 'TCA', fName))
+                    if marks is not None:
+                        qwap = marks['brokerQwapMark']
+                        qwapU = marks['brokerQwapUMark']
+                    vals = calc_TCA_array(fills, qwap, qwapU, arrActSlipPct, exact_vols)
+                    results = format_df(results_to_df(vals, make_title(fills[fills['fillQuantity'] > 0])), format_dict)
+                    fName = make_title(fills) + f'{dt:%Y%m%d}.csv'
+                    save(results, fName, opt)
+                    record(opt, 0, vals, fills, arrActSlipPct is not None)
                     wins += 1
                 elif fills.loc[fills.index[0], 'execShape'] == 'MLegLeg':
-                    # Create a column with unique names for each option in the package
-                    def get_opt_name(l):
-                        s = l[0] + ' '
-                        s += f'{l[1]}{l[2]:0>2}{l[3]:0>2} '
-                        if l[4] == int(l[4]):
-                            s += f'{l[4]:.0f} '
-                        else:
-                            s += f'{l[4]:.2f} '
-                        s += l[5]
-                        return s
-
-                    keyCols = ['secKey_tk',
-                            'secKey_yr', 'secKey_mn', 'secKey_dy',
-                            'secKey_xx',
-                            'secKey_cp']
-                    fills['optName'] = fills[keyCols].apply(get_opt_name, axis=1)
-
-                    # Prepare to calculate and combine the results across legs
-                    # Default behaviour will be to combine results in a side/qty weighted sum
-                    # However, this row will be ignored
-                    ig_rows = ['Order']
-                    # and these rows will be qty weighted only
-                    sum_rows = ['Slip Arr Mid Px',
-                                'Slip Arr Mid USD',
-                                'Slip Arr Mark Px',
-                                'Slip Arr Mark USD',
-                                'DTheo Slip Arr Mid Px',
-                                'DTheo Slip Arr Mid USD',
-                                'DTheo Slip Arr Mark Px',
-                                'DTheo Slip Arr Mid Vol',
-                                'DTheo Slip Arr Mark Vol',
-                                'DTheo Slip Arr Mark USD',
-                                'DAct Slip Arr Mid Px',
-                                'DAct Slip Arr Mid USD',
-                                'DAct Slip Arr Mark Px',
-                                'DAct Slip Arr Mark USD',
-                                'DAct Slip Arr Mid Vol',
-                                'DAct Slip Arr Mark Vol',
-                                ]
-                    # and these rows will simply return max()
-                    max_rows = ['Arrival U Mid',
-                                'Child Orders',
-                                'Avg Child Size',
-                                'Filled Ctr',
-                                'Ctr Fill Rate',
-                                'Px Range',
-                                'Theo U Mid',
-                                'DTheo Px Range',
-                                'DTheo Vol Range',
-                                'Act U Mid']
+                    # Calculate every leg's results as one stacked array, then combine across legs
+                    legs = [legFills for _, legFills in fills.groupby(leg_cols, sort=False, dropna=False)]
+                    legVals = np.stack([calc_TCA_array(legFills, None, None, arrActSlipPct, exact_vols)
+                                        for legFills in legs])
+                    sides = np.array([1 if legFills.loc[legFills.index[0], 'orderSide'] == 'Buy' else -1
+                                      for legFills in legs])
+                    sumVals = consolidate_legs(legVals, sides)
 
                     opt_str = ''
-                    sum_results = None
-                    min_qty = float('inf')
-                    val_cols = ['Maker', 'Taker', 'Total']
-
-                    for i, leg in enumerate(fills['optName'].unique()):
-                        legFills = fills[fills['optName'] == leg]
-                        results = calc_TCA_metrics(legFills, None, None, arrActSlipPct, False)
-                        # Do summing here
-                        qty = results.loc['Filled Ctr', 'Total']
-                        if 0 < qty < min_qty:
-                            min_qty = qty
-                        if legFills.loc[legFills.index[0], 'orderSide'] == 'Buy':
-                            mult = qty
-                        else:
-                            mult = -qty
-                        opt_str += make_title(legFills) + ' '
-                        if sum_results is None:
-                            sum_results = results.copy()
-                            sum_results[['Maker', 'Taker', 'Total']] = 0
-
-                        sum_results.loc[~sum_results.index.isin(ig_rows+sum_rows+max_rows), val_cols] += \
-                            results.loc[~sum_results.index.isin(ig_rows+sum_rows+max_rows), val_cols] * mult
-
-                        sum_results.loc[sum_results.index.isin(sum_rows), val_cols] += \
-                            results.loc[sum_results.index.isin(sum_rows), val_cols] * qty
-
-                        for col in val_cols:
-                            tdf = pd.concat([sum_results.loc[sum_results.index.isin(max_rows), col],
-                                             results.loc[sum_results.index.isin(max_rows), col]], axis=1)
-                            sum_results.loc[sum_results.index.isin(max_rows), col] = tdf.apply(max, axis=1)
-
-                        # Then format and save
+                    for i, legFills in enumerate(legs):
+                        title = make_title(legFills)
+                        opt_str += title + ' '
                         fName = f'{dt:%Y%m%d} {opt % 100000}-{i+1}.csv'
-                        results = format_df(results, format_dict)
-                        results.to_csv(os.path.join(os.getcwd(), 'TCA', fName))
+                        results = format_df(results_to_df(legVals[i], title), format_dict)
+                        save(results, fName, opt)
+                        record(opt, i + 1, legVals[i], legFills, arrActSlipPct is not None)
                         wins += 1
 
-                    sum_results.loc[~sum_results.index.isin(max_rows), val_cols] /= min_qty
-                    sum_results.iloc[0, 3] = opt_str
                     fName = f'{dt:%Y%m%d} {opt % 100000}-Cons.csv'
-                    sum_results = format_df(sum_results, format_dict)
-                    sum_results.to_csv(os.path.join(os.getcwd(), 'TCA', fName))
+                    sum_results = format_df(results_to_df(sumVals, opt_str), format_dict)
+                    save(sum_results, fName, opt)
+                    record(opt, 0, sumVals, fills, arrActSlipPct is not None)
                     wins += 1
 
         if len(opt_parents) == 0 and len(stock_parents) > 0:
@@ -460,17 +633,29 @@ def process_day_TCA(dt):
                 # Look for Vwap data matching stock
                 # For a pure stock order, Vwap is probably a better metric than Qwap
                 qwap = qwapU = None
-                brkr = find_first_file(dt)
-                if brkr is not None:
-                    brkr = brkr[brkr['baseParentNumber'] == stock]
-                    if brkr.shape[0] > 0:
-                        qwap = brkr.loc[brkr.index[0], 'brokerVwapMark']
-                fills = dayFills[dayFills['baseParentNumber'] == stock]
-                results = calc_TCA_metrics(fills, qwap)
+                marks = brkrIndex.lookup(stock, dt)
+                hits = cached(stock, marks)
+                if hits > 0:
+                    wins += hits
+                    continue
+                if marks is not None:
+                    qwap = marks['brokerVwapMark']
+                fills = parentFills[stock]
+                vals = calc_TCA_array(fills, qwap)
+                results = format_df(results_to_df(vals, make_title(fills[fills['fillQuantity'] > 0])), format_dict)
                 fName = f'{dt:%Y%m%d} {stock % 100000}.csv'
-                results.to_csv(os.path.join(os.getcwd(), 'TCA', fName))
+                save(results, fName, stock)
+                record(stock, 0, vals, fills)
                 wins += 1
 
+    if cache is not None:
+        for parent, key in keys.items():
+            if parent not in cache.seen:
+                cache.store(parent, key, written.get(parent, []))
+        cache.save()
+    if facts is not None:
+        facts.save(ctx.parents)
+
     return wins
 
 
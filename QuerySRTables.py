@@ -1,39 +1,374 @@
-from getpass import getpass
-from mysql.connector import connect, Error
-import pandas as pd
+# Downloads the day's SRSE Trade tables into the FillStore partitions under FillData
+#
+# Rows are fetched and written in batches, so memory stays bounded however many rows come back,
+# and only the execution columns we use are selected.  The functions take any DB-API connection,
+# e.g. sqlite3 with the srtrade/srtrade009 schemas attached, as well as mysql.connector.
+#
+# sync_all pulls incrementally: each table keeps a watermark (its last fillNumber or timestamp) in
+# FillData/Store/watermarks.json and only rows beyond it are fetched and appended to the day's
+# partition, so intraday polling costs a few rows per pull rather than a full table scan.
+#
+# sync_concurrent runs the tables in parallel, each on its own connection from a pool, so capture
+# time is bounded by the slowest table rather than the sum of them all.  Each table is retried with
+# exponential backoff, and the columns of every SRSE table are cached in FillData/Store/columns.json.
+
 import os
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+from SRUtils import keep_cols
+from FillStore import primary_keys, store_dir, write_table
+from DayContext import context_cols
+
+accnt = 'T.SRDEMO003'
+
+# SRSE connection details; the password is asked for at run time
+host = '198.102.4.55'
+port = '3307'
+user = 'srdemo003'
+
+# Columns the readers of the Trades store need: those kept by filter_cols, the ids and fill time
+# DayContext loads beyond them (FillHistogram buckets on fillDttm) and the row key
+trade_read_cols = list(dict.fromkeys(keep_cols + context_cols + primary_keys['Trades']))
+
+# Columns pulled from msgsrparentexecution: trade_read_cols and the micros of their time fields
+trade_cols = trade_read_cols + [c + '_us' for c in trade_read_cols if 'Dttm' in c]
+
+# FillStore table -> (SRSE table, columns to select or None for all)
+queries = {
+    'Trades': ('srtrade009.msgsrparentexecution', trade_cols),
+    'BrkrState': ('srtrade.msgsrparentbrkrstate', None),
+    'BrkrDetail': ('srtrade.msgsrparentbrkrdetail', None),
+    'BrkrEvent': ('srtrade.msgsrparentbrkrevent', None),
+    'MLBrkrState': ('srtrade.msgsrmlegbrkrstate', None),
+    'MLBrkrEvent': ('srtrade.msgsrmlegbrkrevent', None),
+}
+
+# FillStore table -> the columns, compared in order, which increase as new rows arrive.  State rows
+# are rewritten with a new timestamp when they change; FillStore.primary_keys keeps the latest
+watermark_cols = {
+    'Trades': ['fillNumber'],
+    'BrkrState': ['timestamp', 'timestamp_us'],
+    'BrkrDetail': ['timestamp', 'timestamp_us'],
+    'BrkrEvent': ['timestamp', 'timestamp_us'],
+    'MLBrkrState': ['timestamp', 'timestamp_us'],
+    'MLBrkrEvent': ['timestamp', 'timestamp_us'],
+}
+
+# Guards the json files under the store, which the threads of sync_concurrent share
+_store_lock = threading.Lock()
+
+
+def watermark_path():
+    return os.path.join(store_dir(), 'watermarks.json')
+
+
+def load_watermarks():
+    # Returns {table: [watermark values]} saved by the last pull, or {} if there hasn't been one
+    if not os.path.exists(watermark_path()):
+        return {}
+    with open(watermark_path()) as f:
+        return json.load(f)
+
+
+def save_watermarks(marks):
+    os.makedirs(store_dir(), exist_ok=True)
+    with open(watermark_path(), 'w') as f:
+        json.dump(marks, f, indent=1)
+
+
+def columns_path():
+    return os.path.join(store_dir(), 'columns.json')
+
+
+def table_columns(connection, srTable, refresh=False):
+    """Returns the columns of srTable, from the cache unless refresh is set or it has none
+
+    Parameters
+    ----------
+    connection : DB-API connection
+        Used when the columns have to be looked up
+    srTable : string
+        The SRSE table, e.g. 'srtrade.msgsrparentbrkrstate'
+    refresh : bool, optional
+        Look the columns up even if they are cached (default is False)
+
+    Returns
+    -------
+    list
+    """
+
+    with _store_lock:
+        cached = {}
+        if os.path.exists(columns_path()):
+            with open(columns_path()) as f:
+                cached = json.load(f)
+    if srTable in cached and not refresh:
+        return cached[srTable]
+    cursor = connection.cursor()
+    try:
+        cursor.execute(f'SELECT * FROM {srTable} LIMIT 0')
+        cursor.fetchall()
+        cols = [d[0] for d in cursor.description]
+    finally:
+        cursor.close()
+    with _store_lock:
+        if os.path.exists(columns_path()):
+            with open(columns_path()) as f:
+                cached = json.load(f)
+        cached[srTable] = cols
+        os.makedirs(store_dir(), exist_ok=True)
+        with open(columns_path(), 'w') as f:
+            json.dump(cached, f, indent=1)
+    return cols
+
+
+def missing_trade_cols(columns=None):
+    # Returns the columns some reader of the Trades store needs which columns (default the Trades
+    # projection) leaves out, so that a narrowed projection fails the sync rather than a later load
+    from OrderIndex import key_cols, seckey_cols
+    columns = trade_cols if columns is None else columns
+    return [c for c in trade_read_cols + key_cols + seckey_cols if c not in columns]
+
+
+def select_columns(connection, table, refresh=False):
+    # Returns the columns to select for table: its projection (plus watermark columns) restricted to
+    # those its SRSE table has, or all of them if it has no projection
+    srTable, columns = queries[table]
+    available = table_columns(connection, srTable, refresh)
+    if columns is None:
+        return available
+    columns = columns + [c for c in watermark_cols[table] if c not in columns]
+    return [c for c in columns if c in available]
+
+
+def sql_value(v):
+    # Renders a watermark value as a SQL literal
+    if isinstance(v, str):
+        return f"'{v}'"
+    return str(v)
+
+
+def json_value(v):
+    # Converts a fetched value to something json and sql_value round trip: numbers stay numbers,
+    # datetimes become 'yyyy-mm-dd hh:mm:ss' strings
+    if hasattr(v, 'strftime'):
+        return v.strftime('%Y-%m-%d %H:%M:%S')
+    if hasattr(v, 'item'):
+        return v.item()
+    return v
+
+
+def build_query(srTable, columns=None):
+    # Returns the SELECT for accnt's rows of srTable, projected to columns if given
+    select = '*' if columns is None else ', '.join(columns)
+    return f"SELECT {select} FROM {srTable} WHERE accnt = '{accnt}'"
+
+
+def build_sync_query(table, watermark=None, columns=None):
+    # Returns the SELECT of columns (default table's projection) for table's rows beyond watermark
+    # (all rows if None), in watermark order
+    srTable, projection = queries[table]
+    cols = watermark_cols[table]
+    if columns is None and projection is not None:
+        columns = projection + [c for c in cols if c not in projection]
+    query = build_query(srTable, columns)
+    if watermark is not None:
+        query += f" AND ({', '.join(cols)}) > ({', '.join(sql_value(v) for v in watermark)})"
+    return query + f" ORDER BY {', '.join(cols)}"
+
+
+def export_table(connection, table, query, dt, batch_size=10000, append=False, watermark=None):
+    """Streams the result of query into the FillStore partition of table for date dt
+
+    Parameters
+    ----------
+    connection : DB-API connection
+        e.g. from mysql.connector.connect or sqlite3.connect
+    table : string
+        The FillStore table, e.g. 'Trades'
+    query : string
+        The SELECT to run
+    dt : datetime.date (or anything richer)
+        The partition date
+    batch_size : int, optional
+        Rows fetched and written per part file (default=10000)
+    append : bool, optional
+        Add the rows to the partition rather than replacing it; nothing is written if there are
+        none (default is False)
+    watermark : list, optional
+        Columns whose values in the last row fetched are returned (default is None)
+
+    Returns
+    -------
+    int
+        The number of rows written
+    list or None
+        The watermark values of the last row, or None if no rows or no watermark columns
+    """
+
+    cursor = connection.cursor()
+    last = None
+    try:
+        cursor.execute(query)
+        cols = [d[0] for d in cursor.description]
+        n = 0
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            write_table(pd.DataFrame(rows, columns=cols), table, dt, append=append or n > 0)
+            n += len(rows)
+            last = rows[-1]
+        if n == 0 and not append:
+            write_table(pd.DataFrame(columns=cols), table, dt)
+    finally:
+        cursor.close()
+    if last is None or watermark is None:
+        return n, None
+    return n, [json_value(last[cols.index(c)]) for c in watermark]
+
+
+def sync_table(connection, table, dt, batch_size=10000, full=False, refresh_columns=False):
+    """Pulls table's rows beyond its watermark into the partition for date dt
+
+    Parameters
+    ----------
+    connection : DB-API connection
+        e.g. from mysql.connector.connect or sqlite3.connect
+    table : string
+        A FillStore table in queries, e.g. 'Trades'
+    dt : datetime.date (or anything richer)
+        The partition date
+    batch_size : int, optional
+        Rows fetched and written per part file (default=10000)
+    full : bool, optional
+        Ignore the watermark and replace the partition with every row (default is False)
+    refresh_columns : bool, optional
+        Look up the SRSE table's columns rather than using the cached ones (default is False)
+
+    Returns
+    -------
+    int
+        The number of rows written
+    """
+
+    if table == 'Trades' and len(missing_trade_cols()) > 0:
+        raise ValueError(f'Trades projection is missing {missing_trade_cols()}')
+    with _store_lock:
+        watermark = None if full else load_watermarks().get(table)
+    columns = select_columns(connection, table, refresh_columns)
+    query = build_sync_query(table, watermark, columns)
+    n, last = export_table(connection, table, query, dt, batch_size, append=not full,
+                           watermark=watermark_cols[table])
+    if last is not None:
+        with _store_lock:
+            marks = load_watermarks()
+            marks[table] = last
+            save_watermarks(marks)
+    return n
+
+
+def sync_all(connection, dt, batch_size=10000, full=False):
+    # Syncs every table in queries into date dt, returning the row count of each
+    return {table: sync_table(connection, table, dt, batch_size, full) for table in queries}
+
+
+def with_retry(func, retries=3, backoff=1.0):
+    """Calls func(attempt) until it succeeds, sleeping backoff * 2 ** attempt seconds between tries
+
+    Any exception is retried, since DB-API drivers each raise their own types; the last one is
+    re-raised once the retries are used up.  A failed incremental pull leaves its watermark
+    unchanged, so rows it had already appended are fetched again and de-duplicated on load.
+
+    Parameters
+    ----------
+    func : callable
+        Takes the attempt number, starting at 0
+    retries : int, optional
+        Attempts after the first (default=3)
+    backoff : float, optional
+        Seconds to wait before the first retry (default=1.0)
+    """
+
+    for attempt in range(retries + 1):
+        try:
+            return func(attempt)
+        except Exception:
+            if attempt == retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+
+
+def sync_concurrent(connect, dt, batch_size=10000, full=False, workers=None, retries=3, backoff=1.0):
+    """Syncs every table in queries into date dt in parallel, each on its own connection
+
+    Parameters
+    ----------
+    connect : callable
+        Returns a DB-API connection, e.g. MySQLConnectionPool.get_connection.  Connections are
+        closed (returned to the pool) after each attempt
+    dt : datetime.date (or anything richer)
+        The partition date
+    batch_size : int, optional
+        Rows fetched and written per part file (default=10000)
+    full : bool, optional
+        Ignore the watermarks and replace the partitions with every row (default is False)
+    workers : int, optional
+        Tables pulled at once (default is one per table)
+    retries : int, optional
+        Retries per table; retries refresh the cached columns in case the schema changed (default=3)
+    backoff : float, optional
+        Seconds to wait before a table's first retry, doubling after each (default=1.0)
+
+    Returns
+    -------
+    dict
+        The number of rows written for each table
+    """
+
+    def attempt(table, i):
+        connection = connect()
+        try:
+            return sync_table(connection, table, dt, batch_size, full, refresh_columns=i > 0)
+        finally:
+            connection.close()
+
+    def pull(table):
+        return with_retry(lambda i: attempt(table, i), retries, backoff)
+
+    with ThreadPoolExecutor(max_workers=workers or len(queries)) as pool:
+        counts = list(pool.map(pull, queries))
+    return dict(zip(queries, counts))
+
+
+def connect_pool(password=None):
+    # Returns a mysql.connector pool with a connection per table, asking for the password if not given.
+    # mysql.connector is imported here so the rest of the module can be used without it
+    from getpass import getpass
+    from mysql.connector.pooling import MySQLConnectionPool
+    return MySQLConnectionPool(pool_name='srse', pool_size=len(queries), host=host, port=port, user=user,
+                               password=password if password is not None else getpass('Enter password: '))
+
+
+def export_all(connection, dt, batch_size=10000):
+    # Exports every table in queries for date dt in full, resetting the watermarks, and returns
+    # the row count of each
+    return sync_all(connection, dt, batch_size, full=True)
+
+
+if __name__ == '__main__':
+    import argparse
+    from mysql.connector import Error
+
+    parser = argparse.ArgumentParser(description="Save today's SRSE Trade tables to the FillStore")
+    parser.add_argument('--sync', action='store_true', help='only pull rows beyond the last watermarks')
+    args = parser.parse_args()
 
-try:
-    with connect(
-        host="198.102.4.55",
-        port = "3307",
-        user="srdemo003",
-        password=getpass("Enter password: "),
-    ) as connection:
-        fills_col_query = "SHOW COLUMNS FROM srtrade009.msgsrparentexecution"
-        fills_row_query = "SELECT * FROM srtrade009.msgsrparentexecution WHERE accnt = 'T.SRDEMO003'"
-        qwap_col_query = "SHOW COLUMNS FROM srtrade.msgsrparentbrkrstate"
-        qwap_row_query = "SELECT * FROM srtrade.msgsrparentbrkrstate WHERE accnt = 'T.SRDEMO003'"
-        ticket_col_query = 'SHOW COLUMNS FROM srtrade.msgsrparentbrkrdetail'
-        ticket_row_query = "SELECT * FROM srtrade.msgsrparentbrkrdetail WHERE accnt = 'T.SRDEMO003'"
-        with connection.cursor() as cursor:
-            cursor.execute(fills_col_query)
-            cols = [c[0] for c in cursor.fetchall()]
-            cursor.execute(fills_row_query)
-            fills = pd.DataFrame(cursor.fetchall(), columns=cols)
-            cursor.execute(qwap_col_query)
-            cols = [c[0] for c in cursor.fetchall()]
-            cursor.execute(qwap_row_query)
-            qwap = pd.DataFrame(cursor.fetchall(), columns=cols)
-            cursor.execute(ticket_col_query)
-            cols = [c[0] for c in cursor.fetchall()]
-            cursor.execute(ticket_row_query)
-            ticket = pd.DataFrame(cursor.fetchall(), columns=cols)
-        saveDir = os.path.join(os.getcwd(), 'FillData')
-        t = pd.Timestamp.now()
-        fills.to_csv(os.path.join(saveDir, f'Trades{t:%Y%m%d}.csv'))
-        qwap.to_csv(os.path.join(saveDir, f'BrkrState{t:%Y%m%d}.csv'))
-        ticket.to_csv(os.path.join(saveDir, f'BrkrDetail{t:%Y%m%d}.csv'))
-except Error as e:
-    print(e)
-    
\ No newline at end of file
+    try:
+        pool = connect_pool()
+        print(sync_concurrent(pool.get_connection, pd.Timestamp.now(), full=not args.sync))
+    except Error as e:
+        print(e)
@@ -0,0 +1,262 @@
+# Single command line entry point for the SpiderRock tools
+#
+#   python SRCli.py sync [--full]                     pull today's SRSE tables into the FillStore
+#   python SRCli.py tca 20210312                      write a day's TCA files
+#   python SRCli.py viz 20210122 70624                chart an order's fills
+#   python SRCli.py hist 20210125 70624               chart an order's fills per time bucket
+#   python SRCli.py backfill 20210101 20210331        rebuild TCA history across a process pool
+#   python SRCli.py charts 20210101 20210331          render every order's charts
+#   python SRCli.py dates                             list the trade dates available
+#   python SRCli.py find 1136626121228828413          list the dates and rows where an order is
+#   python SRCli.py rollup ticker 20210101 20210131   TCA history combined by ticker
+#   python SRCli.py children 20210101 20210131        child order fill rates and times to fill
+#   python SRCli.py bench-imports                     time the import of each module
+#
+# Only argparse is imported at start up.  Each subcommand imports what it needs (pandas, plotly,
+# scipy, mysql.connector) when it runs, so cron jobs and lookups don't pay for the others.
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+# Modules timed by bench-imports, third party first
+bench_modules = ['numpy', 'pandas', 'scipy.special', 'plotly.graph_objects', 'FillStore', 'DayContext',
+                 'ImpliedVol', 'QuerySRTables', 'ProcessExecutions', 'ProcessExecutions_ML', 'Backfill',
+                 'StreamingTCA', 'OrderIndex', 'TCAWarehouse', 'Markouts', 'BrkrTimeline', 'ChildAnalytics',
+                 'FillVizualizer', 'FillHistogram', 'ChartBook']
+
+
+def parse_date(s):
+    # Returns a yyyymmdd string as a pandas Timestamp
+    import pandas as pd
+    return pd.to_datetime(s, format='%Y%m%d')
+
+
+def order_fills(date, parent):
+    # Returns the trade date, baseParentNumber and fills of an order.  parent may be given in full or
+    # as its last five digits (as in the TCA file names), and only its rows are read, via the
+    # OrderIndex.  Without parent the whole day is loaded and its first order used
+    from DayContext import DayContext, context_cols
+    from OrderIndex import get_order_index, load_order
+    from SRUtils import keep_cols
+    dt = parse_date(date)
+    if parent is None:
+        ctx = DayContext(dt)
+        return dt, ctx.parents[0], ctx.parentFills[ctx.parents[0]]
+    index = get_order_index()
+    matches = index.match_parents(parent, dt)
+    if len(matches) != 1:
+        raise SystemExit(f'{len(matches)} orders on {dt:%Y%m%d} match {parent}')
+    return dt, matches[0], load_order(matches[0], 'Trades', keep_cols + context_cols, dt, index)
+
+
+def run_sync(args):
+    import pandas as pd
+    from QuerySRTables import connect_pool, sync_concurrent
+    pool = connect_pool()
+    print(sync_concurrent(pool.get_connection, pd.Timestamp.now(), full=args.full))
+
+
+def run_tca(args):
+    import importlib
+    from Backfill import engines
+    module = importlib.import_module(engines[args.engine])
+    os.makedirs(os.path.join(os.getcwd(), 'TCA'), exist_ok=True)
+    summary = []
+    wins = module.process_day_TCA(parse_date(args.date), summary, not args.no_cache, args.exact_vols)
+    for s in summary:
+        print(s['file'])
+    print(f'{wins} files written')
+
+
+def run_viz(args):
+    from ChartBook import chart_name
+    from FillVizualizer import plot_fill_graph
+    dt, parent, fills = order_fills(args.date, args.parent)
+    print(plot_fill_graph(fills, True, args.exact_vols, args.max_points, chart_name(dt, parent, 'Fills', args.format),
+                          args.open))
+
+
+def run_hist(args):
+    from ChartBook import chart_name
+    from FillHistogram import plot_fill_bar
+    dt, parent, fills = order_fills(args.date, args.parent)
+    bucketFills = plot_fill_bar(fills[fills['fillQuantity'] > 0], args.bucket, True,
+                                chart_name(dt, parent, 'Buckets', args.format), args.open)
+    print(bucketFills.to_string())
+
+
+def run_backfill(args):
+    from Backfill import run_backfill as backfill
+    summary = backfill(args.start, args.end, args.workers, args.engine, not args.no_cache, args.exact_vols)
+    summary['parents'] = summary['parents'].apply(len)
+    print(summary[['files', 'parents', 'error']].to_string())
+
+
+def run_charts(args):
+    from ChartBook import render_book
+    book = render_book(args.start, args.end, args.workers, args.format, args.bucket, args.max_points)
+    book['files'] = book['files'].apply(len)
+    print(book.to_string(index=False))
+
+
+def run_dates(args):
+    from FillStore import available_dates
+    for dt in available_dates(args.table):
+        print(f'{dt:%Y%m%d}')
+
+
+def run_find(args):
+    from OrderIndex import get_order_index
+    keys = {k: getattr(args, k) for k in ['packageId', 'riskGroupId', 'secKey']}
+    locs = get_order_index().find(args.parent, table=args.table, **keys)
+    print(locs.drop('file', axis=1).to_string(index=False))
+
+
+def run_rollup(args):
+    from TCAWarehouse import query_rollup
+    engine = 'ProcessExecutions' if args.engine == 'single' else 'ProcessExecutions_ML'
+    metrics = args.metrics.split(',') if args.metrics else None
+    print(query_rollup(args.dim, args.start, args.end, args.bucket, metrics, engine).to_string())
+
+
+def run_children(args):
+    from ChildAnalytics import fill_rate_table, history_children, latency_table
+    child = history_children(args.start, args.end)
+    keys = args.by.split(',')
+    print(fill_rate_table(child, keys).round(3).to_string())
+    print(latency_table(child, keys).round(3).to_string())
+
+
+def time_import(module, repeat=5):
+    # Returns the best of repeat timings, in seconds, of importing module in a fresh interpreter
+    code = f'import time; t = time.perf_counter(); import {module}; print(time.perf_counter() - t)'
+    best = None
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True)
+        t = float(out.stdout.split()[-1])
+        best = t if best is None else min(best, t)
+    return best
+
+
+def time_command(argv, repeat=5):
+    # Returns the best of repeat wall times, in seconds, of running argv to completion
+    best = None
+    for _ in range(repeat):
+        t = time.perf_counter()
+        subprocess.run(argv, capture_output=True, check=True)
+        t = time.perf_counter() - t
+        best = t if best is None else min(best, t)
+    return best
+
+
+def run_bench_imports(args):
+    # Runs each import in its own interpreter so that no module is already cached by another
+    modules = args.modules or bench_modules
+    width = max(len(m) for m in modules + ['SRCli --help (wall)', 'python -c pass (wall)'])
+    print(f'{"module":<{width}}  best of {args.repeat} (s)')
+    for module in modules:
+        try:
+            t = f'{time_import(module, args.repeat):8.3f}'
+        except subprocess.CalledProcessError:
+            t = '  failed'
+        print(f'{module:<{width}}  {t}')
+    print(f'{"python -c pass (wall)":<{width}}  {time_command([sys.executable, "-c", "pass"], args.repeat):8.3f}')
+    cli = [sys.executable, os.path.abspath(__file__), '--help']
+    print(f'{"SRCli --help (wall)":<{width}}  {time_command(cli, args.repeat):8.3f}')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='SpiderRock fill capture, TCA and charting tools')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    p = sub.add_parser('sync', help="pull today's SRSE tables into the FillStore")
+    p.add_argument('--full', action='store_true', help='re-pull whole tables rather than rows beyond the watermarks')
+    p.set_defaults(func=run_sync)
+
+    p = sub.add_parser('tca', help="write a day's TCA files")
+    p.add_argument('date', help='trade date, yyyymmdd')
+    p.add_argument('--engine', choices=['ml', 'single'], default='ml')
+    p.add_argument('--no-cache', action='store_true', help='recompute every parent')
+    p.add_argument('--exact-vols', action='store_true', help='use exact implied vols in the vol rows')
+    p.set_defaults(func=run_tca)
+
+    p = sub.add_parser('viz', help="chart an order's fills against the market")
+    p.add_argument('date', help='trade date, yyyymmdd')
+    p.add_argument('parent', nargs='?', type=int, help="baseParentNumber or its last 5 digits (default the day's first)")
+    p.add_argument('--max-points', type=int, default=None, help='downsample chart lines to this many points')
+    p.add_argument('--exact-vols', action='store_true', help='chart exact implied vols')
+    p.add_argument('--format', default='html', help='html, or an image format such as png (needs kaleido)')
+    p.add_argument('--open', action='store_true', help='open the chart in a browser')
+    p.set_defaults(func=run_viz)
+
+    p = sub.add_parser('hist', help="chart an order's fills per time bucket")
+    p.add_argument('date', help='trade date, yyyymmdd')
+    p.add_argument('parent', nargs='?', type=int, help="baseParentNumber or its last 5 digits (default the day's first)")
+    p.add_argument('--bucket', default='5min', help='bucket width (default 5min)')
+    p.add_argument('--format', default='html', help='html, or an image format such as png (needs kaleido)')
+    p.add_argument('--open', action='store_true', help='open the chart in a browser')
+    p.set_defaults(func=run_hist)
+
+    p = sub.add_parser('backfill', help='rebuild TCA files for a range of trade dates')
+    p.add_argument('start', nargs='?', help='first date, yyyymmdd (default earliest)')
+    p.add_argument('end', nargs='?', help='last date, yyyymmdd (default latest)')
+    p.add_argument('--workers', type=int, default=None, help='worker processes (default all cores)')
+    p.add_argument('--engine', choices=['ml', 'single'], default='ml')
+    p.add_argument('--no-cache', action='store_true', help='recompute every parent')
+    p.add_argument('--exact-vols', action='store_true', help='use exact implied vols in the vol rows')
+    p.set_defaults(func=run_backfill)
+
+    p = sub.add_parser('charts', help='render the charts of every order for a range of trade dates')
+    p.add_argument('start', nargs='?', help='first date, yyyymmdd (default earliest)')
+    p.add_argument('end', nargs='?', help='last date, yyyymmdd (default latest)')
+    p.add_argument('--workers', type=int, default=None, help='worker processes (default all cores)')
+    p.add_argument('--format', default='html', help='html, or an image format such as png (needs kaleido)')
+    p.add_argument('--bucket', default='5min', help='histogram bucket width (default 5min)')
+    p.add_argument('--max-points', type=int, default=None, help='downsample chart lines to this many points')
+    p.set_defaults(func=run_charts)
+
+    p = sub.add_parser('dates', help='list the trade dates available for a table')
+    p.add_argument('table', nargs='?', default='Trades', help='FillStore table (default Trades)')
+    p.set_defaults(func=run_dates)
+
+    p = sub.add_parser('find', help='list the dates and rows where an order, package, risk group or secKey is')
+    p.add_argument('parent', nargs='?', type=int, help='baseParentNumber')
+    p.add_argument('--packageId', type=int, default=None)
+    p.add_argument('--riskGroupId', type=int, default=None)
+    p.add_argument('--secKey', default=None, help="e.g. 'SPX 20210319 3860.0 Call', or a ticker")
+    p.add_argument('--table', default=None, help='one FillStore table (default all)')
+    p.set_defaults(func=run_find)
+
+    p = sub.add_parser('rollup', help='TCA history from the warehouse, combined by ticker, strategy or childMethod')
+    p.add_argument('dim', choices=['ticker', 'strategy', 'childMethod'])
+    p.add_argument('start', nargs='?', help='first date, yyyymmdd (default earliest)')
+    p.add_argument('end', nargs='?', help='last date, yyyymmdd (default latest)')
+    p.add_argument('--bucket', choices=['Maker', 'Taker', 'Total'], default='Total')
+    p.add_argument('--metrics', default=None, help="comma separated, e.g. 'orders,Slip Qwap Px' (default all)")
+    p.add_argument('--engine', choices=['ml', 'single'], default='ml')
+    p.set_defaults(func=run_rollup)
+
+    p = sub.add_parser('children', help='child order fill rates and time to fill percentiles')
+    p.add_argument('start', nargs='?', help='first date, yyyymmdd (default earliest)')
+    p.add_argument('end', nargs='?', help='last date, yyyymmdd (default latest)')
+    p.add_argument('--by', default='methodFamily',
+                   help="comma separated, e.g. 'childMethod,childMktStance' or 'progressRule' (default methodFamily)")
+    p.set_defaults(func=run_children)
+
+    p = sub.add_parser('bench-imports', help='time the import of each module in a fresh interpreter')
+    p.add_argument('modules', nargs='*', help='modules to time (default the tools and their heavy dependencies)')
+    p.add_argument('--repeat', type=int, default=5, help='runs per module; the best is reported (default 5)')
+    p.set_defaults(func=run_bench_imports)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,22 +1,24 @@
 import pandas as pd
-import os
-import re
+import numpy as np
+
+# srtrade009.msgsprdparentexecution has 244 columns.  These are the ones we need
+keep_cols = ['parentNumber', 'baseParentNumber', 'clOrdId', 'secKey_tk', 'secKey_yr',
+        'secKey_mn', 'secKey_dy', 'secKey_xx', 'secKey_cp', 'secType',
+        'orderSide', 'childSize', 'childPrice', 'childDttm', 'childMakerTaker',
+        'childUBid', 'childUAsk', 'childBid', 'childAsk', 'childMark',
+        'childVol', 'childProb', 'childMktStance', 'childMethod',
+        'fillTransactDttm', 'fillExchFee', 'fillPrice', 'fillQuantity', 'fillBid',
+        'fillAsk', 'fillMark', 'fillUMark', 'fillUBid', 'fillUAsk',
+        'fillVolAtm', 'fillMark1M', 'fillMark10M', 'fillBid1M', 'fillAsk1M',
+        'fillBid10M', 'fillAsk10M', 'fillUMark1M', 'fillUMark10M', 'fillVolAtm1M',
+        'fillVolAtm10M', 'fillVol', 'fillProb', 'fillLimitRefUPrc', 'fillVe',
+        'fillGa', 'fillDe', 'fillTh', 'parentDttm', 'parentUBid',
+        'parentUAsk', 'parentUMark', 'parentBid', 'parentAsk', 'parentMark',
+        'autoHedge']
+
 
 def filter_cols(df):
-    # srtrade009.msgsprdparentexecution has 244 columns.  Let's filter to just the ones we need
-    keep_cols = ['parentNumber', 'baseParentNumber', 'clOrdId', 'secKey_tk', 'secKey_yr',
-            'secKey_mn', 'secKey_dy', 'secKey_xx', 'secKey_cp', 'secType',
-            'orderSide', 'childSize', 'childPrice', 'childDttm', 'childMakerTaker',
-            'childUBid', 'childUAsk', 'childBid', 'childAsk', 'childMark',
-            'childVol', 'childProb', 'childMktStance', 'childMethod',
-            'fillTransactDttm', 'fillExchFee', 'fillPrice', 'fillQuantity', 'fillBid',
-            'fillAsk', 'fillMark', 'fillUMark', 'fillUBid', 'fillUAsk',
-            'fillVolAtm', 'fillMark1M', 'fillMark10M', 'fillBid1M', 'fillAsk1M',
-            'fillBid10M', 'fillAsk10M', 'fillUMark1M', 'fillUMark10M', 'fillVolAtm1M',
-            'fillVolAtm10M', 'fillVol', 'fillProb', 'fillLimitRefUPrc', 'fillVe',
-            'fillGa', 'fillDe', 'fillTh', 'parentDttm', 'parentUBid',
-            'parentUAsk', 'parentUMark', 'parentBid', 'parentAsk', 'parentMark',
-            'autoHedge']
+    # Drop every column of an execution query except keep_cols
     df.drop([c for c in df.columns if c not in keep_cols], axis=1, inplace=True)
 
 
@@ -28,40 +30,234 @@ def round_price_cols(df):
         df[col] = df[col].apply(lambda x: round(x, 2))
 
 
+# Compact dtypes for fills, applied by compact_fills.  Strings with few distinct values become
+# categoricals and counts the smallest integer type that holds them.  Quantities stay at least
+# int32 so that products and running sums of them can't overflow.  Prices are the fill_price_cols:
+# they are rounded to the penny and kept as float32 when every price is below 2**17 ($131,072),
+# where float32 steps are at most 1/128 so each penny rounds back exactly (above it they are 1/64
+# and some don't).  Other floats (marks, vols, probs, greeks and fees) are never rounded; they
+# become float32 where that keeps them to SR's 7 significant figures
+fill_categories = ['secKey_tk', 'secKey_cp', 'secType', 'orderSide', 'childMakerTaker', 'childMktStance',
+                   'childMethod', 'autoHedge', 'execShape']
+fill_int_floors = {'secKey_yr': 'int8', 'secKey_mn': 'int8', 'secKey_dy': 'int8',
+                   'childSize': 'int32', 'fillQuantity': 'int32'}
+fill_price_cols = ['secKey_xx', 'childPrice', 'childUBid', 'childUAsk', 'childBid', 'childAsk',
+                   'fillPrice', 'fillBid', 'fillAsk', 'fillUBid', 'fillUAsk', 'fillBid1M', 'fillAsk1M',
+                   'fillBid10M', 'fillAsk10M', 'fillLimitRefUPrc', 'parentUBid', 'parentUAsk', 'parentBid',
+                   'parentAsk']
+max_float32_price = 2**17
+
+
+def downcast_int(s, floor='int8'):
+    # Returns integer Series s as the smallest integer type (no smaller than floor) holding its values
+    for dtype in ['int8', 'int16', 'int32', 'int64']:
+        if np.dtype(dtype).itemsize < np.dtype(floor).itemsize:
+            continue
+        info = np.iinfo(dtype)
+        if s.empty or (s.min() >= info.min and s.max() <= info.max):
+            return s.astype(dtype)
+    return s
+
+
+def compact_fills(df):
+    """Returns df with the compact fill dtypes of fill_categories, fill_int_floors and the float rules above
+
+    Columns are only converted where the conversion is safe: integer columns holding NaN, strings
+    which aren't listed and floats which float32 would not hold closely enough keep their dtype.
+    Arithmetic on the float32 columns is done in float32 unless they are cast back, so the TCA
+    engines, whose output is compared to the penny, load fills without this.
+
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        Rows of msgsrparentexecution, as returned by FillStore.load_fills
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        A new frame; df is not changed
+    """
+
+    df = df.copy()
+    for col in df.columns:
+        s = df[col]
+        if col in fill_categories and s.dtype == object:
+            df[col] = s.astype('category')
+        elif col in fill_int_floors and pd.api.types.is_integer_dtype(s):
+            df[col] = downcast_int(s, fill_int_floors[col])
+        elif s.dtype == 'float64':
+            if col in fill_price_cols:
+                # Round to the penny, as round_price_cols
+                s = s.round(2)
+                if not (s.abs() >= max_float32_price).any():
+                    df[col] = s.astype('float32')
+                else:
+                    df[col] = s
+            else:
+                f = s.astype('float32')
+                if np.allclose(f.astype('float64'), s, rtol=1e-7, atol=1e-12, equal_nan=True):
+                    df[col] = f
+    return df
+
+
+def compact_errors(df, compacted):
+    """Returns the float columns other than prices which compact_fills changed beyond float32 precision
+
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        Fills as loaded
+    compacted : pandas.core.frame.DataFrame
+        compact_fills(df)
+
+    Returns
+    -------
+    dict
+        Column -> the number of values which differ by more than rtol 1e-7; empty if none do
+    """
+
+    errors = {}
+    for col in df.columns:
+        if df[col].dtype != 'float64' or col in fill_price_cols:
+            continue
+        close = np.isclose(compacted[col].astype('float64'), df[col], rtol=1e-7, atol=1e-12, equal_nan=True)
+        if not close.all():
+            errors[col] = int((~close).sum())
+    return errors
+
+
+# Offsets between Chicago wall-clock time and UTC, keyed by wall-clock hour.  DST transitions
+# happen on the hour, so every timestamp within an hour shares the same offset
+_NS_PER_HOUR = 3600 * 10**9
+_NAT_NS = np.iinfo('int64').min
+_chicago_offsets = {}
+
+
+def _chicago_to_utc(naive_ns):
+    # naive_ns is an int64 array of America/Chicago wall-clock times in ns (no NaT)
+    # Returns the matching UTC ns, localizing each distinct hour at most once per session
+    hours = naive_ns // _NS_PER_HOUR
+    uniq_hours, inverse = np.unique(hours, return_inverse=True)
+    missing = np.array([h for h in uniq_hours if h not in _chicago_offsets], dtype='int64')
+    if missing.shape[0] > 0:
+        starts = pd.DatetimeIndex((missing * _NS_PER_HOUR).view('M8[ns]'))
+        try:
+            utc = starts.tz_localize('America/Chicago')
+        except Exception:
+            # Ambiguous or non-existent hour.  Localize the actual values so the error matches tz_localize's
+            pd.DatetimeIndex(naive_ns.view('M8[ns]')).tz_localize('America/Chicago')
+            raise
+        for h, off in zip(missing, (starts.asi8 - utc.asi8)):
+            _chicago_offsets[h] = off
+    offsets = np.array([_chicago_offsets[h] for h in uniq_hours], dtype='int64')
+    return naive_ns - offsets[inverse]
+
+
+def _parse_naive(s):
+    # Parse a column of SR time strings to tz-naive datetime64, trying the known format first
+    if pd.api.types.is_datetime64_dtype(s):
+        return s
+    try:
+        return pd.to_datetime(s, format='%Y-%m-%d %H:%M:%S')
+    except (ValueError, TypeError):
+        return s.apply(pd.to_datetime)
+
+
 def process_time_cols(df):
     # df is a query from srtrade009.msgsrparentexecution
     # Convert SR's string time fields and convert to tz-aware Timestamps, adding in micros if available
+    # Columns are parsed in one pass and micros are added as integer nanoseconds
 
     time_cols = [col for col in df.columns if ('Dttm' in col) and ('_us' not in col)]
     for col in time_cols:
-        df[col] = df[col].apply(pd.to_datetime)
-        df[col] = df[col].dt.tz_localize('America/Chicago').dt.tz_convert('America/New_York')
-        try:
-            s = df[col + '_us'].apply(pd.Timedelta, unit='micros')
-            df[col] = df[col] + s
-        except:
-            pass
+        if pd.api.types.is_datetime64tz_dtype(df[col]):
+            # Already normalized (e.g. loaded from a typed store)
+            continue
+        naive = _parse_naive(df[col])
+        ns = naive.values.astype('M8[ns]').view('int64')
+        valid = ns != _NAT_NS
+        utc_ns = np.full(ns.shape, _NAT_NS, dtype='int64')
+        utc_ns[valid] = _chicago_to_utc(ns[valid])
+        if col + '_us' in df.columns:
+            try:
+                us = pd.to_numeric(df[col + '_us']).values.astype('float64')
+                valid &= ~np.isnan(us)
+                utc_ns[valid] += (us[valid] * 1000).astype('int64')
+                utc_ns[~valid] = _NAT_NS
+            except (ValueError, TypeError):
+                pass
+        df[col] = pd.DatetimeIndex(utc_ns.view('M8[ns]')).tz_localize('UTC').tz_convert('America/New_York')
 
 
-def format_df(df, format_dict, axis=0, drop_Nan=True):
+def format_df(df, format_dict, axis=0, drop_Nan=True, raw=False):
     # Converts a dataframe with numeric types to all strings using supplied format codes
-    # Format codes are applied along rows (default) or columns (axis=1)
+    # Format codes are applied along rows (default) or columns (axis=1), a whole row (or col) at a time
+    # Strings and Nan's are passed through unchanged
     # Rows (or cols) with any Nan's are deleted unless drop_Nan = False
-    out_df = pd.DataFrame(index=df.index, columns=df.columns)
-    for row in df.index:
-        for col in df.columns:
-            if (type(df.loc[row, col]) is str) or (pd.isna(df.loc[row, col])):
-                out_df.loc[row, col] = df.loc[row, col]
-            else:
-                if axis == 0:
-                    out_df.loc[row, col] = format_dict[row].format(df.loc[row, col])
-                else:
-                    out_df.loc[row, col] = format_dict[col].format(df.loc[row, col])
+    # raw=True skips the formatting and returns numbers as floats, for consumers that don't need strings
+    values = df.to_numpy(dtype=object)
+    keep = pd.isna(values)
+    if not all(pd.api.types.is_numeric_dtype(t) for t in df.dtypes):
+        keep |= np.frompyfunc(lambda x: type(x) is str, 1, 1)(values).astype(bool)
+
+    if raw:
+        out_df = pd.DataFrame(values, index=df.index, columns=df.columns)
+        for col in out_df.columns:
+            if not keep[:, out_df.columns.get_loc(col)].all():
+                try:
+                    out_df[col] = out_df[col].astype(float)
+                except (ValueError, TypeError):
+                    pass
+    else:
+        out = values.copy()
+        labels = df.index if axis == 0 else df.columns
+        for i, label in enumerate(labels):
+            fmt = format_dict[label].format
+            vec = out[i] if axis == 0 else out[:, i]
+            mask = ~(keep[i] if axis == 0 else keep[:, i])
+            vec[mask] = [fmt(x) for x in vec[mask]]
+        out_df = pd.DataFrame(out, index=df.index, columns=df.columns)
+
     if drop_Nan:
         out_df = out_df[out_df.notna().all(axis=(1-axis))]
     return out_df
 
 
+def group_fills(df, groupCol, parentFills=None):
+    """Groups a day's fills once by groupCol (e.g. packageId) and baseParentNumber
+
+    Parameters
+    ----------
+    df : pandas.core.frame.DataFrame
+        A day of fills from SRSE Trade's msgsrparentexecution table
+    groupCol : string
+        The column which ties related parents together, e.g. 'packageId' or 'riskGroupId'
+    parentFills : dict, optional
+        df already split by baseParentNumber, as returned by an earlier call (default is to split it)
+
+    Returns
+    -------
+    list
+        (group, opt_parents, stock_parents) tuples, in order of first appearance, with parents
+        classified by the secType of their first fill.  Parents whose groupCol is null are in no
+        group, as they matched no group under the original == masks
+    dict
+        baseParentNumber -> the parent's fills, in their original row order
+    """
+
+    if parentFills is None:
+        parentFills = {p: g for p, g in df.groupby('baseParentNumber', sort=False)}
+    secTypes = {p: g['secType'].iloc[0] for p, g in parentFills.items()}
+    pairs = df[[groupCol, 'baseParentNumber']].drop_duplicates()
+    groups = []
+    for grp, sub in pairs.groupby(groupCol, sort=False):
+        parents = sub['baseParentNumber'].tolist()
+        groups.append((grp,
+                       [p for p in parents if secTypes[p] == 'Option'],
+                       [p for p in parents if secTypes[p] == 'Stock']))
+    return groups, parentFills
+
+
 def make_title(df):
     # df is a query from srtrade009.msgsrparentexecution, filtered to a single execution
     # Returns a descriptive title for the order
@@ -83,8 +279,8 @@ def find_first_file(dt, fStart='BrkrState'):
     """Returns a dataframe for the first file dated after dt starting with fStart
 
     The function is hard-coded to look in the directory FillData which is assumed to be
-    in the current working directory.  Files are assumed to be of the format
-    fStartyyyymmdd.csv
+    in the current working directory.  Dates are taken from both the FillStore partitions
+    and files of the format fStartyyyymmdd.csv, preferring the store when both exist
 
     Parameters
     ----------
@@ -96,18 +292,15 @@ def find_first_file(dt, fStart='BrkrState'):
     Returns
     -------
     pandas.core.frame.DataFrame or None
-        The result of applying pd.read_csv to the first filename, or None
-        if no appropriate filename found
+        The normalized table for the first date found (see FillStore.load_table), or None
+        if no appropriate date found
     """
 
-    dirPath = os.path.join(os.getcwd(), 'FillData')
-    contents = [f for f in os.listdir(dirPath) if fStart in f]
-    dateStrs = [re.findall('\d{8}', c) for c in contents]
-    dateStrs = [l[0] for l in dateStrs if len(l) > 0]
-    dates = [pd.to_datetime(s) for s in dateStrs]
-    validDates = sorted([d for d in dates if d >= dt])
+    # Imported here since FillStore itself depends on this module
+    from FillStore import available_dates, load_table
+
+    validDates = [d for d in available_dates(fStart) if d >= dt]
     if len(validDates) == 0:
         return None
     else:
-        firstFile = f'{fStart}{validDates[0]:%Y%m%d}.csv'
-        return pd.read_csv(os.path.join(dirPath, firstFile))
+        return load_table(fStart, validDates[0])
@@ -0,0 +1,286 @@
+# Live TCA for working orders, updated fill by fill
+#
+# StreamingTCA keeps running sums for each baseParentNumber (and each leg of a multi-leg order),
+# so every fill costs O(1) however many the order already has.  Snapshots give the metrics of
+# ProcessExecutions_ML.calc_TCA_metrics from the same statistics, via stats_to_array.  Fills can
+# come from a queue.Queue (e.g. fed by a message handler), from the parts QuerySRTables appends to
+# the day's Trades partition of the FillStore as it syncs, or from tailing a Trades csv.
+
+import io
+import os
+import time
+import numpy as np
+import pandas as pd
+from FillStore import partition_parts
+from SRUtils import format_df, make_title
+from ProcessExecutions_ML import (format_dict, leg_cols, arrival_stats, stats_to_array, results_to_df,
+                                  consolidate_legs)
+
+
+class FillAccumulator:
+    """Running TCA statistics for the fills of one instrument of one order
+
+    Holds the arrival_stats of the first positive fill and, for each of the Maker, Taker and
+    Total buckets, the bucket_stats sums: child orders and their sizes, filled quantity, price,
+    pct-spread and underlying mid times quantity, and the high and low (delta-adjusted) prices.
+    """
+
+    def __init__(self):
+        self.first = None
+        self.arrival = None
+        self.buckets = [None, None, None]
+        self.children = [{}, {}, {}]   # clOrdId -> childSize of its first fill, per bucket
+
+    def update(self, fill):
+        # Adds a fill (a dict or Series of msgsrparentexecution columns) to the running statistics
+        qty = fill['fillQuantity']
+        if not qty > 0:
+            return
+        if self.first is None:
+            self.first = dict(fill)
+            self.arrival = arrival_stats(self.first)
+        price = fill['fillPrice']
+        pctSpread = (price - fill['fillBid']) / (fill['fillAsk'] - fill['fillBid'])
+        delta = self.arrival['delta']
+        if delta != 0:
+            uMid = (fill['fillUBid'] + fill['fillUAsk']) / 2
+            dPrice = price - delta * (uMid - self.arrival['arrivalUMid'])
+        makerTaker = fill['childMakerTaker']
+        cols = [2] + ([0] if makerTaker == 'Maker' else [1] if makerTaker == 'Taker' else [])
+        for c in cols:
+            stats = self.buckets[c]
+            if stats is None:
+                stats = self.buckets[c] = {'childOrders': 0, 'childSizeSum': 0, 'filledCtr': 0,
+                                           'pctSpreadQty': 0.0, 'pxQty': 0.0, 'pxMax': price, 'pxMin': price}
+                if delta != 0:
+                    stats.update({'uMidQty': 0.0, 'dPxMax': dPrice, 'dPxMin': dPrice})
+            children = self.children[c]
+            if fill['clOrdId'] not in children:
+                children[fill['clOrdId']] = fill['childSize']
+                stats['childOrders'] += 1
+                stats['childSizeSum'] += fill['childSize']
+            stats['filledCtr'] += qty
+            stats['pctSpreadQty'] += pctSpread * qty
+            stats['pxQty'] += price * qty
+            stats['pxMax'] = max(stats['pxMax'], price)
+            stats['pxMin'] = min(stats['pxMin'], price)
+            if delta != 0:
+                stats['uMidQty'] += uMid * qty
+                stats['dPxMax'] = max(stats['dPxMax'], dPrice)
+                stats['dPxMin'] = min(stats['dPxMin'], dPrice)
+
+    def title(self):
+        # Returns SRUtils.make_title of the fills so far
+        return make_title(pd.DataFrame([dict(self.first, fillQuantity=self.buckets[2]['filledCtr'])]))
+
+    def to_array(self, qwap=None, qwapU=None, arrActSlipPct=None):
+        # Returns the calc_TCA_array of the fills so far, or None if there are none
+        if self.arrival is None:
+            return None
+        return stats_to_array(self.arrival, self.buckets, qwap, qwapU, arrActSlipPct)
+
+
+class StreamingTCA:
+    """TCA for every order seen on a stream of fills, keyed by baseParentNumber
+
+    Multi-leg orders (execShape 'MLegLeg') keep an accumulator per leg and are reported
+    consolidated, as the -Cons files of ProcessExecutions_ML.process_day_TCA.
+    """
+
+    def __init__(self):
+        self.parents = {}   # baseParentNumber -> {leg key: FillAccumulator}
+
+    def update(self, fill):
+        """Adds one fill to its order's statistics
+
+        Parameters
+        ----------
+        fill : dict or pandas.core.series.Series
+            A msgsrparentexecution row with at least the SRUtils.keep_cols fields
+
+        Returns
+        -------
+        int
+            The fill's baseParentNumber
+        """
+
+        parent = fill['baseParentNumber']
+        legs = self.parents.setdefault(parent, {})
+        if fill.get('execShape') == 'MLegLeg':
+            leg = tuple(fill[c] for c in leg_cols)
+        else:
+            leg = None
+        if leg not in legs:
+            legs[leg] = FillAccumulator()
+        legs[leg].update(fill)
+        return parent
+
+    def snapshot(self, parent, qwap=None, qwapU=None, arrActSlipPct=None, formatted=True):
+        """Returns the TCA of parent's fills so far, laid out as calc_TCA_metrics
+
+        Parameters
+        ----------
+        parent : int
+            The baseParentNumber
+        qwap, qwapU, arrActSlipPct : float, optional
+            As for calc_TCA_metrics; qwap and qwapU are ignored for multi-leg orders
+        formatted : bool, optional
+            Whether to convert the results to fixed-width formatted strings (default is True)
+
+        Returns
+        -------
+        pandas.core.frame.DataFrame or None
+            None if parent has no positive quantity fills yet
+        """
+
+        accs = [acc for acc in self.parents.get(parent, {}).values() if acc.arrival is not None]
+        if len(accs) == 0:
+            return None
+        if list(self.parents[parent]) == [None]:
+            vals = accs[0].to_array(qwap, qwapU, arrActSlipPct)
+            title = accs[0].title()
+        else:
+            legVals = np.stack([acc.to_array(None, None, arrActSlipPct) for acc in accs])
+            sides = np.array([acc.arrival['side'] for acc in accs])
+            vals = consolidate_legs(legVals, sides)
+            title = ''.join(acc.title() + ' ' for acc in accs)
+        results = results_to_df(vals, title)
+        if formatted:
+            results = format_df(results, format_dict)
+        return results
+
+
+def queue_source(q, sentinel=None):
+    # Yields fills from a queue.Queue until sentinel is taken from it
+    while True:
+        fill = q.get()
+        if fill is sentinel:
+            return
+        yield fill
+
+
+def store_source(dt, poll=1.0, idle_timeout=None):
+    """Yields the fills of the Trades partition for date dt as sync parts are added to it
+
+    Each new or rewritten part file is read once it is complete.  Fills are yielded in fillNumber
+    order within a part, and a fillNumber already yielded (e.g. after a full re-pull) is skipped.
+
+    Parameters
+    ----------
+    dt : datetime.date (or anything richer)
+        The partition date
+    poll : float, optional
+        Seconds to wait when there is no new part (default=1.0)
+    idle_timeout : float, optional
+        Stop after this many seconds without new parts (default is to follow the partition forever)
+
+    Yields
+    ------
+    dict
+        One per fill, as loaded from the store (time columns are tz-aware Timestamps)
+    """
+
+    read = {}    # part path -> modification time when read
+    seen = set()
+    idle = 0.0
+    while True:
+        new = False
+        for path in partition_parts('Trades', dt):
+            try:
+                mtime = os.path.getmtime(path)
+                if read.get(path) == mtime:
+                    continue
+                rows = pd.read_parquet(path)
+            except (OSError, ValueError):
+                # Removed by a full re-pull, or still being written; try again next poll
+                continue
+            read[path] = mtime
+            new = True
+            idle = 0.0
+            rows = rows.sort_values('fillNumber', kind='mergesort')
+            rows = rows[~rows['fillNumber'].isin(seen)]
+            seen.update(rows['fillNumber'])
+            yield from rows.to_dict('records')
+        if not new:
+            if idle_timeout is not None and idle >= idle_timeout:
+                return
+            time.sleep(poll)
+            idle += poll
+
+
+def tail_source(path, poll=1.0, idle_timeout=None):
+    """Yields the rows of a growing csv file as they are appended, like tail -f
+
+    Parameters
+    ----------
+    path : string
+        A Trades csv; its first line must be the header
+    poll : float, optional
+        Seconds to wait when no complete new line is available (default=1.0)
+    idle_timeout : float, optional
+        Stop after this many seconds without new rows (default is to follow the file forever)
+
+    Yields
+    ------
+    dict
+        One per row, with values typed as pandas.read_csv would
+    """
+
+    while not os.path.exists(path):
+        time.sleep(poll)
+    with open(path) as f:
+        header = f.readline()
+        while not header.endswith('\n'):
+            time.sleep(poll)
+            header += f.readline()
+        pending = ''
+        idle = 0.0
+        while True:
+            pending += f.read()
+            # Only parse complete lines; a partly written last line waits for the next read
+            cut = pending.rfind('\n') + 1
+            if cut > 0:
+                rows = pd.read_csv(io.StringIO(header + pending[:cut]))
+                pending = pending[cut:]
+                idle = 0.0
+                yield from rows.to_dict('records')
+            else:
+                if idle_timeout is not None and idle >= idle_timeout:
+                    return
+                time.sleep(poll)
+                idle += poll
+
+
+def run_stream(source, engine=None, on_update=None):
+    """Feeds every fill from source into engine
+
+    Parameters
+    ----------
+    source : iterable
+        Of fills, e.g. queue_source, store_source or tail_source
+    engine : StreamingTCA, optional
+        The engine to update (default is a new one)
+    on_update : callable, optional
+        Called as on_update(engine, baseParentNumber) after each fill, e.g. to refresh a display
+
+    Returns
+    -------
+    StreamingTCA
+    """
+
+    if engine is None:
+        engine = StreamingTCA()
+    for fill in source:
+        parent = engine.update(fill)
+        if on_update is not None:
+            on_update(engine, parent)
+    return engine
+
+
+if __name__ == '__main__':
+    # Follows today's Trades partition, which `python SRCli.py sync` (e.g. run every minute) extends
+
+    def show(engine, parent):
+        print(engine.snapshot(parent)[['Total']].T.to_string())
+
+    run_stream(store_source(pd.Timestamp.now().normalize()), on_update=show)
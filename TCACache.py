@@ -0,0 +1,90 @@
+# Content-hash cache of the TCA files written for each parent, so reruns only recompute what changed
+#
+# Each engine and trade date has its own shard under FillData/Store/TCACache/{engine}, which keeps
+# backfill workers, and the two engines run over the same day, from writing to the same file.  A shard maps baseParentNumber to the hash of everything the
+# parent's TCA depends on and the files that were written from it.
+
+import os
+import hashlib
+import pickle
+import pandas as pd
+from FillStore import store_dir
+
+
+def cache_dir(engine='ProcessExecutions_ML'):
+    return os.path.join(store_dir(), 'TCACache', engine)
+
+
+class TCACache:
+    """Cache of the TCA output files of one engine for one trade date, keyed by a hash of their inputs
+
+    Entries are dropped when their files are missing from TCA/ or their parent no longer
+    trades on the date.  Whole days are evicted least recently used first once there are
+    more than maxDays shards of the engine.
+
+    Parameters
+    ----------
+    dt : datetime.date (or anything richer)
+        The trade date
+    engine : string
+        The engine writing the files, ProcessExecutions or ProcessExecutions_ML
+    maxDays : int, optional
+        The number of day shards to keep (default=250)
+    """
+
+    def __init__(self, dt, engine, maxDays=250):
+        self.dt = dt
+        self.engine = engine
+        self.maxDays = maxDays
+        self.path = os.path.join(cache_dir(engine), f'{dt:%Y%m%d}.pkl')
+        self.entries = {}   # baseParentNumber -> (key, [file names])
+        self.seen = {}      # entries confirmed or stored in this run
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                self.entries = pickle.load(f)
+
+    @staticmethod
+    def make_key(fills, *inputs):
+        """Returns a hash of a parent's fill rows and any other inputs to its TCA
+
+        Parameters
+        ----------
+        fills : pandas.core.frame.DataFrame
+            The parent's fills
+        *inputs
+            Anything else the results depend on, e.g. broker state marks, hedge slippage and
+            the engine's TCA_VERSION.  Must have a stable repr
+
+        Returns
+        -------
+        string
+        """
+
+        h = hashlib.sha1(pd.util.hash_pandas_object(fills, index=False).values.tobytes())
+        h.update(repr(inputs).encode())
+        return h.hexdigest()
+
+    def lookup(self, parent, key):
+        # Returns the files written for parent if its key matches and they all still exist, else None
+        entry = self.entries.get(parent)
+        if entry is None or entry[0] != key:
+            return None
+        if not all(os.path.exists(os.path.join(os.getcwd(), 'TCA', f)) for f in entry[1]):
+            return None
+        self.seen[parent] = entry
+        return entry[1]
+
+    def store(self, parent, key, files):
+        self.seen[parent] = (key, list(files))
+
+    def save(self):
+        # Writes the entries seen in this run, dropping parents which no longer trade, then evicts old days
+        eDir = cache_dir(self.engine)
+        os.makedirs(eDir, exist_ok=True)
+        with open(self.path, 'wb') as f:
+            pickle.dump(self.seen, f)
+        self.entries = dict(self.seen)
+        shards = sorted((os.path.join(eDir, f) for f in os.listdir(eDir) if f.endswith('.pkl')),
+                        key=os.path.getmtime)
+        for path in shards[:max(0, len(shards) - self.maxDays)]:
+            os.remove(path)
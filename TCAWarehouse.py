@@ -0,0 +1,274 @@
+# Cross-day store of the numeric TCA results, with daily rollups for quick history queries
+#
+# process_day_TCA records the unformatted metrics of every file it writes as rows of a fact table
+# keyed by date, baseParentNumber, leg and bucket (Maker / Taker / Total).  Leg 0 is the order
+# itself, or for a multi-leg order its consolidated results; its legs are 1, 2, ...  Each day is a
+# parquet shard under FillData/Store/TCAWarehouse/{engine}/facts, so backfill workers never share
+# a file and a rerun simply replaces its day.
+#
+# When a day's facts are saved its rollups by ticker, strategy and childMethod are rebuilt from
+# them and saved as small shards of their own.  A rollup holds sums: orders, contracts filled, USD
+# slippage, and the per contract metrics multiplied by contracts filled, so any range of days can
+# be combined into quantity-weighted averages without going back to the facts.
+
+import os
+import time
+import pandas as pd
+from FillStore import store_dir
+
+dims = ['ticker', 'strategy', 'childMethod']
+
+# Descriptive columns of each fact row, ahead of the metric columns (named as in rows_dict)
+fact_cols = ['date', 'baseParentNumber', 'leg', 'bucket', 'ticker', 'secType', 'strategy', 'childMethod',
+             'orderSide']
+
+# Rollup metrics summed as they are, and those averaged weighted by Filled Ctr
+sum_metrics = ['Child Orders', 'Filled Ctr', 'Slip Arr Mid USD', 'Slip Arr Mark USD', 'Slip Qwap USD',
+               'DTheo Slip Arr Mid USD', 'DTheo Slip Arr Mark USD', 'DTheo Slip Qwap USD',
+               'DAct Slip Arr Mid USD', 'DAct Slip Arr Mark USD', 'DActSlip Qwap USD']
+avg_metrics = ['Ctr Fill Rate', 'Avg Fill Pct Spread', 'Slip Arr Mid Px', 'Slip Arr Mark Px', 'Slip Qwap Px',
+               'DTheo Slip Arr Mid Px', 'DTheo Slip Arr Mark Px', 'DTheo Slip Qwap Px',
+               'DTheo Slip Arr Mid Vol', 'DTheo Slip Arr Mark Vol', 'DTheo Slip Qwap Vol',
+               'DAct Slip Arr Mid Px', 'DAct Slip Arr Mark Px', 'DAct Slip Qwap Px',
+               'DAct Slip Arr Mid Vol', 'DAct Slip Arr Mark Vol', 'DAct Slip Qwap Vol']
+
+
+def warehouse_dir(engine='ProcessExecutions_ML'):
+    return os.path.join(store_dir(), 'TCAWarehouse', engine)
+
+
+def fact_path(dt, engine='ProcessExecutions_ML'):
+    return os.path.join(warehouse_dir(engine), 'facts', f'{dt:%Y%m%d}.parquet')
+
+
+def rollup_path(dim, dt, engine='ProcessExecutions_ML'):
+    return os.path.join(warehouse_dir(engine), 'rollups', dim, f'{dt:%Y%m%d}.parquet')
+
+
+def strategy_name(fills, hedged=False):
+    # Classifies an order as Stock, Option or Multi-leg, prefixed Hedged if it has a delta hedge
+    first = fills.iloc[0]
+    if first['secType'] != 'Option':
+        return 'Stock'
+    shape = 'Multi-leg' if first.get('execShape') == 'MLegLeg' else 'Option'
+    return 'Hedged ' + shape if hedged else shape
+
+
+def main_method(fills):
+    # Returns the childMethod which filled the most quantity, or '' if nothing filled
+    fills = fills[fills['fillQuantity'] > 0]
+    if fills.shape[0] == 0:
+        return ''
+    return fills.groupby('childMethod')['fillQuantity'].sum().idxmax()
+
+
+class DayFacts:
+    """Collects the TCA results of one trade date and saves them as fact and rollup shards
+
+    Parents whose files were current in the TCACache aren't recomputed, so their facts are
+    carried over from the day's existing shard; has() tells the engine whether there are any.
+
+    Parameters
+    ----------
+    dt : datetime.date (or anything richer)
+        The trade date
+    engine : string
+        The TCA module, e.g. 'ProcessExecutions_ML'
+    rows : list
+        The row names of the engine's TCA arrays, i.e. list(rows_dict)
+    """
+
+    def __init__(self, dt, engine, rows):
+        self.dt = pd.to_datetime(dt)
+        self.engine = engine
+        self.rows = rows
+        self.records = []
+        self.added = set()
+        path = fact_path(self.dt, engine)
+        self.existing = pd.read_parquet(path) if os.path.exists(path) else None
+
+    def has(self, parent):
+        # Whether the day's saved facts include parent
+        return self.existing is not None and (self.existing['baseParentNumber'] == parent).any()
+
+    def add(self, parent, leg, vals, fills, strategy):
+        """Adds a fact row for each bucket of vals which has fills
+
+        Parameters
+        ----------
+        parent : int
+            The baseParentNumber
+        leg : int
+            0 for the order (or its consolidated results), otherwise the leg number
+        vals : numpy.ndarray
+            From calc_TCA_array or consolidate_legs, shape (len(rows), 3)
+        fills : pandas.core.frame.DataFrame
+            The fills vals was calculated from
+        strategy : string
+            From strategy_name
+        """
+
+        self.added.add(parent)
+        first = fills.iloc[0]
+        makerTaker = fills['childMakerTaker']
+        for c, bucket in enumerate(['Maker', 'Taker', 'Total']):
+            filled = vals[self.rows.index('Filled Ctr'), c]
+            if not filled > 0:
+                continue
+            bucketFills = fills if bucket == 'Total' else fills[makerTaker == bucket]
+            record = {'date': self.dt, 'baseParentNumber': parent, 'leg': leg, 'bucket': bucket,
+                      'ticker': first['secKey_tk'], 'secType': first['secType'], 'strategy': strategy,
+                      'childMethod': main_method(bucketFills), 'orderSide': first['orderSide']}
+            record.update((row, vals[r, c]) for r, row in enumerate(self.rows) if row != 'Order')
+            self.records.append(record)
+
+    def save(self, parents):
+        """Writes the day's facts, keeping earlier facts of cached parents, and rebuilds its rollups
+
+        Parameters
+        ----------
+        parents : list
+            The baseParentNumbers trading on the day; facts of any others are dropped
+
+        Returns
+        -------
+        pandas.core.frame.DataFrame
+            The day's facts
+        """
+
+        facts = pd.DataFrame(self.records, columns=fact_cols + [r for r in self.rows if r != 'Order'])
+        if self.existing is not None:
+            keep = self.existing['baseParentNumber'].isin(set(parents) - self.added)
+            facts = pd.concat([self.existing[keep], facts], ignore_index=True)
+        facts = facts.sort_values(['baseParentNumber', 'leg', 'bucket'], ignore_index=True)
+        path = fact_path(self.dt, self.engine)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        facts.to_parquet(path, index=False)
+        for dim in dims:
+            path = rollup_path(dim, self.dt, self.engine)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            day_rollup(facts, dim).to_parquet(path, index=False)
+        return facts
+
+
+def day_rollup(facts, dim):
+    """Returns the rollup sums of one day's facts by dim
+
+    Only leg 0 rows are used, so each order is counted once.
+
+    Parameters
+    ----------
+    facts : pandas.core.frame.DataFrame
+        One day's fact table
+    dim : string
+        One of dims
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        One row per date, dim value and bucket with orders, the sum_metrics, and for each of the
+        avg_metrics '{metric} x Ctr' and '{metric} Ctr', the Filled Ctr of the rows where it is defined
+    """
+
+    facts = facts[facts['leg'] == 0]
+    sums = pd.DataFrame({'date': facts['date'], dim: facts[dim], 'bucket': facts['bucket'],
+                         'orders': 1})
+    for m in sum_metrics:
+        sums[m] = facts[m].fillna(0)
+    filled = facts['Filled Ctr']
+    for m in avg_metrics:
+        defined = facts[m].notna()
+        sums[m + ' x Ctr'] = (facts[m] * filled).where(defined, 0)
+        sums[m + ' Ctr'] = filled.where(defined, 0)
+    return sums.groupby(['date', dim, 'bucket'], as_index=False).sum()
+
+
+def shard_paths(kind, start=None, end=None, engine='ProcessExecutions_ML'):
+    # Returns the shards of kind ('facts' or 'rollups/{dim}') dated between start and end
+    kDir = os.path.join(warehouse_dir(engine), kind)
+    if not os.path.isdir(kDir):
+        return []
+    paths = []
+    for f in sorted(os.listdir(kDir)):
+        dt = pd.to_datetime(f[:8])
+        if (start is None or dt >= pd.to_datetime(start)) and (end is None or dt <= pd.to_datetime(end)):
+            paths.append(os.path.join(kDir, f))
+    return paths
+
+
+def load_facts(start=None, end=None, engine='ProcessExecutions_ML', columns=None):
+    """Returns the fact rows of every date between start and end (inclusive)
+
+    Parameters
+    ----------
+    start, end : datetime.date (or anything pd.to_datetime accepts), optional
+        The range of trade dates (default is all)
+    engine : string, optional
+        The TCA module whose results to load (default='ProcessExecutions_ML')
+    columns : list, optional
+        Restrict the load to these columns (default is all)
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+    """
+
+    paths = shard_paths('facts', start, end, engine)
+    if len(paths) == 0:
+        return pd.DataFrame(columns=columns or fact_cols)
+    return pd.concat([pd.read_parquet(p, columns=columns) for p in paths], ignore_index=True)
+
+
+def query_rollup(dim, start=None, end=None, bucket='Total', metrics=None, engine='ProcessExecutions_ML'):
+    """Returns the TCA of every order between start and end, combined by ticker, strategy or childMethod
+
+    Parameters
+    ----------
+    dim : string
+        One of dims
+    start, end : datetime.date (or anything pd.to_datetime accepts), optional
+        The range of trade dates (default is all)
+    bucket : string, optional
+        'Maker', 'Taker' or 'Total' (default='Total')
+    metrics : list, optional
+        Columns to return from orders, sum_metrics and avg_metrics (default is all)
+    engine : string, optional
+        The TCA module whose results to query (default='ProcessExecutions_ML')
+
+    Returns
+    -------
+    pandas.core.frame.DataFrame
+        Indexed by dim, with orders and the sum_metrics summed and the avg_metrics averaged
+        weighted by contracts filled
+    """
+
+    paths = shard_paths(os.path.join('rollups', dim), start, end, engine)
+    if len(paths) == 0:
+        return pd.DataFrame(columns=['orders'] + sum_metrics + avg_metrics)
+    sums = pd.concat([pd.read_parquet(p) for p in paths], ignore_index=True)
+    sums = sums[sums['bucket'] == bucket].drop(['date', 'bucket'], axis=1).groupby(dim).sum()
+    result = sums[['orders'] + sum_metrics].copy()
+    for m in avg_metrics:
+        result[m] = sums[m + ' x Ctr'] / sums[m + ' Ctr'].where(sums[m + ' Ctr'] > 0)
+    return result if metrics is None else result[metrics]
+
+
+def rebuild_rollups(engine='ProcessExecutions_ML'):
+    # Rewrites every rollup shard from the facts, e.g. after the rollup metrics change
+    for path in shard_paths('facts', engine=engine):
+        facts = pd.read_parquet(path)
+        dt = pd.to_datetime(os.path.basename(path)[:8])
+        for dim in dims:
+            rPath = rollup_path(dim, dt, engine)
+            os.makedirs(os.path.dirname(rPath), exist_ok=True)
+            day_rollup(facts, dim).to_parquet(rPath, index=False)
+
+
+if __name__ == '__main__':
+    pd.set_option('display.width', 200)
+    t0 = time.perf_counter()
+    result = query_rollup('ticker', metrics=['orders', 'Filled Ctr', 'Slip Qwap Px', 'Slip Qwap USD',
+                                             'DTheo Slip Qwap Px', 'DTheo Slip Qwap USD'])
+    ms = (time.perf_counter() - t0) * 1000
+    print(result.to_string())
+    print(f'{ms:.1f}ms')